@@ -6,12 +6,41 @@ __email__ = 'joe.vasquez@gmail.com'
 __license__ = 'MIT'
 
 import hashlib
+import mmap
+import os
 
-def generate_file_hash(path):
-    file_hash = hashlib.sha1()
+HASH_BUFFER_SIZE = 1024 * 1024
+
+def generate_file_hashes(path, algorithms=('sha1', ), use_mmap=True):
+    """
+    Generate File Hashes
+
+    Hashes the file at *path* once with every algorithm of *algorithms*,
+    returns the hexdigests by algorithm.  The file is memory mapped when
+    possible, otherwise it is read in HASH_BUFFER_SIZE chunks.
+    """
+    hashes = [(algorithm, hashlib.new(algorithm)) for algorithm in algorithms]
     with open(path, 'rb') as f:
-        data = f.read(4096)
-        while data != '':
-            file_hash.update(data)
-            data = f.read(4096)
-    return file_hash.hexdigest()
+        if use_mmap and os.fstat(f.fileno()).st_size > 0:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for algorithm, file_hash in hashes:
+                    file_hash.update(data)
+            finally:
+                data.close()
+        else:
+            data = f.read(HASH_BUFFER_SIZE)
+            while data != '':
+                for algorithm, file_hash in hashes:
+                    file_hash.update(data)
+                data = f.read(HASH_BUFFER_SIZE)
+    return dict((algorithm, file_hash.hexdigest()) for algorithm, file_hash in hashes)
+
+
+def generate_file_hash(path, algorithm='sha1', use_mmap=True):
+    """
+    Generate File Hash
+
+    Hashes the file at *path* with *algorithm*, see generate_file_hashes.
+    """
+    return generate_file_hashes(path, (algorithm, ), use_mmap)[algorithm]
@@ -2,22 +2,35 @@
 
 from django.contrib import admin
 from django.conf.urls.defaults import *
-from vz_backup.models import BackupObject, BackupArchive
+from vz_backup.models import BackupJob, BackupObject, BackupStats
 from vz_backup.views import delete_archive, reload_archive
 
 
 def backup_now(modeladmin, request, queryset):
     for bobj in queryset:
-        bobj.backup()
-backup_now.short_description = 'Backup Selected Objects Now'
+        bobj.enqueue('backup')
+    request.user.message_set.create(message='Queued backup of %d objects' % len(queryset))
+backup_now.short_description = 'Queue Backup of Selected Objects'
 
 
 def prune_now(modeladmin, request, queryset):
+    count = freed = 0
     for bobj in queryset:
-        bobj.prune()
+        ids, size = bobj.prune()
+        count = count + len(ids)
+        freed = freed + size
+    request.user.message_set.create(message='Pruned %d archives, freed %s' % (count, _sizeof_fmt(freed)))
 prune_now.short_description = 'Prune Selected Objects Now'
 
 
+def prune_preview(modeladmin, request, queryset):
+    for bobj in queryset:
+        ids, size = bobj.prune(dry_run=True)
+        request.user.message_set.create(message='%s: pruning would delete %d archives, %s' % (
+            bobj, len(ids), _sizeof_fmt(size)))
+prune_preview.short_description = 'Preview Prune of Selected Objects'
+
+
 class BackupObjectAdmin(admin.ModelAdmin):
     class Media:
         css = {
@@ -28,6 +41,7 @@ class BackupObjectAdmin(admin.ModelAdmin):
     list_display = (
         'app_label',
         'include',
+        'format',
         'compress',
         'prune_by',
         'auto_prune',
@@ -42,10 +56,25 @@ class BackupObjectAdmin(admin.ModelAdmin):
     actions = [
         backup_now,
         prune_now,
+        prune_preview,
     ]
     save_on_top = True
 
 
+    def queryset(self, request):
+        """
+        Join BackupStats so the changelist needs no query per row.
+        """
+        qs = super(BackupObjectAdmin, self).queryset(request)
+        return qs.select_related('stats')
+
+
+    def change_view(self, request, object_id, extra_context=None):
+        context = {'archive_page': request.GET.get('archive_page', 1)}
+        context.update(extra_context or {})
+        return super(BackupObjectAdmin, self).change_view(request, object_id, extra_context=context)
+
+
     def admin_delete_archive(self, request, id):
         return delete_archive(request, self, id)
 
@@ -57,6 +86,8 @@ class BackupObjectAdmin(admin.ModelAdmin):
     def get_urls(self):
         urls = super(BackupObjectAdmin, self).get_urls()
         my_urls = patterns('',
+            url(r'^download/(?P<id>\d+)/(?P<model>\w+\.\w+)/', 'vz_backup.views.download_archive_model',
+                name='vz_backup_download_archive_model'),
             url(r'^download/(?P<id>\d+)/', 'vz_backup.views.download_archive', name='vz_backup_download_archive'),
             url(r'^(?P<action>keep|unkeep)/(?P<id>\d+)/', 'vz_backup.views.keep_archive', name='vz_backup_keep_archive'),
             url(r'^delete/(?P<id>\d+)/', self.admin_delete_archive, name='vz_backup_delete_archive'),
@@ -66,17 +97,54 @@ class BackupObjectAdmin(admin.ModelAdmin):
         return my_urls + urls
 
     def backup_size(self, obj):
-        return _sizeof_fmt(obj.archives_size)
+        return _sizeof_fmt(_stats(obj).archives_size)
+    backup_size.admin_order_field = 'stats__archives_size'
 
     def number_of_archives(self, obj):
-        return obj.archives.count()
+        return _stats(obj).number_of_archives
+    number_of_archives.admin_order_field = 'stats__number_of_archives'
 
     def kept_archives(self, obj):
-        return obj.kept_archives.count()
+        return _stats(obj).kept_archives
+    kept_archives.admin_order_field = 'stats__kept_archives'
 
 admin.site.register(BackupObject, BackupObjectAdmin)
 
 
+class BackupJobAdmin(admin.ModelAdmin):
+    list_display = (
+        'backup_object',
+        'action',
+        'archive_id',
+        'status',
+        'progress',
+        'result',
+        'duration',
+        'queued',
+        'finished',
+    )
+    list_filter = ('status', 'action', )
+    readonly_fields = ('backup_object', 'action', 'archive_id', 'status', 'progress', 'result',
+        'error', 'duration', 'queued', 'started', 'finished', )
+
+
+    def queryset(self, request):
+        return super(BackupJobAdmin, self).queryset(request).select_related('backup_object')
+
+
+    def has_add_permission(self, request):
+        return False
+
+admin.site.register(BackupJob, BackupJobAdmin)
+
+
+def _stats(obj):
+    try:
+        return obj.stats
+    except BackupStats.DoesNotExist:
+        return obj.get_stats()
+
+
 #http://stackoverflow.com/questions/1094841/reusable-library-to-get-\
 #human-readable-version-of-file-size/1094933#1094933
 
@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks
+
+Timing helpers for the backup hot paths, used by the backup_benchmark
+management command.  Results are dicts that can be saved as JSON and
+compared against a saved baseline with compare_results.
+"""
+
+import datetime
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.core import serializers
+from django.core.serializers.python import Deserializer as PythonDeserializer
+from django.core.urlresolvers import reverse, NoReverseMatch
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.test.client import Client
+
+from vz_backup import generate_file_hash
+from vz_backup.compressors import COMPRESSORS, compressor_for_name
+from vz_backup.dump import CHUNK_SIZE, dump_app
+from vz_backup.restore import OBJECT_READERS
+
+# row counts of the synthetic data the suite runs on
+SIZES = (10000, 100000, 1000000)
+
+
+def _legacy_file_hash(path):
+    """The original 4 KB read loop, kept as a point of comparison."""
+    file_hash = hashlib.sha1()
+    with open(path, 'rb') as f:
+        data = f.read(4096)
+        while data != '':
+            file_hash.update(data)
+            data = f.read(4096)
+    return file_hash.hexdigest()
+
+
+def best_time(func, repeat=3, *args, **kwargs):
+    """Best wall clock time of *repeat* calls to *func*."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func(*args, **kwargs)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def _result(name, seconds, size):
+    if seconds > 0:
+        mb_per_s = size / seconds / 1000000.0
+    else:
+        mb_per_s = None
+    return {'name': name, 'seconds': seconds, 'bytes': size, 'mb_per_s': mb_per_s}
+
+
+def bench_file_hash(path, repeat=3):
+    """
+    Time generate_file_hash (mmap and buffered) against the 4 KB loop.
+    """
+    size = os.path.getsize(path)
+    return [
+        _result('hash_4k_loop', best_time(_legacy_file_hash, repeat, path), size),
+        _result('hash_buffered', best_time(generate_file_hash, repeat, path, use_mmap=False), size),
+        _result('hash_mmap', best_time(generate_file_hash, repeat, path), size),
+    ]
+
+
+class CountingSink(object):
+    """File-like object that only counts what is written to it."""
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size = self.size + len(data)
+
+    def flush(self):
+        pass
+
+
+def bench_compressors(path, repeat=1, names=None, level=None, threads=1):
+    """
+    Compress the dump at *path* with every registered compressor (or
+    those in *names*) and time compression and decompression.
+    """
+    size = os.path.getsize(path)
+    results = list()
+    for compressor in COMPRESSORS.values():
+        if names and compressor.name not in names:
+            continue
+        fd, tmp_path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            def compress():
+                with open(path, 'rb') as src:
+                    with open(tmp_path, 'wb') as dst:
+                        writer = compressor.writer(dst, level, threads)
+                        shutil.copyfileobj(src, writer, 1024 * 1024)
+                        writer.close()
+
+            def decompress():
+                with open(tmp_path, 'rb') as src:
+                    shutil.copyfileobj(compressor.reader(src), CountingSink(), 1024 * 1024)
+
+            compress_time = best_time(compress, repeat)
+            decompress_time = best_time(decompress, repeat)
+            compressed = os.path.getsize(tmp_path)
+        finally:
+            os.unlink(tmp_path)
+
+        result = _result(compressor.name, compress_time, size)
+        result['level'] = compressor.default_level if level is None else level
+        result['threads'] = threads
+        result['compressed_bytes'] = compressed
+        result['ratio'] = compressed and float(size) / compressed or None
+        result['decompress_seconds'] = decompress_time
+        result['decompress_mb_per_s'] = _result(compressor.name, decompress_time, size)['mb_per_s']
+        results.append(result)
+    return results
+
+
+def _deserialize(format, path):
+    count = 0
+    with open(path, 'rb') as f:
+        if format in OBJECT_READERS:
+            objects = PythonDeserializer(OBJECT_READERS[format](f))
+        else:
+            objects = serializers.deserialize(format, f)
+        for obj in objects:
+            count = count + 1
+    return count
+
+
+def bench_formats(app_label, formats=None, repeat=1, indent=None, tmp_dir=None):
+    """
+    Dump *app_label* in every public serialization format (or those in
+    *formats*) and time serializing and deserializing, the latter the
+    way reload reads the format, without saving.
+    """
+    results = list()
+    for format in sorted(serializers.get_public_serializer_formats()):
+        if formats and format not in formats:
+            continue
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        os.close(fd)
+        try:
+            def serialize():
+                with open(tmp_path, 'wb') as f:
+                    dump_app(app_label, f, format=format, indent=indent)
+
+            serialize_time = best_time(serialize, repeat)
+            size = os.path.getsize(tmp_path)
+            deserialize_time = best_time(_deserialize, repeat, format, tmp_path)
+            objects = _deserialize(format, tmp_path)
+        finally:
+            os.unlink(tmp_path)
+
+        result = _result(format, serialize_time, size)
+        result['objects'] = objects
+        result['deserialize_seconds'] = deserialize_time
+        result['deserialize_mb_per_s'] = _result(format, deserialize_time, size)['mb_per_s']
+        results.append(result)
+    return results
+
+
+def generate_widgets(model, rows, start=0, using=DEFAULT_DB_ALIAS, batch_size=CHUNK_SIZE):
+    """
+    Insert *rows* synthetic rows into *model*, a model with name, value
+    and modified fields like BackupTestWidget, with batched INSERTs.  Row
+    values are numbered from *start*.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    opts = model._meta
+    columns = [opts.get_field(name).column for name in ('name', 'value', 'modified')]
+    sql = 'INSERT INTO %s (%s) VALUES (%%s, %%s, %%s)' % (qn(opts.db_table),
+        ', '.join([qn(column) for column in columns]))
+    modified = opts.get_field('modified').get_db_prep_save(datetime.datetime(2000, 1, 1),
+        connection=connection)
+    cursor = connection.cursor()
+    for first in range(start, start + rows, batch_size):
+        cursor.executemany(sql, [(u'widget %s' % i, i, modified)
+            for i in range(first, min(first + batch_size, start + rows))])
+    transaction.commit_unless_managed(using=using)
+
+
+def generate_archives(backup_object, number, size=1024 * 1024, using=DEFAULT_DB_ALIAS):
+    """
+    Insert *number* archive rows of *size* bytes for *backup_object*, one
+    an hour going back from now, with empty files.  Every tenth is kept.
+    Fields not set here get their model default, so the rows stay valid
+    as BackupArchive grows fields.
+    """
+    from vz_backup.models import BackupArchive
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    opts = BackupArchive._meta
+    fields = [f for f in opts.local_fields if f is not opts.pk]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(opts.db_table),
+        ', '.join([qn(f.column) for f in fields]),
+        ', '.join(['%s'] * len(fields)))
+    now = datetime.datetime.now()
+    rows = []
+    for i in range(number):
+        created = now - datetime.timedelta(hours=i)
+        path = os.path.join(settings.VZ_BACKUP_DIR, 'benchmark_%d.json' % i)
+        open(path, 'wb').close()
+        values = {
+            'backup_object': backup_object.id,
+            'name': os.path.basename(path),
+            'path': path,
+            'size': size,
+            'file_hash': '%040x' % i,
+            'keep': i % 10 == 0,
+            'edited': created,
+            'created': created,
+        }
+        row = []
+        for f in fields:
+            if f.name in values:
+                value = values[f.name]
+            else:
+                value = f.get_default()
+            row.append(f.get_db_prep_save(value, connection=connection))
+        rows.append(row)
+    cursor = connection.cursor()
+    for start in range(0, number, CHUNK_SIZE):
+        cursor.executemany(sql, rows[start:start + CHUNK_SIZE])
+    transaction.commit_unless_managed(using=using)
+    backup_object.recompute_stats()
+
+
+def bench_backup(backup_object, names=None, repeat=1):
+    """
+    Time backup() of *backup_object* with every registered compressor, or
+    those in *names*.  The archive of a run is deleted before the next,
+    and the fingerprint and content hash of the others are cleared, so
+    every run dumps.  Returns the results and the archives made.
+    """
+    results = list()
+    archives = list()
+    for compressor in COMPRESSORS.values():
+        if names and compressor.name not in names:
+            continue
+        backup_object.compress = compressor.name
+        backup_object.save()
+        archive = None
+        seconds = None
+        for i in range(repeat):
+            if archive is not None:
+                # left in place it would turn the next backup into a skip
+                archive.delete()
+            backup_object.archives.update(fingerprint='', content_hash='')
+            start = time.time()
+            archive = backup_object.backup()
+            elapsed = time.time() - start
+            if seconds is None or elapsed < seconds:
+                seconds = elapsed
+        result = _result('backup.%s' % compressor.name, seconds, archive.size)
+        results.append(result)
+        archives.append(archive)
+    return results, archives
+
+
+def bench_prune(backup_object, archives=2000, repeat=1):
+    """
+    Time prune() of *backup_object* by count, size and time, each pruning
+    half of *archives* generated archives.
+    """
+    policies = (
+        ('count', archives / 2),
+        ('size', archives / 2 * 1024),
+        ('time', archives / 2 / 24.0),
+    )
+    results = list()
+    for prune_by, prune_value in policies:
+        backup_object.prune_by = prune_by
+        backup_object.prune_value = prune_value
+        backup_object.save()
+        best = None
+        for i in range(repeat):
+            backup_object.archives.delete()
+            generate_archives(backup_object, archives)
+            start = time.time()
+            backup_object.prune()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        result = _result('prune.%s' % prune_by, best, 0)
+        result['archives'] = archives
+        result['pruned'] = archives - backup_object.archives.count()
+        results.append(result)
+    backup_object.archives.delete()
+    return results
+
+
+def bench_reload(backup_object, archive, repeat=1):
+    """Time reload() of *archive*."""
+    return _result('reload.%s' % compressor_for_name(archive.name).name,
+        best_time(backup_object.reload, repeat, archive.id), archive.size)
+
+
+def bench_changelist(username, password, repeat=1):
+    """
+    Time the admin BackupObject changelist and count its queries, None
+    when the admin is not in the URLconf.
+    """
+    try:
+        url = reverse('admin:vz_backup_backupobject_changelist')
+    except NoReverseMatch:
+        return None
+    client = Client()
+    client.login(username=username, password=password)
+    old_debug = settings.DEBUG
+    settings.DEBUG = True
+    try:
+        seconds = best_time(client.get, repeat, url)
+        # queries are reset as each request starts, these are the last one's
+        queries = len(connections[DEFAULT_DB_ALIAS].queries)
+    finally:
+        settings.DEBUG = old_debug
+    result = _result('changelist', seconds, 0)
+    result['queries'] = queries
+    return result
+
+
+def run_suite(backup_object, rows, names=None, archives=2000, repeat=1,
+        username=None, password=None):
+    """
+    Run Suite
+
+    Time backup() per compressor, generate_file_hash on the archive,
+    reload(), each prune() policy on *archives* archives of a separate
+    BackupObject and the admin changelist, on the *rows* rows currently in
+    *backup_object*'s app.  Every result is tagged with *rows*.
+    """
+    from vz_backup.models import BackupObject
+    results, made = bench_backup(backup_object, names, repeat)
+    plain = [archive for archive in made if not compressor_for_name(archive.name).extension] or made
+    results.extend([result for result in bench_file_hash(plain[0].path, repeat)
+        if result['name'] != 'hash_4k_loop'])
+    results.append(bench_reload(backup_object, plain[0], repeat))
+    for archive in made:
+        archive.delete()
+
+    pruned, created = BackupObject.objects.get_or_create(app_label='vz_backup_benchmark_prune',
+        defaults={'include': False})
+    results.extend(bench_prune(pruned, archives, repeat))
+    if username is not None:
+        changelist = bench_changelist(username, password, repeat)
+        if changelist is not None:
+            results.append(changelist)
+    pruned.delete()
+
+    for result in results:
+        result['rows'] = rows
+    return results
+
+
+def compare_results(results, baseline, tolerance=0.25):
+    """
+    Compare Results
+
+    Regressions of *results* against the *baseline* results of an earlier
+    run, matched by name and rows: timings more than *tolerance* slower
+    and query counts that grew.  Returns (name, rows, field, value,
+    baseline value) tuples.
+    """
+    previous = dict(((result['name'], result['rows']), result) for result in baseline)
+    regressions = list()
+    for result in results:
+        old = previous.get((result['name'], result['rows']))
+        if old is None:
+            continue
+        if old['seconds'] and result['seconds'] > old['seconds'] * (1 + tolerance):
+            regressions.append((result['name'], result['rows'], 'seconds',
+                result['seconds'], old['seconds']))
+        if 'queries' in old and result.get('queries', 0) > old['queries']:
+            regressions.append((result['name'], result['rows'], 'queries',
+                result['queries'], old['queries']))
+    return regressions
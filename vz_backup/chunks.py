@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Chunk store
+
+Deduplicated archives are split into content-defined chunks which are
+stored once per app under VZ_BACKUP_DIR/chunks/<app_label>/, keyed by
+their sha1.  A BackupArchive then only references its chunks in order.
+
+Chunk files are written before the archive and its Chunk rows are
+saved, a backup that fails in between leaves files no row knows of.
+sweep_chunks removes them once they are older than
+VZ_BACKUP_CHUNK_SWEEP_AGE seconds.  For the same reason a chunk whose
+rows are gone is only unlinked once it is that old, a running backup
+may have just reused its file, see unlink_chunk.
+
+Chunk boundaries are picked on line ends: once a chunk has reached
+CHUNK_MIN_SIZE it ends after the first line whose crc32 matches
+CHUNK_MASK.  Inserting or changing a row therefore only changes the
+chunks around it and every other chunk is shared with earlier archives.
+"""
+
+from django.conf import settings
+
+import hashlib
+import os
+import time
+import zlib
+
+from vz_backup.exceptions import ArchiveHashesDoNotMatch
+
+CHUNK_MIN_SIZE = 128 * 1024
+CHUNK_MAX_SIZE = 4 * 1024 * 1024
+CHUNK_MASK = (1 << 12) - 1
+CHUNK_COMPRESS_LEVEL = 6
+CHUNK_SWEEP_AGE = getattr(settings, 'VZ_BACKUP_CHUNK_SWEEP_AGE', 24 * 60 * 60)
+
+
+def chunk_dir(app_label):
+    return os.path.join(settings.VZ_BACKUP_DIR, 'chunks', app_label)
+
+
+def chunk_path(app_label, digest):
+    return os.path.join(chunk_dir(app_label), digest[:2], digest)
+
+
+def store_chunk(app_label, data):
+    """
+    Store *data* as a chunk of *app_label* unless it is already stored.
+    Returns the chunk digest and the number of bytes written to disk.
+    """
+    digest = hashlib.sha1(data).hexdigest()
+    path = chunk_path(app_label, digest)
+    if os.path.exists(path):
+        # a fresh time keeps sweep_chunks off a file this backup reuses
+        # before its rows are saved
+        os.utime(path, None)
+        return digest, 0
+
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    data = zlib.compress(data, CHUNK_COMPRESS_LEVEL)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+    return digest, len(data)
+
+
+def load_chunk(app_label, digest):
+    """Read chunk *digest* back, checking it against its digest."""
+    with open(chunk_path(app_label, digest), 'rb') as f:
+        data = zlib.decompress(f.read())
+    if hashlib.sha1(data).hexdigest() != digest:
+        raise ArchiveHashesDoNotMatch
+    return data
+
+
+def _unlink_old(path, cutoff):
+    try:
+        if os.path.getmtime(path) < cutoff:
+            os.unlink(path)
+            return True
+    except OSError:
+        pass
+    return False
+
+
+def unlink_chunk(app_label, digest, min_age=CHUNK_SWEEP_AGE):
+    """
+    Delete the file of chunk *digest* of *app_label* unless it changed
+    in the last *min_age* seconds, store_chunk touches the files it
+    reuses.  Returns whether the file was deleted.
+    """
+    return _unlink_old(chunk_path(app_label, digest), time.time() - min_age)
+
+
+def sweep_chunks(app_label, digests, min_age=CHUNK_SWEEP_AGE):
+    """
+    Sweep Chunks
+
+    Delete the files in the chunk store of *app_label* whose digest is
+    not in *digests*, the digests of its Chunk rows.  Files changed in
+    the last *min_age* seconds may belong to a running backup and are
+    kept.  Returns the number of files deleted.
+    """
+    cutoff = time.time() - min_age
+    removed = 0
+    for root, dirs, files in os.walk(chunk_dir(app_label)):
+        for name in files:
+            if name in digests:
+                continue
+            if _unlink_old(os.path.join(root, name), cutoff):
+                removed = removed + 1
+    return removed
+
+
+class ChunkWriter(object):
+    """
+    Chunk Writer
+
+    File-like object that cuts everything written to it into chunks and
+    stores them.  After close(), *chunks* lists (digest, size) in order
+    and *stored_size* is the number of new bytes written to disk.
+    """
+
+    def __init__(self, app_label):
+        self.app_label = app_label
+        self.chunks = []
+        self.stored_size = 0
+        self._pieces = []
+        self._size = 0
+
+    def write(self, data):
+        start = 0
+        search = 0
+        while True:
+            end = data.find('\n', search) + 1
+            if end == 0:
+                break
+            size = self._size + end - start
+            if size >= CHUNK_MAX_SIZE or (size >= CHUNK_MIN_SIZE and
+                    zlib.crc32(data[search:end]) & CHUNK_MASK == 0):
+                self._pieces.append(data[start:end])
+                self._size = size
+                self._store()
+                start = end
+            search = end
+
+        if start < len(data):
+            self._pieces.append(data[start:])
+            self._size = self._size + len(data) - start
+        if self._size >= CHUNK_MAX_SIZE:
+            self._store()
+
+    def _store(self):
+        data = ''.join(self._pieces)
+        self._pieces = []
+        self._size = 0
+        digest, stored = store_chunk(self.app_label, data)
+        self.chunks.append((digest, len(data)))
+        self.stored_size = self.stored_size + stored
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._size:
+            self._store()
+
+
+class ChunkReader(object):
+    """
+    Chunk Reader
+
+    File-like object reading the chunks *digests* of *app_label* back in
+    order, one chunk in memory at a time.
+    """
+
+    def __init__(self, app_label, digests):
+        self.app_label = app_label
+        self._digests = iter(digests)
+        self._buffer = ''
+        self._offset = 0
+
+    def _next_chunk(self):
+        try:
+            digest = self._digests.next()
+        except StopIteration:
+            return False
+        self._buffer = load_chunk(self.app_label, digest)
+        self._offset = 0
+        return True
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        pieces = []
+        while size != 0:
+            if self._offset >= len(self._buffer) and not self._next_chunk():
+                break
+            if size < 0:
+                piece = self._buffer[self._offset:]
+            else:
+                piece = self._buffer[self._offset:self._offset + size]
+                size = size - len(piece)
+            self._offset = self._offset + len(piece)
+            pieces.append(piece)
+        return ''.join(pieces)
+
+    def close(self):
+        self._digests = iter(())
+        self._buffer = ''
+        self._offset = 0
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""
+Compressors
+
+Registry of the compression engines archives can be written with.
+backup() writes through Compressor.writer, download and reload read
+through Compressor.reader.  Engines whose library is not installed
+(xz needs lzma or backports.lzma, zstd needs zstandard, lz4 needs lz4)
+are not registered; asking for one of them, or reading an archive with
+its extension, raises ImproperlyConfigured naming the library.
+
+With more than one thread gz and bz2 compress blocks of the stream on a
+thread pool, like pigz and pbzip2, into standard multi-member files.
+"""
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.datastructures import SortedDict
+from multiprocessing.pool import ThreadPool
+
+import bz2
+import collections
+import gzip
+import struct
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+READ_SIZE = 64 * 1024
+
+
+class CompressingWriter(object):
+    """
+    Compressing Writer
+
+    Feeds everything written through a compression object into *fileobj*.
+    Closing it flushes the compressor but does not close *fileobj*.
+    """
+
+    def __init__(self, fileobj, compressobj):
+        self.fileobj = fileobj
+        self.compressobj = compressobj
+
+    def write(self, data):
+        data = self.compressobj.compress(data)
+        if data:
+            self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        if self.compressobj is not None:
+            self.fileobj.write(self.compressobj.flush())
+            self.compressobj = None
+
+
+class ParallelCompressingWriter(object):
+    """
+    Parallel Compressing Writer
+
+    Cuts everything written into *block_size* blocks and compresses them
+    with *compress_block* on *threads* threads.  Each block must come
+    out as a complete compressed stream, they are written to *fileobj* in
+    order, so the result is a multi-member file.  At most two blocks per
+    thread are held in memory.  Closing it writes the last block but
+    does not close *fileobj*.
+    """
+
+    def __init__(self, fileobj, compress_block, threads, block_size):
+        self.fileobj = fileobj
+        self.compress_block = compress_block
+        self.threads = threads
+        self.block_size = block_size
+        self.pool = ThreadPool(threads)
+        self.pending = collections.deque()
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered = self.buffered + len(data)
+        if self.buffered >= self.block_size:
+            data = ''.join(self.buffer)
+            end = len(data) - len(data) % self.block_size
+            for start in range(0, end, self.block_size):
+                self._submit(data[start:start + self.block_size])
+            self.buffer = [data[end:]]
+            self.buffered = len(data) - end
+
+    def _submit(self, block):
+        self.pending.append(self.pool.apply_async(self.compress_block, (block, )))
+        while len(self.pending) > 2 * self.threads:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        if self.pool is None:
+            return
+        try:
+            if self.buffered:
+                self._submit(''.join(self.buffer))
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().get())
+        finally:
+            self.pool.terminate()
+            self.pool = None
+            self.buffer = []
+            self.buffered = 0
+
+
+class DecompressingReader(object):
+    """
+    Decompressing Reader
+
+    Reads *fileobj* back through decompression objects made by
+    *decompressobj*.  Concatenated streams (multi-member gzip, bz2 or xz
+    files) are read one after the other.
+    """
+
+    def __init__(self, fileobj, decompressobj):
+        self.fileobj = fileobj
+        self._factory = decompressobj
+        self._decompressor = decompressobj()
+        self._buffer = ''
+        self._offset = 0
+        self._eof = False
+
+    def _decompress(self, data):
+        pieces = []
+        while data:
+            if getattr(self._decompressor, 'eof', False):
+                self._decompressor = self._factory()
+            try:
+                pieces.append(self._decompressor.decompress(data))
+            except EOFError:
+                self._decompressor = self._factory()
+                continue
+            data = getattr(self._decompressor, 'unused_data', '')
+            if data:
+                self._decompressor = self._factory()
+        return ''.join(pieces)
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        while not self._eof and (size < 0 or len(self._buffer) - self._offset < size):
+            data = self.fileobj.read(READ_SIZE)
+            if not data:
+                self._eof = True
+                break
+            self._buffer = self._buffer[self._offset:] + self._decompress(data)
+            self._offset = 0
+        if size < 0:
+            size = len(self._buffer) - self._offset
+        data = self._buffer[self._offset:self._offset + size]
+        self._offset = self._offset + len(data)
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+
+class _Uncompressed(object):
+    """Writer for the none compressor, closing it leaves *fileobj* open."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write(self, data):
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        pass
+
+
+class Compressor(object):
+    """
+    Compressor
+
+    Base class of the registered compression engines.  *extension* is
+    appended to archive names, *default_level* is used when a
+    BackupObject has no compress_level.  Engines with a compress_block
+    method compress on several threads when asked to, with a
+    ParallelCompressingWriter.
+    """
+
+    name = None
+    extension = None
+    default_level = None
+    compress_block = None
+
+    def compressobj(self, level, threads):
+        raise NotImplementedError
+
+    def decompressobj(self):
+        raise NotImplementedError
+
+    def block_size(self, level):
+        return 1024 * 1024
+
+    def parallel_writer(self, fileobj, level, threads):
+        return ParallelCompressingWriter(fileobj, lambda block: self.compress_block(block, level),
+            threads, self.block_size(level))
+
+    def writer(self, fileobj, level=None, threads=1):
+        if level is None:
+            level = self.default_level
+        if threads > 1 and self.compress_block is not None:
+            return self.parallel_writer(fileobj, level, threads)
+        return CompressingWriter(fileobj, self.compressobj(level, threads))
+
+    def reader(self, fileobj):
+        return DecompressingReader(fileobj, self.decompressobj)
+
+
+class NoCompressor(Compressor):
+    name = 'none'
+
+    def writer(self, fileobj, level=None, threads=1):
+        return _Uncompressed(fileobj)
+
+    def reader(self, fileobj):
+        return fileobj
+
+
+class GzipCompressor(Compressor):
+    name = 'gz'
+    extension = 'gz'
+    default_level = 9
+
+    def writer(self, fileobj, level=None, threads=1):
+        if level is None:
+            level = self.default_level
+        if threads > 1:
+            return self.parallel_writer(fileobj, level, threads)
+        # no file name or time in the header, so equal data compresses
+        # to equal files
+        return gzip.GzipFile(filename='', mode='wb', fileobj=fileobj, compresslevel=level, mtime=0)
+
+    def compress_block(self, data, level):
+        """*data* as one gzip member, without file name or time."""
+        compressobj = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return ''.join([
+            '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff',
+            compressobj.compress(data),
+            compressobj.flush(),
+            struct.pack('<II', zlib.crc32(data) & 0xffffffffL, len(data) & 0xffffffffL),
+        ])
+
+    def decompressobj(self):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+class BZ2Compressor(Compressor):
+    name = 'bz2'
+    extension = 'bz2'
+    default_level = 9
+
+    def compressobj(self, level, threads):
+        return bz2.BZ2Compressor(level)
+
+    def compress_block(self, data, level):
+        return bz2.compress(data, level)
+
+    def block_size(self, level):
+        # about one bzip2 block, so the ratio is close to one thread's
+        return level * 100000
+
+    def decompressobj(self):
+        return bz2.BZ2Decompressor()
+
+
+class XZCompressor(Compressor):
+    name = 'xz'
+    extension = 'xz'
+    default_level = 6
+
+    def compressobj(self, level, threads):
+        return lzma.LZMACompressor(preset=level)
+
+    def decompressobj(self):
+        return lzma.LZMADecompressor()
+
+
+class ZstdCompressor(Compressor):
+    name = 'zstd'
+    extension = 'zst'
+    default_level = 3
+
+    def compressobj(self, level, threads):
+        if threads > 1:
+            return zstandard.ZstdCompressor(level=level, threads=threads).compressobj()
+        return zstandard.ZstdCompressor(level=level).compressobj()
+
+    def decompressobj(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+class _LZ4Compressobj(object):
+    """lz4.frame.LZ4FrameCompressor with the compressobj interface."""
+
+    def __init__(self, level):
+        self.compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self.header = self.compressor.begin()
+
+    def compress(self, data):
+        data = self.header + self.compressor.compress(data)
+        self.header = ''
+        return data
+
+    def flush(self):
+        return self.header + self.compressor.flush()
+
+
+class LZ4Compressor(Compressor):
+    name = 'lz4'
+    extension = 'lz4'
+    default_level = 0
+
+    def compressobj(self, level, threads):
+        return _LZ4Compressobj(level)
+
+    def decompressobj(self):
+        return lz4.frame.LZ4FrameDecompressor()
+
+
+COMPRESSORS = SortedDict()
+
+# name -> (extension, library) of engines whose library is missing
+UNAVAILABLE = SortedDict()
+
+
+def register(compressor):
+    COMPRESSORS[compressor.name] = compressor
+
+
+def _unavailable(name, library):
+    return ImproperlyConfigured("Compression '%s' needs %s, which is not installed" % (name, library))
+
+
+def get_compressor(name):
+    """Registered compressor *name*, raises ImproperlyConfigured if there is none."""
+    try:
+        return COMPRESSORS[name]
+    except KeyError:
+        if name in UNAVAILABLE:
+            raise _unavailable(name, UNAVAILABLE[name][1])
+        raise ImproperlyConfigured("Unknown compression '%s'" % name)
+
+
+def compressor_for_name(filename):
+    """
+    Compressor an archive named *filename* was written with.  Raises
+    ImproperlyConfigured for the extension of an engine whose library is
+    missing instead of reading the archive as uncompressed.
+    """
+    for compressor in COMPRESSORS.values():
+        if compressor.extension and filename.endswith('.' + compressor.extension):
+            return compressor
+    for name, (extension, library) in UNAVAILABLE.items():
+        if filename.endswith('.' + extension):
+            raise _unavailable(name, library)
+    return COMPRESSORS['none']
+
+
+register(BZ2Compressor())
+register(GzipCompressor())
+register(NoCompressor())
+if lzma is not None:
+    register(XZCompressor())
+else:
+    UNAVAILABLE['xz'] = ('xz', 'lzma or backports.lzma')
+if zstandard is not None:
+    register(ZstdCompressor())
+else:
+    UNAVAILABLE['zstd'] = ('zst', 'zstandard')
+if lz4 is not None:
+    register(LZ4Compressor())
+else:
+    UNAVAILABLE['lz4'] = ('lz4', 'lz4')
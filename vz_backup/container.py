@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Container archives
+
+A container archive is a zip file with one member per model, or per
+primary key range of a big model, each compressed on its own with the
+BackupObject's compression and stored as is.  index.json, written last,
+lists every member with its model, key range, row count and sizes, so a
+single model or a few rows can be restored or extracted by reading only
+the members that hold them.
+
+Members hold the objects of their segment without the brackets of a JSON
+array, see JSONSegmentSerializer; joined with commas inside brackets any
+run of them is a regular fixture.
+
+Containers are written front to back, without seeking, so they can be
+hashed on their way to disk like other archives.
+"""
+
+from django.db import models, DEFAULT_DB_ALIAS
+from django.utils import simplejson
+
+from vz_backup.compressors import compressor_for_name
+from vz_backup.dump import CHUNK_SIZE, SEGMENT_ROWS, dump_segments, plan_segments
+
+import hashlib
+import os
+import shutil
+import tempfile
+import zipfile
+import zlib
+
+EXTENSION = 'zip'
+INDEX_NAME = 'index.json'
+
+# members get a fixed date so identical dumps give identical archives
+DATE_TIME = (2000, 1, 1, 0, 0, 0)
+
+
+class _Tellable(object):
+    """
+    Counts the bytes written to *stream* for zipfile, which needs to know
+    where it is in the file but never seeks back in it here.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.position = 0
+
+    def write(self, data):
+        self.stream.write(data)
+        self.position = self.position + len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        self.stream.flush()
+
+
+class _CRCWriter(object):
+    """Computes the zip CRC-32 of the member file written through it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.crc = 0
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+
+def _add_member(container, name, path, crc):
+    """
+    Copy the file at *path* into *container* as member *name*, stored.
+    Its CRC-32 *crc* was computed while the file was written, so the
+    header is complete before the data and zipfile doesn't seek back to
+    fill it in.
+    """
+    info = zipfile.ZipInfo(name, DATE_TIME)
+    info.compress_type = zipfile.ZIP_STORED
+    info.external_attr = 0644 << 16
+    info.file_size = info.compress_size = os.path.getsize(path)
+    info.CRC = crc
+    info.header_offset = container.fp.tell()
+    container.fp.write(info.FileHeader(info.file_size > zipfile.ZIP64_LIMIT))
+    with open(path, 'rb') as member_file:
+        shutil.copyfileobj(member_file, container.fp, 1024 * 1024)
+    container.filelist.append(info)
+    container.NameToInfo[name] = info
+
+
+def write_container(app_label, stream, compressor, level=None, threads=1, workers=1,
+        indent=None, use_natural_keys=False, chunk_size=CHUNK_SIZE,
+        segment_rows=SEGMENT_ROWS, using=DEFAULT_DB_ALIAS, progress=None, tmp_dir=None,
+        throttle=None):
+    """
+    Write Container
+
+    Dump *app_label* into a container archive written to *stream*, the
+    segments dumped by *workers* processes into temporary files in
+    *tmp_dir* and each member compressed with *compressor*.  *stream* is
+    written front to back and not closed.  Rows read in this process are
+    reported to *throttle*, see dump_segments.  Returns the index, whose
+    content_hash is the sha1 of the data of every member, in order,
+    before compression.
+    """
+    segments = plan_segments(app_label, segment_rows, using)
+    tmp_dir = tempfile.mkdtemp(prefix='segments_', dir=tmp_dir)
+    index = {'app_label': app_label, 'members': []}
+    content_hash = hashlib.sha1()
+    try:
+        dumped = dump_segments(segments, tmp_dir, workers, indent, use_natural_keys,
+            chunk_size, using, throttle)
+        container = zipfile.ZipFile(_Tellable(stream), 'w', zipfile.ZIP_STORED, allowZip64=True)
+        try:
+            label = None
+            for number, ((segment_label, first, last), segment_path, count) in enumerate(dumped):
+                if progress is not None and segment_label != label:
+                    label = segment_label
+                    progress(models.get_model(*label.split('.')))
+                if not count:
+                    continue
+                member = u'%s.%04d.json' % (segment_label, number)
+                if compressor.extension:
+                    member = u'%s.%s' % (member, compressor.extension)
+                member_path = segment_path + '.member'
+                with open(member_path, 'wb') as member_file:
+                    c_file = _CRCWriter(member_file)
+                    b_file = compressor.writer(c_file, level, threads)
+                    with open(segment_path, 'rb') as segment_file:
+                        data = segment_file.read(1024 * 1024)
+                        while data:
+                            content_hash.update(data)
+                            b_file.write(data)
+                            data = segment_file.read(1024 * 1024)
+                    b_file.close()
+                _add_member(container, member, member_path, c_file.crc)
+                index['members'].append({
+                    'member': member,
+                    'model': segment_label,
+                    'after_pk': first,
+                    'last_pk': last,
+                    'count': count,
+                    'size': os.path.getsize(segment_path),
+                    'stored_size': os.path.getsize(member_path),
+                })
+                os.unlink(member_path)
+            index['content_hash'] = content_hash.hexdigest()
+            info = zipfile.ZipInfo(INDEX_NAME, DATE_TIME)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0644 << 16
+            container.writestr(info, simplejson.dumps(index, indent=2))
+        finally:
+            container.close()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return index
+
+
+def read_index(container):
+    """Index of the open zipfile.ZipFile *container*."""
+    return simplejson.loads(container.read(INDEX_NAME))
+
+
+def _in_range(model, entry, pks):
+    to_python = model._meta.pk.to_python
+    for pk in pks:
+        if entry['after_pk'] is not None and pk <= to_python(entry['after_pk']):
+            continue
+        if entry['last_pk'] is not None and pk > to_python(entry['last_pk']):
+            continue
+        return True
+    return False
+
+
+def select_members(container, labels=None, pks=None):
+    """
+    Index entries of the members of *container* holding the models of
+    *labels* (all models when None), limited to those whose key range
+    holds one of *pks*, if given.
+    """
+    entries = []
+    for entry in read_index(container)['members']:
+        if labels is not None and entry['model'] not in labels:
+            continue
+        if pks is not None and not _in_range(models.get_model(*entry['model'].split('.')), entry, pks):
+            continue
+        entries.append(entry)
+    return entries
+
+
+def open_member(container, entry):
+    """File-like object reading the decompressed objects of member *entry*."""
+    return compressor_for_name(entry['member']).reader(container.open(entry['member']))
+
+
+def iter_model_fixture(path, label, block_size=64 * 1024):
+    """
+    Iterate over the rows of model *label* in the container archive at
+    *path* as a JSON fixture, *block_size* bytes at a time.  Only the
+    members holding the model are read.
+    """
+    container = zipfile.ZipFile(path)
+    try:
+        yield '['
+        written = False
+        for entry in select_members(container, [label]):
+            if written:
+                yield ','
+            member = open_member(container, entry)
+            try:
+                data = member.read(block_size)
+                while data:
+                    yield data
+                    data = member.read(block_size)
+            finally:
+                member.close()
+            written = True
+        if written:
+            yield '\n'
+        yield ']'
+    finally:
+        container.close()
@@ -0,0 +1,461 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming dumps
+
+Serializes an app's model data straight into a stream, one object at a
+time, instead of building the whole dump in memory like dumpdata does.
+"""
+
+from django.conf import settings
+from django.core import serializers
+from django.core.management.commands.dumpdata import sort_dependencies
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.serializers.python import Serializer as PythonSerializer
+from django.db import connections, models, router, transaction, DEFAULT_DB_ALIAS
+from django.utils import simplejson
+from django.utils.datastructures import SortedDict
+from django.utils.encoding import smart_unicode
+
+from vz_backup.throttle import lower_priority
+
+from contextlib import contextmanager
+
+import itertools
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+CHUNK_SIZE = getattr(settings, 'VZ_BACKUP_CHUNK_SIZE', 1000)
+SEGMENT_ROWS = getattr(settings, 'VZ_BACKUP_SEGMENT_ROWS', 100000)
+FETCH_SIZE = getattr(settings, 'VZ_BACKUP_FETCH_SIZE', 2000)
+
+
+class JSONStreamSerializer(PythonSerializer):
+    """
+    JSON Stream Serializer
+
+    Writes each object to the stream as soon as it is serialized.  Output
+    is a regular JSON fixture that loaddata can read.
+    """
+
+    internal_use_only = True
+
+    def start_serialization(self):
+        self._current = None
+        self._count = 0
+        self.stream.write('[')
+
+    def end_serialization(self):
+        if self._count:
+            self.stream.write('\n')
+        self.stream.write(']')
+
+    def end_object(self, obj):
+        data = {
+            'model': smart_unicode(obj._meta),
+            'pk': smart_unicode(obj._get_pk_val(), strings_only=True),
+            'fields': self._current,
+        }
+        if self._count:
+            self.stream.write(',\n')
+        else:
+            self.stream.write('\n')
+        self.stream.write(simplejson.dumps(data, cls=DjangoJSONEncoder,
+            indent=self.options.get('indent')))
+        self._count = self._count + 1
+        self._current = None
+
+    def getvalue(self):
+        if callable(getattr(self.stream, 'getvalue', None)):
+            return self.stream.getvalue()
+
+
+class JSONSegmentSerializer(JSONStreamSerializer):
+    """
+    JSON Segment Serializer
+
+    Writes the objects as JSONStreamSerializer does, without the brackets
+    around them, so segments joined with commas inside one pair of
+    brackets give the same bytes as one serialization of all objects.
+    """
+
+    def start_serialization(self):
+        self._current = None
+        self._count = 0
+
+    def end_serialization(self):
+        pass
+
+
+def app_models(app_label, using=DEFAULT_DB_ALIAS):
+    """
+    Models of *app_label* in the order dumpdata would serialize them.
+    """
+    app = models.get_app(app_label)
+    return [model for model in sort_dependencies([(app, None)])
+        if not model._meta.proxy and router.allow_syncdb(using, model)]
+
+
+def iter_model(model, chunk_size=CHUNK_SIZE, using=DEFAULT_DB_ALIAS, queryset=None):
+    """
+    Iterate over all rows of *model*, or of *queryset* if given, fetching
+    *chunk_size* rows per query.
+
+    Rows are walked in primary key order so only one chunk is ever held in
+    memory.
+    """
+    if queryset is None:
+        queryset = model._default_manager.using(using)
+    qs = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        if last_pk is None:
+            chunk = list(qs[:chunk_size])
+        else:
+            chunk = list(qs.filter(pk__gt=last_pk)[:chunk_size])
+        for obj in chunk:
+            yield obj
+        if len(chunk) < chunk_size:
+            break
+        last_pk = chunk[-1].pk
+
+
+@contextmanager
+def consistent_snapshot(using=DEFAULT_DB_ALIAS):
+    """
+    Consistent Snapshot
+
+    Run the block in one transaction that sees the database as it was
+    when the transaction started: REPEATABLE READ on PostgreSQL, a
+    consistent snapshot on MySQL, a read transaction on SQLite.  The
+    transaction is committed at the end, writes made inside it, like job
+    progress, only show then, and rolled back if the block raises.
+
+    The transaction psycopg2 and MySQLdb opened for earlier reads is
+    rolled back first, as the isolation level can only be set before a
+    transaction's first query.  If the connection has uncommitted writes
+    the block runs in that transaction instead, left to whoever opened
+    it to commit or roll back.
+    """
+    if transaction.is_dirty(using=using):
+        yield
+        return
+    connection = connections[using]
+    engine = connection.settings_dict['ENGINE']
+    transaction.enter_transaction_management(using=using)
+    transaction.managed(True, using=using)
+    try:
+        transaction.rollback(using=using)
+        cursor = connection.cursor()
+        if 'postgresql' in engine:
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        elif 'mysql' in engine:
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            cursor.execute('START TRANSACTION WITH CONSISTENT SNAPSHOT')
+        elif 'sqlite' in engine:
+            # pysqlite only opens transactions for writes
+            cursor.execute('BEGIN')
+        yield
+    except:
+        exc_info = sys.exc_info()
+        try:
+            transaction.rollback(using=using)
+        finally:
+            transaction.leave_transaction_management(using=using)
+        raise exc_info[0], exc_info[1], exc_info[2]
+    try:
+        transaction.commit(using=using)
+    finally:
+        transaction.leave_transaction_management(using=using)
+
+
+_cursors = itertools.count()
+
+
+def server_side_cursor(connection):
+    """
+    A cursor that fetches rows from the server as they are read instead
+    of all at once, None when the backend has none that allows other
+    queries, e.g. for natural keys, while it is read: MySQL's SSCursor
+    does not.  PostgreSQL needs a transaction for it, see consistent_snapshot.
+    """
+    engine = connection.settings_dict['ENGINE']
+    if 'postgresql_psycopg2' in engine:
+        connection.cursor()
+        return connection.connection.cursor(name='vz_backup_dump_%d' % _cursors.next())
+    if 'sqlite' in engine:
+        # SQLite steps through the rows as they are fetched
+        return connection.cursor()
+    return None
+
+
+def iter_model_cursor(model, fetch_size=FETCH_SIZE, using=DEFAULT_DB_ALIAS, queryset=None):
+    """
+    Iterate over all rows of *model*, or of *queryset* if given, with one
+    query read through a server-side cursor *fetch_size* rows at a time.
+    Falls back to iter_model on backends without server-side cursors.
+    """
+    if queryset is None:
+        queryset = model._default_manager.using(using)
+    qs = queryset.order_by('pk')
+    connection = connections[using]
+    cursor = server_side_cursor(connection)
+    if cursor is None:
+        for obj in iter_model(model, fetch_size, using, queryset):
+            yield obj
+        return
+    compiler = qs.query.get_compiler(using=using)
+    resolve_columns = getattr(compiler, 'resolve_columns', None)
+    fields = model._meta.fields
+    sql, params = compiler.as_sql()
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            for row in rows:
+                if resolve_columns is not None:
+                    row = resolve_columns(row, fields)
+                obj = model(*row)
+                obj._state.db = using
+                yield obj
+    finally:
+        cursor.close()
+
+
+def _report(model, objects, progress):
+    progress(model)
+    for obj in objects:
+        yield obj
+
+
+def _count(model, objects, rows, timer=None, throttle=None):
+    """
+    Count the objects of *model* into *rows*, timing fetches as 'fetch'
+    and reporting them to *throttle* batch_rows at a time.
+    """
+    label = u'%s.%s' % (model._meta.app_label, model._meta.object_name)
+    rows[label] = 0
+    objects = iter(objects)
+    batch = 0
+    latency = 0.0
+    while True:
+        if timer is not None:
+            start = timer.start()
+        fetch_start = time.time()
+        try:
+            obj = objects.next()
+        except StopIteration:
+            obj = None
+        if timer is not None:
+            timer.stop('fetch', start)
+        if obj is None:
+            break
+        rows[label] = rows[label] + 1
+        if throttle is not None:
+            batch = batch + 1
+            latency = latency + time.time() - fetch_start
+            if batch >= throttle.batch_rows:
+                throttle.fetched(batch, latency)
+                batch = 0
+                latency = 0.0
+        yield obj
+    if batch:
+        throttle.fetched(batch, latency)
+
+
+def dump_app(app_label, stream, format='json', indent=None,
+        use_natural_keys=False, chunk_size=CHUNK_SIZE, using=DEFAULT_DB_ALIAS,
+        index=None, progress=None, timer=None, fetch_size=None, throttle=None):
+    """
+    Dump App
+
+    Serialize every model of *app_label* into *stream*.  JSON is written
+    object by object, other formats use their own serializer with
+    *stream* as output.  With a RowIndex as *index* only the rows it lets
+    through are serialized.  *progress*, if given, is called with each
+    model as its rows start being serialized.  Time spent fetching rows
+    is added to the 'fetch' phase of the PhaseTimer *timer*, if given.
+    With *fetch_size* each model is read with one query through a
+    server-side cursor, see iter_model_cursor.  Row fetches are reported
+    to the vz_backup.throttle.Throttle *throttle*, if given.  Returns the
+    number of rows dumped per model label.
+    """
+    if index is None and fetch_size is not None:
+        iterators = [(model, iter_model_cursor(model, fetch_size, using))
+            for model in app_models(app_label, using)]
+    elif index is None:
+        iterators = [(model, iter_model(model, chunk_size, using))
+            for model in app_models(app_label, using)]
+    else:
+        iterators = [(model, index.objects(model, chunk_size, using))
+            for model in app_models(app_label, using)]
+    if progress is not None:
+        iterators = [(model, _report(model, objects, progress)) for model, objects in iterators]
+    rows = SortedDict()
+    objects = itertools.chain(*[_count(model, objects, rows, timer, throttle)
+        for model, objects in iterators])
+
+    if format == 'json':
+        serializer = JSONStreamSerializer()
+    else:
+        serializer = serializers.get_serializer(format)()
+    serializer.serialize(objects, stream=stream, indent=indent,
+        use_natural_keys=use_natural_keys)
+    return rows
+
+
+def plan_segments(app_label, segment_rows=SEGMENT_ROWS, using=DEFAULT_DB_ALIAS):
+    """
+    Plan Segments
+
+    Split the dump of *app_label* into segments that can be dumped on
+    their own: one per model, or one per *segment_rows* rows of a bigger
+    model.  Returns (model label, first pk, last pk) tuples in dump order,
+    a None pk leaves that end of the range open.
+    """
+    segments = []
+    for model in app_models(app_label, using):
+        label = u'%s.%s' % (model._meta.app_label, model._meta.object_name)
+        qs = model._default_manager.using(using).order_by('pk')
+        count = qs.count()
+        last = None
+        for start in range(segment_rows, count, segment_rows):
+            pk = qs.values_list('pk', flat=True)[start - 1]
+            segments.append((label, last, pk))
+            last = pk
+        segments.append((label, last, None))
+    return segments
+
+
+def dump_segment(segment, path, indent=None, use_natural_keys=False,
+        chunk_size=CHUNK_SIZE, using=DEFAULT_DB_ALIAS, throttle=None):
+    """
+    Dump Segment
+
+    Serialize the rows of *segment*, see plan_segments, into the file
+    *path* with JSONSegmentSerializer, reporting row fetches to
+    *throttle*, if given.  Returns the number of objects.
+    """
+    label, first, last = segment
+    model = models.get_model(*label.split('.'))
+    qs = model._default_manager.using(using)
+    if first is not None:
+        qs = qs.filter(pk__gt=first)
+    if last is not None:
+        qs = qs.filter(pk__lte=last)
+    serializer = JSONSegmentSerializer()
+    with open(path, 'wb') as stream:
+        serializer.serialize(_count(model, iter_model(model, chunk_size, using, queryset=qs), {},
+            throttle=throttle), stream=stream, indent=indent, use_natural_keys=use_natural_keys)
+    return serializer._count
+
+
+def init_worker():
+    """
+    Worker processes must not share the parent's DB connections, and run
+    at the priority of vz_backup.throttle.lower_priority.
+    """
+    for connection in connections.all():
+        connection.connection = None
+    lower_priority()
+
+
+def _dump_segment(args):
+    return dump_segment(*args)
+
+
+def in_memory(using=DEFAULT_DB_ALIAS):
+    """Is *using* an in-memory SQLite database, which other processes can't open?"""
+    settings_dict = connections[using].settings_dict
+    return 'sqlite' in settings_dict['ENGINE'] and settings_dict['NAME'] in ('', ':memory:')
+
+
+def dump_segments(segments, tmp_dir, workers=1, indent=None, use_natural_keys=False,
+        chunk_size=CHUNK_SIZE, using=DEFAULT_DB_ALIAS, throttle=None):
+    """
+    Dump Segments
+
+    Serialize *segments* into files in *tmp_dir*, *workers* at a time in
+    a process pool, or in this process for an in-memory database.  Rows
+    read in this process are reported to *throttle*, if given, those read
+    by worker processes aren't.  Returns (segment, path, object count)
+    tuples in the order of *segments*.
+    """
+    tasks = [(segment, os.path.join(tmp_dir, '%06d.json' % i), indent,
+        use_natural_keys, chunk_size, using) for i, segment in enumerate(segments)]
+    # pool workers, e.g. of backup_all, can't start processes of their own
+    if workers > 1 and len(tasks) > 1 and not multiprocessing.current_process().daemon and \
+            not in_memory(using):
+        for connection in connections.all():
+            connection.close()
+        pool = multiprocessing.Pool(min(workers, len(tasks)), init_worker)
+        try:
+            counts = pool.map(_dump_segment, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        counts = [dump_segment(*task, **{'throttle': throttle}) for task in tasks]
+    return [(task[0], task[1], count) for task, count in zip(tasks, counts)]
+
+
+def join_segments(stream, segment_files):
+    """
+    Write the non empty segments read from *segment_files* into *stream*
+    as one JSON array.
+    """
+    stream.write('[')
+    written = False
+    for segment_file in segment_files:
+        if written:
+            stream.write(',')
+        try:
+            shutil.copyfileobj(segment_file, stream, 1024 * 1024)
+        finally:
+            segment_file.close()
+        written = True
+    if written:
+        stream.write('\n')
+    stream.write(']')
+
+
+def dump_app_parallel(app_label, stream, workers, indent=None, use_natural_keys=False,
+        chunk_size=CHUNK_SIZE, using=DEFAULT_DB_ALIAS, segment_rows=SEGMENT_ROWS,
+        progress=None, tmp_dir=None, throttle=None):
+    """
+    Dump App Parallel
+
+    Like dump_app with the JSON format, but the segments planned by
+    plan_segments are serialized by *workers* processes into temporary
+    files in *tmp_dir*, then copied into *stream* in dump order.  The
+    output and return value are the same as dump_app's.  *throttle* is
+    passed on to dump_segments.
+    """
+    segments = plan_segments(app_label, segment_rows, using)
+    tmp_dir = tempfile.mkdtemp(prefix='segments_', dir=tmp_dir)
+    try:
+        dumped = dump_segments(segments, tmp_dir, workers, indent, use_natural_keys,
+            chunk_size, using, throttle)
+
+        rows = SortedDict()
+        for (segment_label, first, last), path, count in dumped:
+            rows[segment_label] = rows.get(segment_label, 0) + count
+
+        def segment_files():
+            label = None
+            for (segment_label, first, last), path, count in dumped:
+                if progress is not None and segment_label != label:
+                    label = segment_label
+                    progress(models.get_model(*label.split('.')))
+                if count:
+                    yield open(path, 'rb')
+
+        join_segments(stream, segment_files())
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return rows
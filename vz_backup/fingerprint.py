@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Fingerprints
+
+A fingerprint is a cheap summary of an app's tables, compared with the
+one stored on the last archive to find out whether anything changed
+without dumping the app.  Every table is summed up by its row count and a
+checksum of its rows computed by the database: an order independent sum
+of row digests on PostgreSQL and SQLite, CHECKSUM TABLE on MySQL.
+
+Models listed in VZ_BACKUP_TIMESTAMP_FIELDS are summed up by row count,
+largest primary key and latest timestamp instead, which needs no reading
+of the rows when the fields are indexed; rows changed without touching
+the timestamp, by QuerySet.update() or raw SQL, go unnoticed.  Other
+databases give no fingerprint and the app is always dumped.
+
+With natural keys a dump also depends on the rows its foreign keys point
+to in other apps, whose natural keys it writes, so their tables are
+fingerprinted too, see natural_key_models.
+
+A checksum reads every row of its table, so checksums are reported to
+the backup's Throttle like the rows of a dump.
+"""
+
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import Count, Max
+from django.utils.datastructures import SortedDict
+from django.utils.encoding import smart_unicode
+
+from vz_backup.dump import app_models
+from vz_backup.incremental import TIMESTAMP_FIELDS
+
+import hashlib
+import time
+
+CHECKSUM_BITS = 60
+
+
+class RowChecksum(object):
+    """
+    Row Checksum
+
+    SQLite aggregate summing the first CHECKSUM_BITS bits of the md5 of
+    every row, so the result doesn't depend on the order rows are read.
+    """
+
+    def __init__(self):
+        self.total = 0
+
+    def step(self, *values):
+        values = tuple([isinstance(value, buffer) and str(value) or value for value in values])
+        digest = int(hashlib.md5(repr(values)).hexdigest()[:CHECKSUM_BITS / 4], 16)
+        self.total = (self.total + digest) % (1 << CHECKSUM_BITS)
+
+    def finalize(self):
+        return self.total
+
+
+def table_checksum(table, columns, using=DEFAULT_DB_ALIAS, throttle=None):
+    """
+    Table Checksum
+
+    Row count and checksum of the *columns* of every row of *table*, as
+    a list, or None when the database can't compute a checksum.  The rows
+    read are reported to *throttle*, if given.
+    """
+    start = time.time()
+    checksum = _table_checksum(table, columns, using)
+    if checksum is not None and throttle is not None:
+        throttle.fetched(checksum[0], time.time() - start)
+    return checksum
+
+
+def _table_checksum(table, columns, using):
+    connection = connections[using]
+    engine = connection.settings_dict['ENGINE']
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    if 'postgresql' in engine:
+        cursor.execute("SELECT COUNT(*), SUM(('x' || SUBSTR(MD5(CAST(t AS text)), 1, %d))::bit(%d)::bigint) "
+            "FROM %s t" % (CHECKSUM_BITS / 4, CHECKSUM_BITS, qn(table)))
+    elif 'mysql' in engine:
+        cursor.execute('SELECT COUNT(*) FROM %s' % qn(table))
+        count = cursor.fetchone()[0]
+        cursor.execute('CHECKSUM TABLE %s' % qn(table))
+        return [int(count), smart_unicode(cursor.fetchone()[1])]
+    elif 'sqlite' in engine:
+        connection.connection.create_aggregate('vz_backup_checksum', -1, RowChecksum)
+        cursor.execute('SELECT COUNT(*), vz_backup_checksum(%s) FROM %s' % (
+            ', '.join([qn(column) for column in columns]), qn(table)))
+    else:
+        return None
+    count, checksum = cursor.fetchone()
+    return [int(count), smart_unicode(checksum)]
+
+
+def model_fingerprint(model, using=DEFAULT_DB_ALIAS, throttle=None):
+    """
+    Fingerprint of *model*'s table and of its many to many tables, as a
+    dict, or None when one of them has none.  Checksums are reported to
+    *throttle*, if given.
+    """
+    opts = model._meta
+    field = TIMESTAMP_FIELDS.get(smart_unicode(opts))
+    fingerprint = {}
+    if field is not None:
+        values = model._default_manager.using(using).aggregate(count=Count(opts.pk.name),
+            last_pk=Max(opts.pk.name), last_modified=Max(field))
+        fingerprint['rows'] = [values['count'], smart_unicode(values['last_pk']),
+            smart_unicode(values['last_modified'])]
+    else:
+        fingerprint['rows'] = table_checksum(opts.db_table,
+            [f.column for f in opts.local_fields], using, throttle)
+    for f in opts.local_many_to_many:
+        if f.rel.through._meta.auto_created:
+            fingerprint[f.name] = table_checksum(f.m2m_db_table(),
+                [f.m2m_column_name(), f.m2m_reverse_name()], using, throttle)
+    if None in fingerprint.values():
+        return None
+    return fingerprint
+
+
+def natural_key_models(models):
+    """
+    Models outside *models* that foreign keys and many to many fields of
+    *models* point to and that have a natural key, and those the natural
+    keys of these point to in turn, ordered by label.
+    """
+    seen = set(models)
+    related = []
+    pending = list(models)
+    while pending:
+        opts = pending.pop()._meta
+        for f in opts.local_fields + opts.local_many_to_many:
+            target = f.rel and f.rel.to
+            if not target or target in seen or not hasattr(target, 'natural_key'):
+                continue
+            seen.add(target)
+            related.append(target)
+            pending.append(target)
+    related.sort(key=lambda model: smart_unicode(model._meta))
+    return related
+
+
+def app_fingerprint(app_label, using=DEFAULT_DB_ALIAS, use_natural_keys=False, throttle=None):
+    """
+    App Fingerprint
+
+    Fingerprints of the models of *app_label* by model label, None when
+    one of them has none.  With *use_natural_keys* the models of other
+    apps whose natural keys a dump writes are included.  Checksums are
+    reported to *throttle*, if given.
+    """
+    fingerprint = SortedDict()
+    models = app_models(app_label, using)
+    if use_natural_keys:
+        models = models + natural_key_models(models)
+    for model in models:
+        value = model_fingerprint(model, using, throttle)
+        if value is None:
+            return None
+        fingerprint[smart_unicode(model._meta)] = value
+    return fingerprint
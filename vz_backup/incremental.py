@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental backups
+
+Every archive of an incremental BackupObject is saved with a row index
+next to it (<archive path>.idx, gzipped JSON lines).  The index lists
+each row of the app as [model, pk, row hash] and each row deleted since
+the parent archive as [model, pk, null].  The next backup only serializes
+rows that are new or whose hash changed.
+
+Models listed in VZ_BACKUP_TIMESTAMP_FIELDS are not hashed: only rows
+whose timestamp field is at least the start time of the parent archive's
+dump are fetched, and the index only keeps their primary keys.
+"""
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.serializers.python import Serializer as PythonSerializer
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import simplejson
+from django.utils.encoding import smart_unicode
+
+import datetime
+import gzip
+import hashlib
+import os
+
+from vz_backup.dump import iter_model, CHUNK_SIZE
+
+TIMESTAMP_FIELDS = dict((label.lower(), field) for label, field in
+    getattr(settings, 'VZ_BACKUP_TIMESTAMP_FIELDS', {}).items())
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def index_path(archive_path):
+    return archive_path + '.idx'
+
+
+def row_hash(obj, use_natural_keys=False):
+    """Hash of the serialized fields of *obj*."""
+    data = PythonSerializer().serialize([obj], use_natural_keys=use_natural_keys)
+    return hashlib.sha1(simplejson.dumps(data[0]['fields'], sort_keys=True,
+        cls=DjangoJSONEncoder)).hexdigest()
+
+
+def _pk(obj):
+    return smart_unicode(obj._get_pk_val(), strings_only=True)
+
+
+class IndexReader(object):
+    """
+    Index Reader
+
+    Reads a row index back one model at a time.  Models are expected in
+    the order they were written, anything else costs a rescan.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.started = None
+        self._open()
+
+    def _open(self):
+        self._file = gzip.open(self.path, 'rb')
+        self._pending = None
+        header = simplejson.loads(self._file.readline())
+        self.started = datetime.datetime.strptime(header['started'], TIME_FORMAT)
+
+    def _entries(self, label):
+        found = False
+        while True:
+            line = self._pending or self._file.readline()
+            self._pending = None
+            if not line:
+                break
+            entry = simplejson.loads(line)
+            if entry[0] != label:
+                if found:
+                    self._pending = line
+                    break
+                continue
+            found = True
+            yield entry
+
+    def iter_rows(self, label):
+        """(pk, row hash) of every row of *label*, in the order written."""
+        found = False
+        for model, pk, value in self._entries(label):
+            found = True
+            if value is not None:
+                yield pk, value
+        if not found:
+            self.close()
+            self._open()
+            for model, pk, value in self._entries(label):
+                if value is not None:
+                    yield pk, value
+
+    def rows(self, label):
+        """pk -> row hash of every row of *label*"""
+        return dict(self.iter_rows(label))
+
+    def deleted(self):
+        """model label -> list of pks deleted since the parent archive"""
+        self.close()
+        self._open()
+        deleted = dict()
+        for line in self._file:
+            model, pk, value = simplejson.loads(line)
+            if value is None:
+                deleted.setdefault(model, []).append(pk)
+        return deleted
+
+    def close(self):
+        self._file.close()
+
+
+INTEGER_FIELDS = ('AutoField', 'BigIntegerField', 'IntegerField', 'PositiveIntegerField',
+    'PositiveSmallIntegerField', 'SmallIntegerField')
+
+
+def _integer_pk(model):
+    """Is the primary key of *model* an integer, ordered alike by Python and the database?"""
+    pk = model._meta.pk
+    while pk.rel is not None:
+        pk = pk.rel.get_related_field()
+    return pk.get_internal_type() in INTEGER_FIELDS
+
+
+class MergedRows(object):
+    """
+    Merged Rows
+
+    The (pk, row hash) *entries* of a model in the parent index, in
+    primary key order, read along with the model's rows instead of
+    loaded whole.  pop() must be called with increasing primary keys;
+    entries skipped over belong to deleted rows and are iterated over
+    with those never reached.
+    """
+
+    def __init__(self, entries):
+        self._entries = iter(entries)
+        self._deleted = []
+        self._advance()
+
+    def _advance(self):
+        try:
+            self._next = self._entries.next()
+        except StopIteration:
+            self._next = None
+
+    def pop(self, pk, default=None):
+        while self._next is not None and self._next[0] < pk:
+            self._deleted.append(self._next[0])
+            self._advance()
+        if self._next is not None and self._next[0] == pk:
+            value = self._next[1]
+            self._advance()
+            return value
+        return default
+
+    def __iter__(self):
+        for pk in self._deleted:
+            yield pk
+        while self._next is not None:
+            yield self._next[0]
+            self._advance()
+
+
+class RowIndex(object):
+    """
+    Row Index
+
+    Writes the index of a new archive and filters the objects to dump
+    down to rows changed since the *parent* index, if there is one.
+    After close(), *changed* and *deleted* count what differs.
+    """
+
+    def __init__(self, path, parent=None, use_natural_keys=False):
+        self.path = path
+        self.use_natural_keys = use_natural_keys
+        self.started = datetime.datetime.now()
+        self.changed = 0
+        self.deleted = 0
+        self.parent = None
+        if parent is not None:
+            self.parent = IndexReader(parent)
+        self._file = gzip.open(path, 'wb')
+        self._file.write(simplejson.dumps({'started': self.started.strftime(TIME_FORMAT)}) + '\n')
+
+    def _write(self, label, pk, value):
+        self._file.write(simplejson.dumps([label, pk, value]) + '\n')
+
+    def objects(self, model, chunk_size=CHUNK_SIZE, using=DEFAULT_DB_ALIAS):
+        """
+        Yield the objects of *model* to serialize while recording every
+        row in the index.  Rows of models with an integer primary key are
+        merged with the parent index as both are read in key order, those
+        of other models, whose keys the database may order differently,
+        are compared with the parent's rows loaded into memory.
+        """
+        label = smart_unicode(model._meta)
+        field = TIMESTAMP_FIELDS.get(label)
+        previous = dict()
+        if self.parent is not None and _integer_pk(model):
+            previous = MergedRows(self.parent.iter_rows(label))
+        elif self.parent is not None:
+            previous = self.parent.rows(label)
+
+        if field is not None and self.parent is not None:
+            qs = model._default_manager.using(using).filter(
+                **{'%s__gte' % field: self.parent.started})
+            for obj in iter_model(model, chunk_size, using, queryset=qs):
+                self.changed = self.changed + 1
+                yield obj
+            pks = model._default_manager.using(using).order_by('pk').values_list('pk', flat=True)
+            for pk in pks.iterator():
+                pk = smart_unicode(pk, strings_only=True)
+                previous.pop(pk, None)
+                self._write(label, pk, '')
+        else:
+            for obj in iter_model(model, chunk_size, using):
+                pk = _pk(obj)
+                if field is None:
+                    value = row_hash(obj, self.use_natural_keys)
+                else:
+                    value = ''
+                self._write(label, pk, value)
+                if previous.pop(pk, None) != value:
+                    self.changed = self.changed + 1
+                    yield obj
+
+        for pk in previous:
+            self.deleted = self.deleted + 1
+            self._write(label, pk, None)
+
+    def close(self):
+        self._file.close()
+        if self.parent is not None:
+            self.parent.close()
+
+    def discard(self):
+        self.close()
+        os.unlink(self.path)
@@ -2,14 +2,20 @@
 
 from optparse import make_option
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from vz_backup.models import backup_all
 from vz_backup.models import BackupObject
+from vz_backup.throttle import lower_priority
+
+import sys
 
 
 class Command(BaseCommand):
     
-    option_list = BaseCommand.option_list
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', action='store', dest='workers', default=1, type='int',
+            help='Number of apps to back up at the same time'),
+    )
     if '--verbosity' not in [opt.get_opt_string() for opt in BaseCommand.option_list]:
         option_list += (
             make_option('--verbosity', action='store', dest='verbosity', default='1',
@@ -17,7 +23,26 @@ class Command(BaseCommand):
             help='Verbosity level; 0=minimal output, 1=normal output, 2=all output'),
         )
 
-    help = "Adds application to backups"
+    help = "Backs up all included applications"
 
     def handle(self, *args, **options):
-        backup_all()
+        lower_priority()
+        results = backup_all(workers=options.get('workers', 1))
+
+        if int(options.get('verbosity', 1)) > 0:
+            # Django 1.3 and later give commands their own stdout
+            stdout = getattr(self, 'stdout', sys.stdout)
+            for result in results:
+                line = "%-30s %-10s %8.2fs %12d bytes" % (result['app_label'] or result['id'],
+                    result['status'], result['duration'], result['bytes'])
+                if result['throughput'] is not None:
+                    line = "%s %8.2f MB/s %8d rows/s" % (line, result['throughput'][0] / (1024 * 1024),
+                        result['throughput'][1])
+                if result['error']:
+                    line = "%s  %s" % (line, result['error'])
+                stdout.write(line + '\n')
+
+        failed = [result['app_label'] or str(result['id']) for result in results
+            if result['status'] == 'failed']
+        if failed:
+            raise CommandError('Backup failed for %s' % ', '.join(failed))
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+from optparse import make_option
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import loading
+from django.utils import simplejson
+
+from vz_backup.benchmarks import SIZES, bench_compressors, bench_file_hash, bench_formats, \
+    compare_results, generate_widgets, run_suite
+from vz_backup.dump import dump_app
+
+WIDGETS_APP = 'vz_backup.tests.testwidgets'
+
+
+class Command(BaseCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option('--size', action='store', dest='size', default=64, type='int',
+            help='Size in MB of the generated file when no path is given'),
+        make_option('--repeat', action='store', dest='repeat', default=3, type='int',
+            help='Number of runs, the best one is reported'),
+        make_option('--compress', action='append', dest='compress', default=[],
+            help='Compression to benchmark, may be repeated, default is all'),
+        make_option('--level', action='store', dest='level', default=None, type='int',
+            help='Compression level, default is each compression\'s default'),
+        make_option('--threads', action='store', dest='threads', default=1, type='int',
+            help='Compression threads, where supported'),
+        make_option('--format', action='append', dest='format', default=[],
+            help='Serialization format to benchmark, may be repeated, default is all'),
+        make_option('--indent', action='store', dest='indent', default=None, type='int',
+            help='Indent of the benchmarked dumps, default is VZ_BACKUP_INDENT'),
+        make_option('--rows', action='append', dest='rows', default=[], type='int',
+            help='Number of synthetic widgets to run the suite on, may be repeated, default is 10000, 100000 and 1000000'),
+        make_option('--archives', action='store', dest='archives', default=2000, type='int',
+            help='Number of archives pruned by each prune policy in the suite'),
+        make_option('--output', action='store', dest='output', default=None,
+            help='File to write the suite results to as JSON, default is standard output'),
+        make_option('--baseline', action='store', dest='baseline', default=None,
+            help='JSON results of an earlier suite run to compare against'),
+        make_option('--tolerance', action='store', dest='tolerance', default=0.25, type='float',
+            help='Fraction a timing may exceed its baseline before it is a regression'),
+    )
+
+    help = "Benchmarks backup hot paths"
+    args = 'hash [path] | compress <app_label> | formats <app_label> | suite'
+
+    def handle(self, what=None, target=None, *args, **options):
+        if what == 'hash':
+            self.hash(target, options)
+        elif what == 'compress' and target is not None:
+            self.compress(target, options)
+        elif what == 'formats' and target is not None:
+            self.formats(target, options)
+        elif what == 'suite':
+            self.suite(options)
+        else:
+            raise CommandError('Usage: %s' % self.args)
+
+    def hash(self, path, options):
+        tmp_path = None
+        if path is None:
+            fd, tmp_path = tempfile.mkstemp()
+            with os.fdopen(fd, 'wb') as f:
+                for i in range(options['size']):
+                    f.write(os.urandom(1024 * 1024))
+            path = tmp_path
+
+        try:
+            results = bench_file_hash(path, options['repeat'])
+        finally:
+            if tmp_path is not None:
+                os.unlink(tmp_path)
+
+        for result in results:
+            print "%-16s %8.3fs %10.1f MB/s" % (
+                result['name'], result['seconds'], result['mb_per_s'] or 0)
+
+    def compress(self, app_label, options):
+        fd, path = tempfile.mkstemp(dir=settings.VZ_BACKUP_DIR)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                dump_app(app_label, f, indent=getattr(settings, 'VZ_BACKUP_INDENT', 4))
+            results = bench_compressors(path, options['repeat'], options['compress'],
+                options['level'], 1)
+            if options['threads'] > 1:
+                # each compressor on one thread, then on --threads
+                threaded = bench_compressors(path, options['repeat'], options['compress'],
+                    options['level'], options['threads'])
+                results = [result for pair in zip(results, threaded) for result in pair]
+        finally:
+            os.unlink(path)
+
+        print "%-6s %5s %7s %12s %7s %12s %12s" % ('codec', 'level', 'threads', 'bytes', 'ratio',
+            'comp MB/s', 'decomp MB/s')
+        for result in results:
+            print "%-6s %5s %7d %12d %7.2f %12.1f %12.1f" % (result['name'], result['level'],
+                result['threads'], result['compressed_bytes'], result['ratio'] or 0,
+                result['mb_per_s'] or 0, result['decompress_mb_per_s'] or 0)
+
+    def formats(self, app_label, options):
+        indent = options['indent']
+        if indent is None:
+            indent = getattr(settings, 'VZ_BACKUP_INDENT', 4)
+        results = bench_formats(app_label, options['format'], options['repeat'], indent,
+            settings.VZ_BACKUP_DIR)
+
+        print "%-8s %10s %12s %10s %10s %12s %12s" % ('format', 'objects', 'bytes',
+            'ser s', 'deser s', 'ser MB/s', 'deser MB/s')
+        for result in results:
+            print "%-8s %10d %12d %10.3f %10.3f %12.1f %12.1f" % (result['name'],
+                result['objects'], result['bytes'], result['seconds'],
+                result['deserialize_seconds'], result['mb_per_s'] or 0,
+                result['deserialize_mb_per_s'] or 0)
+
+    def suite(self, options):
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = simplejson.load(f)['results']
+
+        # run on a test database with the test widgets, like the tests
+        old_installed_apps = settings.INSTALLED_APPS
+        old_backup_dir = settings.VZ_BACKUP_DIR
+        if WIDGETS_APP not in old_installed_apps:
+            settings.INSTALLED_APPS = list(old_installed_apps) + [WIDGETS_APP]
+        loading.cache.loaded = False
+        loading.load_app(WIDGETS_APP)
+        settings.VZ_BACKUP_DIR = tempfile.mkdtemp()
+        connection = connections[DEFAULT_DB_ALIAS]
+        old_name = connection.creation.create_test_db(verbosity=0)
+        try:
+            from vz_backup.models import BackupObject
+            from vz_backup.tests.testwidgets.models import BackupTestWidget
+            User.objects.create_superuser('benchmark', 'benchmark@example.com', 'benchmark')
+            backup_object = BackupObject.objects.create(app_label='testwidgets')
+            results = []
+            rows = 0
+            for size in sorted(options['rows'] or SIZES):
+                generate_widgets(BackupTestWidget, size - rows, start=rows)
+                rows = size
+                results.extend(run_suite(backup_object, rows, options['compress'],
+                    options['archives'], options['repeat'], 'benchmark', 'benchmark'))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(settings.VZ_BACKUP_DIR, ignore_errors=True)
+            settings.VZ_BACKUP_DIR = old_backup_dir
+            settings.INSTALLED_APPS = old_installed_apps
+            loading.cache.loaded = False
+
+        data = simplejson.dumps({
+            'created': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'python': sys.version.split()[0],
+            'engine': connection.settings_dict['ENGINE'],
+            'results': results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(data)
+            for result in results:
+                print "%-16s %8d %10.3fs %10.1f MB/s %s" % (result['name'], result['rows'],
+                    result['seconds'], result['mb_per_s'] or 0, result.get('queries', ''))
+        else:
+            print data
+
+        if baseline is not None:
+            regressions = compare_results(results, baseline, options['tolerance'])
+            for name, rows, field, value, old in regressions:
+                sys.stderr.write("regression: %s on %d rows, %s %s (baseline %s)\n" % (
+                    name, rows, field, value, old))
+            if regressions:
+                raise CommandError('%d regressions against %s' % (len(regressions),
+                    options['baseline']))
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand, CommandError
+from vz_backup.container import read_index
+from vz_backup.models import BackupArchive
+
+import zipfile
+
+
+class Command(BaseCommand):
+
+    args = '<archive id or path>'
+    help = "Lists the members of a container archive with their row counts and sizes"
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give one archive id or path')
+        path = args[0]
+        if path.isdigit():
+            try:
+                path = BackupArchive.objects.get(id__exact=int(path)).path
+            except BackupArchive.DoesNotExist:
+                raise CommandError('Archive with this ID does not exist.')
+
+        try:
+            container = zipfile.ZipFile(path)
+        except (IOError, zipfile.BadZipfile), e:
+            raise CommandError('%s is not a container archive: %s' % (path, e))
+        try:
+            index = read_index(container)
+        except KeyError:
+            raise CommandError('%s has no index' % path)
+        finally:
+            container.close()
+
+        print "%-40s %-30s %10s %12s %12s" % ('member', 'model', 'rows', 'bytes', 'stored')
+        for entry in index['members']:
+            print "%-40s %-30s %10d %12d %12d" % (entry['member'], entry['model'],
+                entry['count'], entry['size'], entry['stored_size'])
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand, CommandError
+from vz_backup.models import BackupObject
+
+
+class Command(BaseCommand):
+
+    args = '[app_label app_label ...]'
+    help = "Recomputes archive statistics of backup objects from their archives"
+
+    def handle(self, *args, **options):
+        bobjs = BackupObject.objects.all()
+        if args:
+            bobjs = bobjs.filter(app_label__in=args)
+            missing = set(args) - set(bobjs.values_list('app_label', flat=True))
+            if missing:
+                raise CommandError('No backup object for %s' % ', '.join(sorted(missing)))
+
+        for bobj in bobjs:
+            stats = bobj.recompute_stats()
+            if int(options.get('verbosity', 1)) > 0:
+                print "%-30s %6d archives %6d kept %12d bytes" % (bobj.app_label,
+                    stats.number_of_archives, stats.kept_archives, stats.archives_size)
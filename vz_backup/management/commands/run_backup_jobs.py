@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from vz_backup.models import next_job, run_maintenance_jobs
+from vz_backup.throttle import lower_priority
+
+import time
+
+
+class Command(BaseCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+            help='Run the queued jobs and exit instead of waiting for more'),
+        make_option('--sleep', action='store', dest='sleep', default=5, type='float',
+            help='Seconds to wait before looking for new jobs when the queue is empty'),
+        make_option('--maintain-every', action='store', dest='maintain_every', default=10, type='int',
+            help='Prune and mail new archives after this many jobs, even if more are queued'),
+        make_option('--maintain-after', action='store', dest='maintain_after', default=300, type='float',
+            help='Prune and mail new archives after this many seconds, even if more jobs are queued'),
+    )
+    if '--verbosity' not in [opt.get_opt_string() for opt in BaseCommand.option_list]:
+        option_list += (
+            make_option('--verbosity', action='store', dest='verbosity', default='1',
+            type='choice', choices=['0', '1', '2'],
+            help='Verbosity level; 0=minimal output, 1=normal output, 2=all output'),
+        )
+
+    help = "Runs backup jobs queued from the admin"
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        lower_priority()
+        ran = 0
+        since = None
+        while True:
+            job = next_job()
+            if job is not None:
+                job.run()
+                ran = ran + 1
+                since = since or time.time()
+                if verbosity > 0:
+                    self.report(job.backup_object.app_label, job)
+
+            # prune and mail for the jobs run so far, in one batch
+            if job is None or ran >= options.get('maintain_every', 10) or \
+                    time.time() - since >= options.get('maintain_after', 300):
+                maintained = run_maintenance_jobs()
+                if maintained and verbosity > 0:
+                    self.report(', '.join(sorted(set([m.backup_object.app_label for m in maintained]))),
+                        maintained[0])
+                ran = 0
+                since = None
+
+            if job is None:
+                if options.get('once'):
+                    break
+                # don't hold a connection open while idle
+                for connection in connections.all():
+                    connection.close()
+                time.sleep(options.get('sleep', 5))
+
+
+    def report(self, label, job):
+        line = "%-30s %-8s %-8s %8.2fs %s" % (label, job.action, job.status, job.duration, job.result)
+        if job.error:
+            line = "%s  %s" % (line, job.error)
+        print line
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from vz_backup.models import BackupArchive, BackupObject
+from vz_backup.verify import STATUSES, verify_archives
+
+import datetime
+
+
+class Command(BaseCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', action='store', dest='workers', default=4, type='int',
+            help='Number of archives hashed at the same time'),
+        make_option('--days', action='store', dest='days', default=None, type='float',
+            help='Only verify archives not found intact in the last DAYS days'),
+    )
+    if '--verbosity' not in [opt.get_opt_string() for opt in BaseCommand.option_list]:
+        option_list += (
+            make_option('--verbosity', action='store', dest='verbosity', default='1',
+            type='choice', choices=['0', '1', '2'],
+            help='Verbosity level; 0=minimal output, 1=normal output, 2=all output'),
+        )
+
+    args = '[app_label app_label ...]'
+    help = "Re-hashes archives and reports missing, truncated and corrupted ones"
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        archives = BackupArchive.objects.select_related('backup_object').order_by('id')
+        if args:
+            labels = BackupObject.objects.filter(app_label__in=args).values_list('app_label', flat=True)
+            missing = set(args) - set(labels)
+            if missing:
+                raise CommandError('No backup object for %s' % ', '.join(sorted(missing)))
+            archives = archives.filter(backup_object__app_label__in=args)
+        if options.get('days') is not None:
+            since = datetime.datetime.now() - datetime.timedelta(days=options['days'])
+            archives = archives.filter(Q(last_verified__isnull=True) | Q(last_verified__lt=since))
+
+        counts = dict((status, 0) for status in STATUSES)
+        for archive, status in verify_archives(archives, workers=options.get('workers', 4)):
+            counts[status] = counts[status] + 1
+            if status != 'ok' or verbosity > 1:
+                print "%-10s %6d %-30s %s" % (status, archive.id, archive.backup_object.app_label,
+                    archive.path)
+
+        if verbosity > 0:
+            print ', '.join(['%d %s' % (counts[status], status) for status in STATUSES])
+        failed = sum([counts[status] for status in STATUSES if status != 'ok'])
+        if failed:
+            raise CommandError('%d archives failed verification' % failed)
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics
+
+Time and byte counters for the phases of a backup, prune, mail or
+reload.  A PhaseTimer collects them while the action runs and, when it
+is finished, sends the phase_timed and action_timed signals, which
+record_metrics hands to the backends listed in
+VZ_BACKUP_METRICS_BACKENDS.
+"""
+
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.datastructures import SortedDict
+from django.utils.importlib import import_module
+
+from vz_backup.signals import action_timed, phase_timed
+
+import logging
+import os
+import time
+
+LOGGER = getattr(settings, 'VZ_BACKUP_METRICS_LOGGER', 'vz_backup.metrics')
+
+
+class PhaseTimer(object):
+    """
+    Phase Timer
+
+    Collects the seconds and bytes of each phase of *action* on
+    *backup_object*.  Phases can nest, a phase is only charged the time
+    not spent in the phases inside it, so the phases add up to the time
+    they were timed for.
+    """
+
+    def __init__(self, backup_object, action):
+        self.backup_object = backup_object
+        self.action = action
+        self.phases = SortedDict()
+        self.started = time.time()
+        self.duration = None
+        # time spent in nested phases, one entry per phase being timed
+        self._nested = [0.0]
+
+    def add(self, phase, seconds=0.0, bytes=0):
+        totals = self.phases.get(phase)
+        if totals is None:
+            totals = self.phases[phase] = {'seconds': 0.0, 'bytes': 0}
+        totals['seconds'] = totals['seconds'] + seconds
+        totals['bytes'] = totals['bytes'] + bytes
+
+    def start(self):
+        """Start timing a phase, returns what stop needs."""
+        self._nested.append(0.0)
+        return time.time()
+
+    def stop(self, phase, start, bytes=0):
+        """Charge the time since *start*, less nested phases, to *phase*."""
+        elapsed = time.time() - start
+        nested = self._nested.pop()
+        self._nested[-1] = self._nested[-1] + elapsed
+        self.add(phase, elapsed - nested, bytes)
+
+    @contextmanager
+    def phase(self, phase):
+        start = self.start()
+        try:
+            yield
+        finally:
+            self.stop(phase, start)
+
+    def stop_clock(self):
+        """Fix the duration of the action, returns it."""
+        if self.duration is None:
+            self.duration = time.time() - self.started
+        return self.duration
+
+    def finish(self, archive=None):
+        """
+        Stop the clock if still running and send phase_timed for every
+        phase, then action_timed with *archive*, the archive made, mailed or
+        reloaded, if any.
+        """
+        self.stop_clock()
+        for phase, totals in self.phases.items():
+            phase_timed.send(sender=PhaseTimer, backup_object=self.backup_object,
+                action=self.action, phase=phase, seconds=totals['seconds'],
+                bytes=totals['bytes'])
+        action_timed.send(sender=PhaseTimer, backup_object=self.backup_object,
+            action=self.action, duration=self.duration, phases=self.phases,
+            archive=archive)
+
+
+class LoggingBackend(object):
+    """
+    Logging Backend
+
+    Logs one line per action with its duration and phases to the
+    VZ_BACKUP_METRICS_LOGGER logger.
+    """
+
+    def record(self, backup_object, action, duration, phases, archive=None):
+        logging.getLogger(LOGGER).info('%s %s %.3fs %s', action, backup_object, duration,
+            ' '.join(['%s=%.3fs/%dB' % (phase, totals['seconds'], totals['bytes'])
+                for phase, totals in phases.items()]))
+
+
+class PrometheusTextfileBackend(object):
+    """
+    Prometheus Textfile Backend
+
+    Keeps the latest metrics of every app and action in the file
+    VZ_BACKUP_METRICS_TEXTFILE, in the format of the node exporter's
+    textfile collector.  The file is replaced as a whole by a rename, so
+    the collector never reads it half written.
+    """
+
+    HELP = SortedDict((
+        ('vz_backup_duration_seconds', 'Duration of the last action.'),
+        ('vz_backup_phase_seconds', 'Seconds spent in each phase of the last action.'),
+        ('vz_backup_phase_bytes', 'Bytes handled by each phase of the last action.'),
+        ('vz_backup_last_run_timestamp_seconds', 'Time the last action finished.'),
+        ('vz_backup_archive_bytes', 'Size of the last archive made.'),
+        ('vz_backup_archive_raw_bytes', 'Uncompressed size of the last archive made.'),
+    ))
+
+    def __init__(self, path=None):
+        if path is None:
+            path = getattr(settings, 'VZ_BACKUP_METRICS_TEXTFILE', None)
+        if path is None:
+            raise ImproperlyConfigured('PrometheusTextfileBackend needs VZ_BACKUP_METRICS_TEXTFILE')
+        self.path = path
+
+    def read(self):
+        """Samples in the file, a dict of 'name{labels}' to value."""
+        samples = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        sample, value = line.rsplit(' ', 1)
+                        samples[sample] = value
+        except IOError:
+            pass
+        return samples
+
+    def record(self, backup_object, action, duration, phases, archive=None):
+        app_label = getattr(backup_object, 'app_label', '')
+        labels = 'app_label="%s",action="%s"' % (app_label, action)
+        samples = self.read()
+        samples['vz_backup_duration_seconds{%s}' % labels] = '%f' % duration
+        samples['vz_backup_last_run_timestamp_seconds{%s}' % labels] = '%f' % time.time()
+        for phase, totals in phases.items():
+            phase_labels = '%s,phase="%s"' % (labels, phase)
+            samples['vz_backup_phase_seconds{%s}' % phase_labels] = '%f' % totals['seconds']
+            samples['vz_backup_phase_bytes{%s}' % phase_labels] = '%d' % totals['bytes']
+        if action == 'backup' and archive is not None:
+            samples['vz_backup_archive_bytes{app_label="%s"}' % app_label] = '%d' % archive.size
+            if archive.raw_size is not None:
+                samples['vz_backup_archive_raw_bytes{app_label="%s"}' % app_label] = '%d' % archive.raw_size
+
+        lines = []
+        for name, help in self.HELP.items():
+            names = sorted([sample for sample in samples if sample.split('{', 1)[0] == name])
+            if names:
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s gauge' % name)
+                lines.extend(['%s %s' % (sample, samples[sample]) for sample in names])
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            logging.getLogger(LOGGER).exception('Unable to write %s' % self.path)
+
+
+def load_backend(path):
+    """Instance of the metrics backend class at dotted *path*."""
+    module, attr = path.rsplit('.', 1)
+    try:
+        backend = getattr(import_module(module), attr)
+    except (ImportError, AttributeError), e:
+        raise ImproperlyConfigured('Error loading metrics backend %s: "%s"' % (path, e))
+    return backend()
+
+
+def get_backends():
+    return [load_backend(path) for path in getattr(settings, 'VZ_BACKUP_METRICS_BACKENDS', ())]
+
+
+def record_metrics(sender, backup_object, action, duration, phases, archive=None, **kwargs):
+    """Record Metrics
+
+    action_timed signal
+
+    hands the metrics of a finished action to every backend"""
+    for backend in get_backends():
+        backend.record(backup_object, action, duration, phases, archive)
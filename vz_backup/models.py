@@ -2,24 +2,49 @@
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.core.mail import EmailMessage
+from django.core import serializers
+from django.core.mail import EmailMessage, get_connection
 from django.core.management import call_command
-from django.core.management.commands import dumpdata
-from django.db import models
-from django.db.models import Sum
-from django.db.models.signals import post_save, pre_delete, pre_save
+from django.core.urlresolvers import reverse
+from django.db import connections, models, router, transaction, DEFAULT_DB_ALIAS
+from django.db.models import Count, F, Q, Sum
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.utils import simplejson
+from django.utils.datastructures import SortedDict
 
 import datetime
 import mimetypes
+import multiprocessing
 import os
+import shutil
 import time
+import zipfile
 
-from vz_backup import generate_file_hash
+from vz_backup import HASH_BUFFER_SIZE, generate_file_hash
+from vz_backup.compressors import COMPRESSORS, compressor_for_name, get_compressor
+from vz_backup.chunks import ChunkReader, ChunkWriter, sweep_chunks, unlink_chunk
+from vz_backup.container import EXTENSION as CONTAINER_EXTENSION, open_member, select_members, write_container
+from vz_backup.dump import dump_app, dump_app_parallel, init_worker, consistent_snapshot, CHUNK_SIZE, FETCH_SIZE
 from vz_backup.exceptions import *
-from vz_backup.signals import maintenance_tasks, unlink_archive
+from vz_backup.fingerprint import app_fingerprint
+from vz_backup.incremental import IndexReader, RowIndex, index_path
+from vz_backup.metrics import PhaseTimer, record_metrics
+from vz_backup.restore import OBJECT_READERS, BatchLoader, clear_app, clear_model, defer_constraints, \
+    iter_json_objects, load_stream, restore_constraints
+from vz_backup.signals import collect_chunks, defer_maintenance, deferred_archives, maintenance_tasks, \
+    save_archive_chunks, unlink_archive, update_stats_on_delete, update_stats_on_save
+from vz_backup.signals import action_timed
+from vz_backup.streams import DeferredFileWriter, HashingReader, HashingWriter, ThrottledWriter, \
+    TimedReader, TimedWriter
+from vz_backup.throttle import LATENCY_TARGET, READ_RATE, WRITE_RATE, Throttle
 
 INDENT = getattr(settings, 'VZ_BACKUP_INDENT', 4)
 FORMAT = getattr(settings, 'VZ_BACKUP_FORMAT', 'json')
+EXTRA_HASH = getattr(settings, 'VZ_BACKUP_EXTRA_HASH', None)
+MAIL_MAX_SIZE = getattr(settings, 'VZ_BACKUP_MAIL_MAX_SIZE', 10 * 1024 * 1024)
+BASE_URL = getattr(settings, 'VZ_BACKUP_BASE_URL', '')
+SPOOL_SIZE = getattr(settings, 'VZ_BACKUP_SPOOL_SIZE', 8 * 1024 * 1024)
+JOB_TIMEOUT = getattr(settings, 'VZ_BACKUP_JOB_TIMEOUT', 6 * 60 * 60)
 
 PRUNE_CHOICES = (
     ('count', 'Count'),
@@ -28,10 +53,34 @@ PRUNE_CHOICES = (
     ('none', 'None'),
 )
 
-COMPRESS_CHOICES = (
-    ('bz2', 'bz2'),
-    ('gz', 'gz'),
-    ('none', 'none'),
+COMPRESS_CHOICES = tuple((name, name) for name in COMPRESSORS.keys())
+
+# the builtin serializers are only loaded by a lookup made before any
+# registration, so look them up first
+if 'msgpack' in OBJECT_READERS and 'msgpack' not in serializers.get_serializer_formats():
+    serializers.register_serializer('msgpack', 'vz_backup.msgpack_serializer')
+
+FORMAT_CHOICES = tuple((name, name) for name in sorted(serializers.get_public_serializer_formats()))
+
+DELETE_BATCH_SIZE = 500
+
+# compressed fixtures loaddata can read without help; not bz2, BZ2File
+# stops after the first stream of a multi-stream file written on threads
+LOADDATA_COMPRESSORS = ('gz', 'none')
+
+JOB_ACTION_CHOICES = (
+    ('backup', 'Backup'),
+    ('prune', 'Prune'),
+    ('mail', 'Mail'),
+    ('reload', 'Reload'),
+    ('maintain', 'Prune and mail'),
+)
+
+JOB_STATUS_CHOICES = (
+    ('queued', 'Queued'),
+    ('running', 'Running'),
+    ('done', 'Done'),
+    ('failed', 'Failed'),
 )
 
 
@@ -46,7 +95,13 @@ class BackupObject(models.Model):
     include = models.BooleanField(default=True,
         help_text='Include this app when performing backup?')
     use_natural_keys = models.BooleanField(default=True)
+    format = models.CharField(max_length=10, choices=FORMAT_CHOICES, default=FORMAT,
+        help_text='Serialization format of new archives.')
     compress = models.CharField(max_length=5, choices=COMPRESS_CHOICES, default='none', db_index=True)
+    compress_level = models.PositiveSmallIntegerField(blank=True, null=True,
+        help_text='Compression level, leave empty for the default of the chosen compression.')
+    compress_threads = models.PositiveSmallIntegerField(default=1,
+        help_text='Number of threads used to compress, where supported.')
     prune_by = models.CharField(max_length=5, choices=PRUNE_CHOICES,
         default='none',
         help_text='What factor leads to archive file deletion?', db_index=True)
@@ -54,6 +109,22 @@ class BackupObject(models.Model):
         default=10)
     auto_prune = models.BooleanField(default=False,
         help_text="Prune after backup?", db_index=True)
+    incremental = models.BooleanField(default=False,
+        help_text='Only dump rows added or changed since the last archive?')
+    full_every = models.PositiveIntegerField(default=7,
+        help_text='Number of incremental archives before the next full archive.')
+    snapshot = models.BooleanField(default=False,
+        help_text='Dump the app in one repeatable read transaction, reading each model through a server-side cursor?')
+    write_rate = models.FloatField(blank=True, null=True,
+        help_text='Most MB a second written to the archive, leave empty for VZ_BACKUP_WRITE_RATE.')
+    read_rate = models.PositiveIntegerField(blank=True, null=True,
+        help_text='Most rows a second read from the database, leave empty for VZ_BACKUP_READ_RATE.')
+    dump_workers = models.PositiveSmallIntegerField(default=1,
+        help_text='Number of processes dumping models, or row ranges of big models, at the same time.')
+    container = models.BooleanField(default=False,
+        help_text='Store each model in its own member of a zip archive, so single models can be reloaded or downloaded?')
+    deduplicate = models.BooleanField(default=False,
+        help_text='Store archives as chunks shared with earlier archives?  Compression is per chunk.')
     mail_to = models.ManyToManyField(User, limit_choices_to={'is_superuser': True}, 
         blank=True, null=True, default='', help_text='Select which admin(s) to send new backup archives to.')
     created = models.DateTimeField(blank=True, auto_now_add=True)
@@ -78,25 +149,78 @@ class BackupObject(models.Model):
         return self.archives.filter(keep=False)
 
 
+    def get_stats(self):
+        """
+        Archive statistics kept up to date as archives are created,
+        deleted, kept or unkept.  Read fresh from the database each time.
+        """
+        stats, created = BackupStats.objects.get_or_create(backup_object=self)
+        if created:
+            stats = self.recompute_stats()
+        return stats
+
+
+    def recompute_stats(self):
+        """
+        Recompute archive statistics from the archives themselves, to repair
+        drift.
+        """
+        totals = self.archives.aggregate(size=Sum('size'), number=Count('id'))
+        unkept = self.unkept_archives.aggregate(size=Sum('size'), number=Count('id'))
+        try:
+            last = self.archives.values_list('id', 'created')[0]
+        except IndexError:
+            last = (None, None)
+        BackupStats.objects.get_or_create(backup_object=self)
+        BackupStats.objects.filter(backup_object=self).update(
+            archives_size=totals['size'] or 0,
+            unkept_archives_size=unkept['size'] or 0,
+            number_of_archives=totals['number'],
+            kept_archives=totals['number'] - unkept['number'],
+            last_archive_id=last[0],
+            last_archive_time=last[1])
+        return BackupStats.objects.get(backup_object=self)
+
+
+    def update_stats(self, create=True, **deltas):
+        """
+        Add *deltas* to the statistics in a single atomic UPDATE.  When
+        there are no statistics yet they are computed by get_stats, from
+        archives that already include the change, or with *create* off
+        left alone.
+        """
+        deltas = dict((field, F(field) + delta) for field, delta in deltas.items() if delta)
+        if deltas and BackupStats.objects.filter(backup_object=self).update(**deltas):
+            return
+        if create:
+            self.get_stats()
+
+
+    def _update_last_archive(self):
+        try:
+            last = self.archives.values_list('id', 'created')[0]
+        except IndexError:
+            last = (None, None)
+        BackupStats.objects.filter(backup_object=self).update(
+            last_archive_id=last[0], last_archive_time=last[1])
+
+
     @property
     def unkept_archives_size(self):
-        qs = self.unkept_archives.aggregate(Sum('size'))
-        if qs['size__sum'] is None:
-            return 0
-        return qs['size__sum']
+        return self.get_stats().unkept_archives_size
 
 
     @property
     def archives_size(self):
-        qs = self.archives.aggregate(Sum('size'))
-        if qs['size__sum'] is None:
-            return 0
-        return qs['size__sum']
+        return self.get_stats().archives_size
 
 
     @property
     def last_archive(self):
-        return self.archives[0]
+        last_archive_id = self.get_stats().last_archive_id
+        if last_archive_id is None:
+            raise IndexError('%s has no archives' % self)
+        return BackupArchive.objects.get(id__exact=last_archive_id)
 
 
     @property
@@ -104,131 +228,687 @@ class BackupObject(models.Model):
         return self.kept_archives[0]
 
 
-    def prune(self):
+    def collect_chunks(self, sweep=False):
+        """
+        Collect Chunks
+
+        Delete chunks no deduplicated archive references any more, both
+        the rows and the files in the chunk store.  Files a running backup
+        may have just reused are kept for a later sweep, see
+        vz_backup.chunks.unlink_chunk.  With *sweep* on, chunk files
+        without a row, left by failed backups, are deleted too, see
+        vz_backup.chunks.sweep_chunks.  Returns the number of chunk rows
+        and files removed.
+        """
+        orphans = list(Chunk.objects.filter(backup_object=self,
+            archivechunk__isnull=True).values_list('id', 'digest'))
+        if orphans:
+            Chunk.objects.filter(id__in=[id for id, digest in orphans]).delete()
+        for id, digest in orphans:
+            unlink_chunk(self.app_label, digest)
+        removed = len(orphans)
+        if sweep:
+            removed = removed + sweep_chunks(self.app_label, set(Chunk.objects.filter(
+                backup_object=self).values_list('digest', flat=True)))
+        return removed
+
+
+    def prune(self, dry_run=False):
         """
         Prune
 
-        Depends on prune_by.
+        Depends on prune_by.  Each policy picks its victims, BackupArchives
+        not marked "keep", with a single query.
 
         If prune_by is "count", prune_value is number of BackupArhchives
-        to keep.  Find totalBackupArchives for this BackupObject that
-        are not marked "keep".  Delete all BackupArchives not marked
-        "keep" for BackupObject older than BackupArchives[count-1].
+        to keep.  Every unkept BackupArchive after the newest prune_value
+        ones is a victim.
 
         If prune_by is "size", prune_value is total size of
-        BackupArchive files not marked "keep" in kilo bytes.  If total
-        is greater than prune_value, get ids of BackupArchives where
-        size of this list - total is less than prune_value.  Delete
-        BackupArchives with selected ids.
+        BackupArchive files not marked "keep" in kilo bytes.  Unkept
+        BackupArchives are walked newest first, once their running total
+        exceeds prune_value the rest are victims.
 
         If prune_by is "time", prune_value is number of days to keep
-        BackupArchive files not marked "keep".  Find all BackupArchives
-        older than today - prune_value, delete them.
+        BackupArchive files not marked "keep".  All BackupArchives
+        older than today - prune_value are victims.
 
         If prune_by is "none", don't prune
+
+        Archives a remaining incremental archive builds on are spared.
+        Victims are deleted in bulk, then their files are unlinked, and
+        with deduplicate on chunk files left by failed backups are swept.  With
+        *dry_run* nothing is deleted.  Returns the list of victim ids and
+        the number of bytes they take.
         """
-        unkept = self.unkept_archives
+        timer = PhaseTimer(self, 'prune')
+        start = timer.start()
+        unkept = self.unkept_archives.order_by('-created')
+        fields = ('id', 'size', 'path', 'chunked')
+
+        stats = self.get_stats()
 
         if self.prune_by == 'count':
-            prune_value = int(self.prune_value)
-            if unkept.count() > prune_value:
-                last_backup = unkept.all()[prune_value-1]
-                BackupArchive.objects.filter(
-                    backup_object=self,
-                    keep=False,
-                    created__lt=last_backup.created).delete()
+            victims = list()
+            if stats.number_of_archives - stats.kept_archives > int(self.prune_value):
+                victims = list(unkept.values_list(*fields)[int(self.prune_value):])
 
         elif self.prune_by == 'size':
-
             prune_value = self.prune_value * 1000
-
-            ids = list()
-            start = 0
-            size = self.unkept_archives_size
-            while size > prune_value:
-                archive = unkept.order_by('created')[start]
-                ids.append(archive.id)
-                start = start + 1
-                size = size - archive.size
-            BackupArchive.objects.filter(id__in=ids).delete()
+            victims = list()
+            total = 0
+            if stats.unkept_archives_size <= prune_value:
+                unkept = unkept.none()
+            for victim in unkept.values_list(*fields):
+                total = total + victim[1]
+                if total > prune_value:
+                    victims.append(victim)
 
         elif self.prune_by == 'time':
-
             delta = datetime.timedelta(days=self.prune_value)
             threshold = datetime.date.today() - delta
-            BackupArchive.objects.filter(
-                backup_object=self, keep=False, created__lt=threshold).delete()
+            victims = list(unkept.filter(created__lt=threshold).values_list(*fields))
 
         else:
-            pass
+            victims = list()
+
+        victims = self._spare_parents(victims)
+        timer.stop('select', start)
+        if not dry_run:
+            if victims:
+                self._delete_archives(victims, timer)
+            if self.deduplicate:
+                with timer.phase('sweep'):
+                    self.collect_chunks(sweep=True)
+            timer.finish()
+        return [victim[0] for victim in victims], sum([victim[1] for victim in victims])
 
 
-    def backup(self):
+    def _spare_parents(self, victims):
+        """
+        Drop victims an incremental archive that stays still builds on.
+        """
+        ids = set([victim[0] for victim in victims])
+        if not ids:
+            return victims
+        protected = set(BackupArchive.objects.filter(parent__in=list(ids)).exclude(
+            id__in=list(ids)).values_list('parent', flat=True))
+        while protected:
+            ids = ids - protected
+            protected = set(BackupArchive.objects.filter(id__in=list(protected),
+                parent__in=list(ids)).values_list('parent', flat=True))
+        return [victim for victim in victims if victim[0] in ids]
+
+
+    def _delete_archives(self, victims, timer=None):
+        """
+        Delete *victims*, (id, size, path, chunked) tuples, with bulk
+        DELETEs instead of one delete() per archive, then unlink their
+        files and collect unreferenced chunks.  Both are timed as the
+        'delete' and 'unlink' phases of *timer*, if given.
+        """
+        if timer is None:
+            timer = PhaseTimer(self, 'delete')
+        start = timer.start()
+        ids = [victim[0] for victim in victims]
+        _delete_archive_rows(ids)
+        size = sum([victim[1] for victim in victims])
+        self.update_stats(archives_size=-size, unkept_archives_size=-size,
+            number_of_archives=-len(ids))
+        if self.get_stats().last_archive_id in ids:
+            self._update_last_archive()
+        timer.stop('delete', start)
+
+        start = timer.start()
+        for id, size, path, chunked in victims:
+            for victim_path in (path, index_path(path)):
+                if chunked and victim_path == path:
+                    continue
+                try:
+                    os.unlink(victim_path)
+                except OSError:
+                    pass
+        if [victim for victim in victims if victim[3]]:
+            self.collect_chunks()
+        timer.stop('unlink', start, sum([victim[1] for victim in victims]))
+
+
+    def backup(self, progress=None):
+        """
+        Backup
+
+        Dump app data into a new BackupArchive.  Returns the new archive,
+        or None if an identical archive already exists.  *progress* is
+        handed to dump_app.
+
+        With incremental on, only rows changed since the last archive are
+        dumped, until full_every incrementals have been chained to the
+        last full archive.  With container on every archive is a full
+        JSON container archive, see vz_backup.container.
+
+        The serialized data is hashed as it is written, into content_hash,
+        and the first VZ_BACKUP_SPOOL_SIZE bytes of the archive are kept in
+        memory, so a dump equal to an earlier archive of the app, in
+        whatever compression, is dropped before a small archive is written.
+
+        Fetching rows, serializing, compressing, hashing, deduplicating and
+        writing are timed, see vz_backup.metrics; the archive records the
+        duration, phases, uncompressed size and rows per model.
+
+        The app is first fingerprinted, see fingerprint.  When the
+        fingerprint is the one of the last archive nothing is dumped,
+        skipped is set and None is returned.  A compress whose library isn't
+        installed raises ImproperlyConfigured before anything is read.
+
+        With snapshot on the fingerprint, the dump and the new archive all
+        belong to one consistent_snapshot transaction.
+        """
+        compressor = get_compressor(self.compress)
+        if self.snapshot:
+            with consistent_snapshot():
+                return self._backup(compressor, progress)
+        return self._backup(compressor, progress)
+
+
+    def _backup(self, compressor, progress=None):
+        """Backup with *compressor*, see backup."""
+        timer = PhaseTimer(self, 'backup')
+        throttle = self.throttle(timer)
         dt = datetime.datetime.now()
-        name = u'%s_%s%s.%s' % (self.app_label, dt.strftime('%Y%j-'), dt.microsecond, FORMAT)
+        stamp = u'%s_%s%s' % (self.app_label, dt.strftime('%Y%j-'), dt.microsecond)
+
+        with timer.phase('fingerprint'):
+            fingerprint = self.fingerprint(throttle)
+            self.skipped = fingerprint is not None and fingerprint == self._last_fingerprint()
+        if self.skipped:
+            timer.finish()
+            return None
+        fingerprint = fingerprint or ''
+
+        if self.container:
+            archive = self._backup_container(u'%s.json.%s' % (stamp, CONTAINER_EXTENSION), timer,
+                fingerprint, progress, throttle)
+            timer.finish(archive)
+            return archive
 
-        if self.compress == 'gz':
-            from gzip import GzipFile
-            name = name + u'.gz'
-        elif self.compress == 'bz2':
-            from bz2 import BZ2File
-            name = name + u'.bz2'
+        name = u'%s.%s' % (stamp, self.format)
+
+        if self.deduplicate:
+            compressor = get_compressor('none')
+        if compressor.extension:
+            name = u'%s.%s' % (name, compressor.extension)
 
         path = os.path.join(settings.VZ_BACKUP_DIR, name)
+        parent = None
+        index = None
+        d_file = None
         try:
-            if self.compress == 'gz':
-                b_file = GzipFile(path, 'wb')
-            elif self.compress == 'bz2':
-                b_file = BZ2File(path, 'w')
+            if self.incremental:
+                parent = self._incremental_parent()
+                if parent is None:
+                    index = RowIndex(index_path(path), use_natural_keys=self.use_natural_keys)
+                else:
+                    index = RowIndex(index_path(path), index_path(parent.path),
+                        use_natural_keys=self.use_natural_keys)
+
+            algorithms = ['sha1']
+            if EXTRA_HASH is not None:
+                algorithms.append(EXTRA_HASH)
+            if self.deduplicate:
+                c_file = ChunkWriter(self.app_label)
+                o_file = TimedWriter(c_file, timer, 'dedup')
             else:
-                b_file = open(path, 'w')
-
-            dump = dumpdata.Command()
-            b_file.write(dump.handle(
-                    self.app_label,
-                    use_natural_keys=self.use_natural_keys,
-                    indent=INDENT,
-                    format=FORMAT))
-            b_file.close()
+                d_file = DeferredFileWriter(path, SPOOL_SIZE)
+                o_file = TimedWriter(d_file, timer, 'write')
+            if throttle is not None:
+                o_file = ThrottledWriter(o_file, throttle)
+            h_file = HashingWriter(o_file, algorithms)
+
+            b_file = TimedWriter(compressor.writer(TimedWriter(h_file, timer, 'hash'),
+                self.compress_level, self.compress_threads), timer, 'compress')
+            s_file = HashingWriter(b_file)
+
+            start = timer.start()
+            rows = self._dump(TimedWriter(s_file, timer, 'content_hash'), index, timer,
+                throttle, progress)
+            timer.stop('serialize', start, s_file.size)
+            with timer.phase('close'):
+                b_file.close()
+                if self.deduplicate:
+                    h_file.close()
+                if index is not None:
+                    index.close()
+
+            content_hash = s_file.hexdigest()
+            file_hash = h_file.hexdigest('sha1')
+            if parent is None:
+                unchanged = BackupArchive.objects.filter(Q(content_hash__exact=content_hash) |
+                    Q(file_hash__exact=file_hash), backup_object__exact=self).exists()
+            else:
+                unchanged = index.changed == 0 and index.deleted == 0
+            if unchanged:
+                if parent is None:
+                    # so the next backup is skipped without dumping
+                    BackupArchive.objects.filter(id__exact=self.get_stats().last_archive_id,
+                        content_hash__exact=content_hash).update(fingerprint=fingerprint)
+                if not self.deduplicate:
+                    d_file.discard()
+                if index is not None:
+                    os.unlink(index.path)
+                timer.finish()
+                return None
+
+            if not self.deduplicate:
+                with timer.phase('close'):
+                    h_file.close()
+
+            extra_hash = ''
+            if EXTRA_HASH is not None:
+                extra_hash = u'%s:%s' % (EXTRA_HASH, h_file.hexdigest(EXTRA_HASH))
+            kwargs = dict(
+                name=name,
+                path=path,
+                size=h_file.size,
+                file_hash=file_hash,
+                content_hash=content_hash,
+                extra_hash=extra_hash,
+                parent=parent,
+                raw_size=s_file.size,
+                rows=simplejson.dumps(rows),
+                phases=simplejson.dumps(timer.phases),
+                fingerprint=fingerprint,
+                duration=timer.stop_clock())
+            if parent is not None:
+                kwargs['depth'] = parent.depth + 1
+            if self.deduplicate:
+                archive = self._create_chunked_archive(c_file.chunks, **kwargs)
+            else:
+                archive = BackupArchive.objects.create(backup_object=self, **kwargs)
+
+        except (IOError, OSError):
+            self._discard_partial(index, d_file)
+            raise UnableToCreateArchive
+        except:
+            self._discard_partial(index, d_file)
+            raise
+        timer.finish(archive)
+        return archive
 
-            file_hash = generate_file_hash(path)
-            try:
-                ba = BackupArchive.objects.get(file_hash__exact=file_hash, backup_object__exact=self)
-                os.unlink(path)
-            except BackupArchive.DoesNotExist:
-                BackupArchive.objects.create(
-                    backup_object=self,
-                    name=name,
-                    path=path,
-                    size=os.path.getsize(path),
-                    file_hash=file_hash)
-
-        except IOError:
+
+    def _discard_partial(self, index, d_file):
+        """Remove the index and archive file a failed backup left behind."""
+        for partial in (index, d_file):
+            if partial is not None:
+                try:
+                    partial.discard()
+                except (IOError, OSError):
+                    pass
+
+
+    def _dump(self, stream, index, timer, throttle=None, progress=None):
+        """
+        Dump the app into *stream*, with worker processes when dump_workers
+        is above 1 and the dump is a full JSON one outside a snapshot.
+        Worker processes don't report their reads to *throttle*.
+        """
+        if self.dump_workers > 1 and index is None and self.format == 'json' and not self.snapshot:
+            return dump_app_parallel(self.app_label, stream, self.dump_workers,
+                indent=INDENT,
+                use_natural_keys=self.use_natural_keys,
+                progress=progress,
+                tmp_dir=settings.VZ_BACKUP_DIR,
+                throttle=throttle)
+        return dump_app(self.app_label, stream,
+            format=self.format,
+            indent=INDENT,
+            use_natural_keys=self.use_natural_keys,
+            index=index,
+            progress=progress,
+            timer=timer,
+            fetch_size=self.snapshot and FETCH_SIZE or None,
+            throttle=throttle)
+
+
+    def throttle(self, timer=None):
+        """
+        Throttle
+
+        vz_backup.throttle.Throttle holding backups of the app to its
+        write_rate and read_rate, or the global ones, and to
+        VZ_BACKUP_LATENCY_TARGET.  None when none of them is set.
+        """
+        write_rate = self.write_rate or WRITE_RATE
+        read_rate = self.read_rate or READ_RATE
+        if not write_rate and not read_rate and LATENCY_TARGET is None:
+            return None
+        return Throttle(write_rate=write_rate, read_rate=read_rate,
+            latency_target=LATENCY_TARGET,
+            batch_rows=self.snapshot and FETCH_SIZE or CHUNK_SIZE,
+            timer=timer)
+
+
+    def fingerprint(self, throttle=None):
+        """
+        Fingerprint
+
+        Cheap summary of the app's tables, and with use_natural_keys of the
+        tables whose natural keys the dump refers to, and of the settings
+        the data is serialized with, as a JSON string, see
+        vz_backup.fingerprint.  None when the tables can't be summed up.
+        The rows checksummed are reported to *throttle*, if given.
+        """
+        tables = app_fingerprint(self.app_label, use_natural_keys=self.use_natural_keys,
+            throttle=throttle)
+        if tables is None:
+            return None
+        return simplejson.dumps({
+            'settings': [self.format, self.use_natural_keys, self.incremental, self.container, INDENT],
+            'tables': tables,
+        }, sort_keys=True)
+
+
+    def _last_fingerprint(self):
+        last_archive_id = self.get_stats().last_archive_id
+        if last_archive_id is None:
+            return None
+        return BackupArchive.objects.filter(id__exact=last_archive_id).values_list(
+            'fingerprint', flat=True)[0]
+
+
+    def _backup_container(self, name, timer, fingerprint='', progress=None, throttle=None):
+        """
+        Dump the app into a new container archive named *name*, hashed
+        and throttled as it is written like other archives.  Its
+        content_hash is the hash of the member data, see write_container,
+        so an equal dump in another compression is dropped too.
+        """
+        path = os.path.join(settings.VZ_BACKUP_DIR, name)
+        algorithms = ['sha1']
+        if EXTRA_HASH is not None:
+            algorithms.append(EXTRA_HASH)
+        d_file = None
+        try:
+            start = timer.start()
+            d_file = DeferredFileWriter(path, SPOOL_SIZE)
+            o_file = TimedWriter(d_file, timer, 'write')
+            if throttle is not None:
+                o_file = ThrottledWriter(o_file, throttle)
+            h_file = HashingWriter(o_file, algorithms)
+            kwargs = dict(
+                level=self.compress_level,
+                threads=self.compress_threads,
+                workers=self.dump_workers,
+                indent=INDENT,
+                use_natural_keys=self.use_natural_keys,
+                progress=progress,
+                tmp_dir=settings.VZ_BACKUP_DIR,
+                throttle=throttle)
+            if self.snapshot:
+                # worker processes can't share the snapshot
+                kwargs['workers'] = 1
+            index = write_container(self.app_label, TimedWriter(h_file, timer, 'hash'),
+                get_compressor(self.compress), **kwargs)
+            timer.stop('serialize', start, h_file.size)
+            file_hash = h_file.hexdigest('sha1')
+            content_hash = index['content_hash']
+            if BackupArchive.objects.filter(Q(content_hash__exact=content_hash) |
+                    Q(file_hash__exact=file_hash), backup_object__exact=self).exists():
+                # so the next backup is skipped without dumping
+                BackupArchive.objects.filter(id__exact=self.get_stats().last_archive_id,
+                    content_hash__exact=content_hash).update(fingerprint=fingerprint)
+                d_file.discard()
+                return None
+            with timer.phase('close'):
+                h_file.close()
+            extra_hash = ''
+            if EXTRA_HASH is not None:
+                extra_hash = u'%s:%s' % (EXTRA_HASH, h_file.hexdigest(EXTRA_HASH))
+            rows = SortedDict()
+            for entry in index['members']:
+                rows[entry['model']] = rows.get(entry['model'], 0) + entry['count']
+            return BackupArchive.objects.create(backup_object=self, name=name, path=path,
+                size=h_file.size, file_hash=file_hash, content_hash=content_hash, extra_hash=extra_hash,
+                raw_size=sum([entry['size'] for entry in index['members']]),
+                rows=simplejson.dumps(rows), phases=simplejson.dumps(timer.phases),
+                fingerprint=fingerprint, duration=timer.stop_clock())
+        except (IOError, OSError):
+            self._discard_partial(None, d_file)
             raise UnableToCreateArchive
+        except:
+            self._discard_partial(None, d_file)
+            raise
+
+
+    def _incremental_parent(self):
+        """
+        Archive the next incremental archive builds on, None when the next
+        archive has to be a full one.
+        """
+        try:
+            last = self.last_archive
+        except IndexError:
+            return None
+        if last.depth >= self.full_every or not os.path.exists(index_path(last.path)):
+            return None
+        return last
+
+
+    @transaction.commit_on_success
+    def _create_chunked_archive(self, chunks, **kwargs):
+        """
+        Create a BackupArchive referencing *chunks*, a list of
+        (digest, size) in archive order.  The chunk references are saved
+        by the save_archive_chunks signal before maintenance tasks run.
+        """
+        archive = BackupArchive(backup_object=self, chunked=True, **kwargs)
+        archive.pending_chunks = chunks
+        archive.save()
+        return archive
+
+
+    def enqueue(self, action, archive_id=None):
+        """
+        Queue *action* for the run_backup_jobs worker.  Returns the queued
+        or running job for the same action and archive if there is one, so
+        repeated requests coalesce into a single job.  Jobs gone stale are
+        failed first, see fail_stale_jobs, and the unique pending key of
+        unfinished jobs keeps two requests from both adding one.
+        """
+        fail_stale_jobs()
+        job, created = BackupJob.objects.get_or_create(
+            pending=u'%s:%s:%s' % (self.id, action, archive_id or ''),
+            defaults={'backup_object': self, 'action': action, 'archive_id': archive_id})
+        return job
 
 
     def mail(self, which=None, fail_silently=True):
         if self.mail_to.count() > 0:
-            message = EmailMessage(
-                subject=u'%s backup manager %s'%(settings.EMAIL_SUBJECT_PREFIX, self),
-                to=self.mail_to.values_list('email', flat=True)
-            )
             if which is None:
-                ba = BackupArchive.objects.filter(backup_object=self).only('backup_object', 'path', 'created').latest()
+                ba = BackupArchive.objects.filter(backup_object=self).latest()
             else:
                 ba = BackupArchive.objects.get(id__exact=which)
+            mail_archives([ba], fail_silently=fail_silently)
+
+    def reload(self, which, labels=None, pks=None):
+        """
+        Reload
+
+        Replace the app's data with archive *which*.  An incremental archive
+        is loaded on top of the full archive and incrementals it builds on.
 
-            message.body='sha1 has for archive is: %s'%ba.file_hash
-            message.attach_file(ba.path, mimetypes.guess_type(ba.path)[0])
-            message.send()
+        JSON and MessagePack archives are read once: each is hashed while
+        it streams into the database and the whole reload is rolled back if
+        one does not match its hash, see vz_backup.restore.  Other formats
+        are checked against their hash, then reset and loaded with loaddata.
 
-    def reload(self, which):
-        ba = BackupArchive.objects.only('backup_object', 'id', 'path').get(backup_object=self, id__exact=which)
-        if ba.file_hash != generate_file_hash(ba.path):
+        Container archives can be reloaded in part: only the models of
+        *labels*, 'app_label.ModelName' labels, or of those only the rows
+        with a primary key in *pks*.
+
+        A streamed reload is timed per phase (clear, read, hash,
+        decompress, load, delete), other reloads as a whole, see
+        vz_backup.metrics.
+        """
+        timer = PhaseTimer(self, 'reload')
+        ba = BackupArchive.objects.get(backup_object=self, id__exact=which)
+        if ba.container:
+            with timer.phase('load'):
+                self._restore_container(ba, labels, pks)
+            timer.finish(ba)
+            return
+        if labels is not None or pks is not None:
+            raise ValueError('Only container archives can be reloaded in part')
+        chain = [ba]
+        while chain[0].parent_id is not None:
+            chain.insert(0, chain[0].parent)
+
+        if [archive for archive in chain if archive.format not in OBJECT_READERS]:
+            with timer.phase('load'):
+                self._reload_fixtures(chain)
+        else:
+            self._restore(chain, timer)
+        timer.finish(ba)
+
+
+    @transaction.commit_on_success
+    def _restore(self, chain, timer):
+        """
+        Delete the app's rows and stream the archives of *chain* back in,
+        hashing each while it is read.  Raises ArchiveHashesDoNotMatch,
+        rolling everything back, as soon as an archive does not match.
+        """
+        using = DEFAULT_DB_ALIAS
+        connection = connections[using]
+        defer_constraints(connection)
+        try:
+            with timer.phase('clear'):
+                clear_app(self.app_label, using=using)
+            for archive in chain:
+                h_file = HashingReader(TimedReader(archive.open(), timer, 'read'))
+                b_file = compressor_for_name(archive.name).reader(TimedReader(h_file, timer, 'hash'))
+                try:
+                    with timer.phase('load'):
+                        try:
+                            load_stream(TimedReader(b_file, timer, 'decompress'), using=using,
+                                replace=archive.parent_id is not None,
+                                use_natural_keys=self.use_natural_keys, format=archive.format)
+                        finally:
+                            # a damaged archive fails its hash, whatever broke
+                            h_file.drain()
+                            if archive.file_hash != h_file.hexdigest():
+                                raise ArchiveHashesDoNotMatch
+                finally:
+                    b_file.close()
+                if archive.parent_id is not None:
+                    reader = IndexReader(index_path(archive.path))
+                    try:
+                        with timer.phase('delete'):
+                            self._delete_rows(reader.deleted())
+                    finally:
+                        reader.close()
+        finally:
+            restore_constraints(connection)
+
+
+    @transaction.commit_on_success
+    def _restore_container(self, archive, labels=None, pks=None):
+        """
+        Restore container *archive*, or the models of *labels* and rows of
+        *pks* in it.  Every member read is checked against its zip CRC.  A
+        full restore hashes the archive while it is read, members in file
+        order, and is rolled back if it doesn't match.
+        """
+        if pks is not None and (labels is None or len(labels) != 1):
+            raise ValueError('pks need exactly one model')
+
+        using = DEFAULT_DB_ALIAS
+        connection = connections[using]
+        h_file = HashingReader(open(archive.path, 'rb'))
+        container = zipfile.ZipFile(h_file)
+        defer_constraints(connection)
+        try:
+            if labels is None:
+                clear_app(self.app_label, using=using)
+            else:
+                for label in labels:
+                    model = models.get_model(*label.split('.'))
+                    if pks is not None:
+                        pks = set([model._meta.pk.to_python(pk) for pk in pks])
+                    clear_model(model, using=using, pks=pks)
+            loader = BatchLoader(using=using, use_natural_keys=self.use_natural_keys)
+            for entry in select_members(container, labels, pks):
+                objects = iter_json_objects(open_member(container, entry))
+                if pks is not None:
+                    to_python = models.get_model(*entry['model'].split('.'))._meta.pk.to_python
+                    objects = (obj for obj in objects if to_python(obj['pk']) in pks)
+                loader.load(objects)
+            loader.finish()
+            if labels is None:
+                h_file.drain()
+                if archive.file_hash != h_file.hexdigest():
+                    raise ArchiveHashesDoNotMatch
+        finally:
+            restore_constraints(connection)
+            container.close()
+            h_file.close()
+
+
+    def _reload_fixtures(self, chain):
+        """Reload *chain* with reset and loaddata, for non JSON archives."""
+        fixtures = list()
+        try:
+            for archive in chain:
+                fixtures.append(self._fixture(archive))
+
+            call_command('reset', self.app_label, interactive=False)
+            for archive, (path, is_temp) in zip(chain, fixtures):
+                call_command('loaddata', path, verbosity=0)
+                if archive.parent_id is not None:
+                    reader = IndexReader(index_path(archive.path))
+                    try:
+                        self._delete_rows(reader.deleted())
+                    finally:
+                        reader.close()
+        finally:
+            for path, is_temp in fixtures:
+                if is_temp:
+                    os.unlink(path)
+
+
+    def _fixture(self, archive):
+        """
+        Verify *archive* and return (path, is_temp) of a fixture loaddata
+        can read.  Chunked archives and compressions loaddata does not know
+        are rebuilt into a temporary file, hashed while they are read.
+        """
+        compressor = compressor_for_name(archive.name)
+        if not archive.chunked and compressor.name in LOADDATA_COMPRESSORS:
+            if archive.file_hash != generate_file_hash(archive.path):
+                raise ArchiveHashesDoNotMatch
+            return archive.path, False
+
+        path = os.path.join(settings.VZ_BACKUP_DIR,
+            u'reload_%s.%s' % (archive.id, archive.format))
+        h_file = HashingReader(archive.open())
+        try:
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(compressor.reader(h_file), f, HASH_BUFFER_SIZE)
+            h_file.drain()
+        finally:
+            h_file.close()
+        if archive.file_hash != h_file.hexdigest():
+            os.unlink(path)
             raise ArchiveHashesDoNotMatch
+        return path, True
 
-        call_command('reset', self.app_label, interactive=False)
-        call_command('loaddata', ba.path, verbosity=0)
+
+    def _delete_rows(self, deleted):
+        """Delete rows recorded as deleted by an incremental archive."""
+        for label, pks in deleted.items():
+            app_label, model_name = label.split('.')
+            model = models.get_model(app_label, model_name)
+            for start in range(0, len(pks), CHUNK_SIZE):
+                model._default_manager.filter(pk__in=pks[start:start + CHUNK_SIZE]).delete()
 
 
 class BackupArchive(models.Model):
@@ -239,7 +919,28 @@ class BackupArchive(models.Model):
     path = models.FilePathField(path=settings.VZ_BACKUP_DIR, editable=False)
     size = models.BigIntegerField(default=0, editable=False, db_index=True)
     file_hash = models.CharField(max_length=40, editable=False, default='', null=True, blank=True, db_index=True)
+    content_hash = models.CharField(max_length=40, editable=False, default='', blank=True, db_index=True,
+        help_text='sha1 of the serialized data, before compression.')
+    extra_hash = models.CharField(max_length=140, editable=False, default='', blank=True,
+        help_text='Optional second digest, stored as "algorithm:hexdigest".')
     keep = models.BooleanField(default=False, db_index=True)
+    chunked = models.BooleanField(default=False, editable=False)
+    parent = models.ForeignKey('self', null=True, blank=True, editable=False,
+        related_name='incrementals', help_text='Archive an incremental archive builds on.')
+    depth = models.PositiveIntegerField(default=0, editable=False,
+        help_text='Number of incremental archives since the last full archive.')
+    duration = models.FloatField(blank=True, null=True, editable=False,
+        help_text='Seconds the backup took.')
+    raw_size = models.BigIntegerField(blank=True, null=True, editable=False,
+        help_text='Size before compression.')
+    rows = models.TextField(blank=True, default='', editable=False,
+        help_text='Rows dumped per model, as JSON.')
+    phases = models.TextField(blank=True, default='', editable=False,
+        help_text='Seconds and bytes of each backup phase, as JSON.')
+    fingerprint = models.TextField(blank=True, default='', editable=False,
+        help_text='Summary of the app tables when the backup started, as JSON.')
+    last_verified = models.DateTimeField(blank=True, null=True, editable=False, db_index=True,
+        help_text='When verify_archives last found the archive intact.')
     edited = models.DateTimeField(blank=True, auto_now=True, editable=False)
     created = models.DateTimeField(blank=True, auto_now_add=True, editable=False)
 
@@ -249,14 +950,539 @@ class BackupArchive(models.Model):
         get_latest_by = 'created'
 
 
+    def __init__(self, *args, **kwargs):
+        super(BackupArchive, self).__init__(*args, **kwargs)
+        # keep as loaded, None when deferred
+        self.saved_keep = self.__dict__.get('keep')
+
+
     def __unicode__(self):
         return u"%s on %s" % (self.backup_object, self.created.isoformat())
 
 
-def backup_all():
-    bs = BackupObject.objects.filter(include=True).all()
-    for b in bs:
-        b.backup()
+    def stats_saved(self, created):
+        """Update BackupStats after this archive was saved."""
+        bo = BackupObject(id=self.backup_object_id)
+        if created:
+            unkept_size = self.keep and 0 or self.size
+            bo.update_stats(archives_size=self.size, unkept_archives_size=unkept_size,
+                number_of_archives=1, kept_archives=self.keep and 1 or 0)
+            BackupStats.objects.filter(backup_object=bo).update(
+                last_archive_id=self.id, last_archive_time=self.created)
+        elif self.saved_keep is None:
+            bo.recompute_stats()
+        elif self.saved_keep != self.keep:
+            sign = self.keep and 1 or -1
+            bo.update_stats(unkept_archives_size=-sign * self.size, kept_archives=sign)
+        self.saved_keep = self.keep
+
+
+    def stats_deleted(self):
+        """
+        Update BackupStats after this archive was deleted.  Nothing is done
+        when the backup object or its statistics are gone, as when they are
+        deleted with it.
+        """
+        if not BackupObject.objects.filter(id=self.backup_object_id).exists():
+            return
+        bo = BackupObject(id=self.backup_object_id)
+        unkept_size = self.keep and 0 or self.size
+        bo.update_stats(create=False, archives_size=-self.size, unkept_archives_size=-unkept_size,
+            number_of_archives=-1, kept_archives=self.keep and -1 or 0)
+        if BackupStats.objects.filter(backup_object=bo, last_archive_id=self.id).exists():
+            bo._update_last_archive()
+
+
+    @property
+    def container(self):
+        """Is this a container archive?"""
+        return self.name.endswith('.' + CONTAINER_EXTENSION)
+
+
+    @property
+    def format(self):
+        """Serialization format, from the archive name."""
+        name = self.name
+        if self.container:
+            name = name[:-len(CONTAINER_EXTENSION) - 1]
+        extension = compressor_for_name(name).extension
+        if extension:
+            name = name[:-len(extension) - 1]
+        return os.path.splitext(name)[1][1:]
+
+
+    @property
+    def row_counts(self):
+        """(model label, rows) pairs dumped into this archive."""
+        if not self.rows:
+            return []
+        return sorted(simplejson.loads(self.rows).items())
+
+
+    @property
+    def throughput(self):
+        """
+        (bytes, rows) a second the backup reached, from raw_size, rows
+        and duration.  None for archives without them.
+        """
+        if not self.duration or self.raw_size is None:
+            return None
+        return (self.raw_size / self.duration,
+            sum([count for label, count in self.row_counts]) / self.duration)
+
+
+    @property
+    def phase_times(self):
+        """(phase, seconds, bytes) of the backup, slowest phase first."""
+        if not self.phases:
+            return []
+        return sorted([(phase, totals['seconds'], totals['bytes'])
+            for phase, totals in simplejson.loads(self.phases).items()],
+            key=lambda phase: -phase[1])
+
+
+    def save_chunks(self, chunks):
+        """
+        Save references to *chunks*, a list of (digest, size) in archive
+        order, creating Chunk rows for chunks new to this app.
+        """
+        digests = set(digest for digest, size in chunks)
+        known = dict(Chunk.objects.filter(backup_object=self.backup_object,
+            digest__in=digests).values_list('digest', 'id'))
+        offset = 0
+        for position, (digest, size) in enumerate(chunks):
+            if digest not in known:
+                known[digest] = Chunk.objects.create(backup_object=self.backup_object,
+                    digest=digest, size=size).id
+            ArchiveChunk.objects.create(archive=self, chunk_id=known[digest],
+                position=position, offset=offset)
+            offset = offset + size
+
+
+    def open(self, offset=0):
+        """
+        Open the archive file for reading in binary mode, positioned at
+        *offset*.  Chunked archives are rebuilt from their chunks while
+        being read, starting with the chunk that holds *offset*.
+        """
+        if self.chunked:
+            references = self.archivechunk_set.order_by('position')
+            skip = offset
+            if offset:
+                try:
+                    position, chunk_offset = references.filter(offset__lte=offset).order_by(
+                        '-position').values_list('position', 'offset')[0]
+                except IndexError:
+                    position, chunk_offset = 0, 0
+                references = references.filter(position__gte=position)
+                skip = offset - chunk_offset
+            digests = references.values_list('chunk__digest', flat=True)
+            reader = ChunkReader(self.backup_object.app_label, digests.iterator())
+            if skip:
+                reader.read(skip)
+            return reader
+        b_file = open(self.path, 'rb')
+        if offset:
+            b_file.seek(offset)
+        return b_file
+
+
+class BackupStats(models.Model):
+    """
+    Backup Stats
+
+    Running archive totals of a BackupObject, updated as archives are
+    created, deleted, kept or unkept.  Kept apart from BackupObject so
+    saving a BackupObject never writes stale totals.
+    """
+
+    backup_object = models.OneToOneField(BackupObject, primary_key=True,
+        related_name='stats', editable=False)
+    archives_size = models.BigIntegerField(default=0, editable=False)
+    unkept_archives_size = models.BigIntegerField(default=0, editable=False)
+    number_of_archives = models.IntegerField(default=0, editable=False)
+    kept_archives = models.IntegerField(default=0, editable=False)
+    last_archive_id = models.IntegerField(blank=True, null=True, editable=False)
+    last_archive_time = models.DateTimeField(blank=True, null=True, editable=False)
+
+
+    def __unicode__(self):
+        return u'%s stats' % self.backup_object_id
+
+
+class Chunk(models.Model):
+    """
+    Chunk
+
+    A piece of archive data stored once per app in the chunk store and
+    shared by every deduplicated archive containing it.
+    """
+
+    backup_object = models.ForeignKey(BackupObject, editable=False)
+    digest = models.CharField(max_length=40, editable=False)
+    size = models.BigIntegerField(default=0, editable=False)
+    created = models.DateTimeField(blank=True, auto_now_add=True, editable=False)
+
+
+    class Meta:
+        unique_together = (('backup_object', 'digest'), )
+
+
+    def __unicode__(self):
+        return self.digest
+
+
+class ArchiveChunk(models.Model):
+    """Position of a Chunk in a deduplicated BackupArchive"""
+
+    archive = models.ForeignKey(BackupArchive, editable=False)
+    chunk = models.ForeignKey(Chunk, editable=False)
+    position = models.PositiveIntegerField(editable=False)
+    offset = models.BigIntegerField(default=0, editable=False)
+
+
+    class Meta:
+        ordering = ['position']
+        unique_together = (('archive', 'position'), )
+
+
+class BackupJob(models.Model):
+    """
+    Backup Job
+
+    A backup, prune, mail or reload of a BackupObject queued from the
+    admin and run by the run_backup_jobs worker, or the maintenance of a
+    new archive queued by a backup job.  *archive_id* is the archive
+    mailed, reloaded or maintained.  *pending* is a key unique to the backup
+    object, action and archive while the job is queued or running, None
+    once it finished, and *heartbeat* when a running job last reported
+    progress.
+    """
+
+    backup_object = models.ForeignKey(BackupObject, editable=False)
+    action = models.CharField(max_length=10, choices=JOB_ACTION_CHOICES, editable=False)
+    archive_id = models.IntegerField(blank=True, null=True, editable=False)
+    status = models.CharField(max_length=10, choices=JOB_STATUS_CHOICES,
+        default='queued', db_index=True, editable=False)
+    progress = models.CharField(max_length=255, blank=True, editable=False)
+    result = models.CharField(max_length=255, blank=True, editable=False)
+    error = models.TextField(blank=True, editable=False)
+    duration = models.FloatField(blank=True, null=True, editable=False)
+    queued = models.DateTimeField(auto_now_add=True, editable=False)
+    started = models.DateTimeField(blank=True, null=True, editable=False)
+    finished = models.DateTimeField(blank=True, null=True, editable=False)
+    heartbeat = models.DateTimeField(blank=True, null=True, editable=False)
+    pending = models.CharField(max_length=64, unique=True, blank=True, null=True, editable=False)
+
+
+    class Meta:
+        ordering = ['-queued']
+        get_latest_by = 'queued'
+
+
+    def __unicode__(self):
+        return u"%s %s" % (self.get_action_display(), self.backup_object)
+
+
+    def set_progress(self, progress):
+        """Record *progress* where the admin can see it while running."""
+        self.progress = progress[:255]
+        self.heartbeat = datetime.datetime.now()
+        BackupJob.objects.filter(id=self.id).update(progress=self.progress,
+            heartbeat=self.heartbeat)
+
+
+    def claim(self):
+        """
+        Mark a queued job running.  False if another worker was first.
+        """
+        self.started = datetime.datetime.now()
+        self.heartbeat = self.started
+        claimed = BackupJob.objects.filter(id=self.id, status='queued').update(
+            status='running', started=self.started, heartbeat=self.heartbeat)
+        if claimed:
+            self.status = 'running'
+        return bool(claimed)
+
+
+    def run(self):
+        """
+        Run the job and record its result, error and duration.  Never
+        raises so a failing job does not stop the worker.
+
+        Maintenance of a new archive is deferred to a queued maintain
+        job, which the worker runs in batches, see run_maintenance_jobs,
+        and which outlives the worker if it is stopped.
+        """
+        start = time.time()
+        bo = self.backup_object
+        try:
+            if self.action == 'backup':
+                defer_maintenance()
+                try:
+                    ba = bo.backup(progress=lambda model: self.set_progress(
+                        u'dumping %s' % model._meta.object_name))
+                finally:
+                    for archive_id in deferred_archives():
+                        bo.enqueue('maintain', archive_id)
+                if ba is None:
+                    self.result = bo.skipped and u'skipped, no changes' or u'unchanged'
+                else:
+                    self.result = u'archive %s, %d bytes' % (ba.id, ba.size)
+                    if ba.throughput is not None:
+                        self.result = u'%s, %.2f MB/s, %d rows/s' % (self.result,
+                            ba.throughput[0] / (1024 * 1024), ba.throughput[1])
+            elif self.action == 'prune':
+                ids, size = bo.prune()
+                self.result = u'pruned %d archives, %d bytes' % (len(ids), size)
+            elif self.action == 'mail':
+                bo.mail(self.archive_id, fail_silently=False)
+                self.result = u'mailed'
+            elif self.action == 'reload':
+                bo.reload(self.archive_id)
+                self.result = u'reloaded'
+            elif self.action == 'maintain':
+                sent = run_maintenance([self.archive_id], fail_silently=False)
+                self.result = u'%d mails' % sent
+            self.status = 'done'
+        except Exception, e:
+            self.status = 'failed'
+            self.error = u'%s: %s' % (e.__class__.__name__, e)
+        self.duration = time.time() - start
+        self.finished = datetime.datetime.now()
+        self.pending = None
+        BackupJob.objects.filter(id=self.id).update(status=self.status,
+            result=self.result, error=self.error, duration=self.duration,
+            finished=self.finished, pending=None)
+
+
+def fail_stale_jobs(timeout=JOB_TIMEOUT):
+    """
+    Fail Stale Jobs
+
+    Mark failed the running jobs that reported no progress for *timeout*
+    seconds, VZ_BACKUP_JOB_TIMEOUT by default, left behind by a worker
+    that died, so they no longer hold back new jobs for the same action.
+    Backups of apps with snapshot on are never failed: their progress is
+    written inside the snapshot transaction, which other workers don't
+    see until it commits.  Returns the number of jobs failed.
+    """
+    now = datetime.datetime.now()
+    cutoff = now - datetime.timedelta(seconds=timeout)
+    return BackupJob.objects.filter(status='running').exclude(action='backup',
+        backup_object__snapshot=True).filter(Q(heartbeat__lt=cutoff) |
+        Q(heartbeat__isnull=True, started__lt=cutoff)).update(status='failed',
+        error=u'Stale: no progress for %d seconds, the worker was stopped' % timeout,
+        finished=now, pending=None)
+
+
+def next_job():
+    """
+    Claim the oldest queued BackupJob, None when the queue is empty.
+    Maintain jobs are left for run_maintenance_jobs.  Stale running jobs
+    are failed first, see fail_stale_jobs.
+    """
+    fail_stale_jobs()
+    while True:
+        try:
+            job = BackupJob.objects.filter(status='queued').exclude(action='maintain').order_by(
+                'queued', 'id')[0]
+        except IndexError:
+            return None
+        if job.claim():
+            return job
+
+
+def _bulk_delete(model, field_name, values):
+    """
+    Delete rows of *model* whose *field_name* is in *values* with plain
+    DELETE statements: no objects are loaded and no signals are sent.
+    Must run under transaction management.
+    """
+    connection = connections[router.db_for_write(model)]
+    qn = connection.ops.quote_name
+    column = model._meta.get_field(field_name).column
+    cursor = connection.cursor()
+    for start in range(0, len(values), DELETE_BATCH_SIZE):
+        batch = values[start:start + DELETE_BATCH_SIZE]
+        cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (qn(model._meta.db_table),
+            qn(column), ', '.join(['%s'] * len(batch))), batch)
+    transaction.set_dirty()
+
+
+@transaction.commit_on_success
+def _delete_archive_rows(ids):
+    _bulk_delete(ArchiveChunk, 'archive', ids)
+    _bulk_delete(BackupArchive, 'id', ids)
+
+
+def _archive_message(archives, to):
+    """
+    One mail to *to* with every archive of *archives*.  Archives larger
+    than MAIL_MAX_SIZE are linked to instead of attached.
+    """
+    labels = SortedDict((ba.backup_object.app_label, None) for ba in archives)
+    message = EmailMessage(
+        subject=u'%s backup manager %s'%(settings.EMAIL_SUBJECT_PREFIX, u', '.join(labels.keys())),
+        to=to
+    )
+    body = []
+    for ba in archives:
+        body.append(u'%s: sha1 hash for archive is: %s' % (ba.name, ba.file_hash))
+        if MAIL_MAX_SIZE is not None and ba.size > MAIL_MAX_SIZE:
+            body.append(u'download: %s%s' % (BASE_URL,
+                reverse('admin:vz_backup_download_archive', args=(ba.id, ))))
+            continue
+        b_file = ba.open()
+        try:
+            message.attach(ba.name, b_file.read(), mimetypes.guess_type(ba.name)[0])
+        finally:
+            b_file.close()
+    message.body = u'\n'.join(body)
+    return message
+
+
+def mail_archives(archives, fail_silently=True):
+    """
+    Mail Archives
+
+    Send *archives* to the mail_to users of their BackupObjects.  Every
+    recipient gets one mail holding all of their archives, recipients of
+    the same archives share it, and all mails go out over one connection.
+    Building and sending the mails are timed, see vz_backup.metrics.
+    Returns the number of mails sent.
+    """
+    archives = list(archives)
+    bobjs = set([ba.backup_object for ba in archives])
+    timer = PhaseTimer(len(bobjs) == 1 and bobjs.pop() or None, 'mail')
+    start = timer.start()
+    by_email = SortedDict()
+    for ba in archives:
+        for email in ba.backup_object.mail_to.values_list('email', flat=True):
+            by_email.setdefault(email, []).append(ba)
+    groups = SortedDict()
+    for email, email_archives in by_email.items():
+        key = tuple([ba.id for ba in email_archives])
+        groups.setdefault(key, (email_archives, []))[1].append(email)
+    messages = [_archive_message(group_archives, to) for group_archives, to in groups.values()]
+    timer.stop('build', start, sum([ba.size for ba in archives]))
+    if messages:
+        with timer.phase('send'):
+            get_connection(fail_silently=fail_silently).send_messages(messages)
+        timer.finish(len(archives) == 1 and archives[0] or None)
+    return len(messages)
+
+
+def run_maintenance(archive_ids, fail_silently=True):
+    """
+    Run Maintenance
+
+    The deferred part of maintenance_tasks for a batch of new archives:
+    prune each auto_prune BackupObject once, then mail the archives that
+    are left with mail_archives.
+    """
+    bobjs = BackupObject.objects.filter(backuparchive__id__in=archive_ids, auto_prune=True).distinct()
+    for bo in bobjs:
+        bo.prune()
+    archives = BackupArchive.objects.filter(id__in=archive_ids).select_related(
+        'backup_object').order_by('backup_object', 'created')
+    return mail_archives(archives, fail_silently=fail_silently)
+
+
+def run_maintenance_jobs():
+    """
+    Run Maintenance Jobs
+
+    Claim every queued maintain job and run maintenance for their
+    archives as one batch, see run_maintenance.  The jobs share the
+    result, error and duration of the batch.  Returns the jobs run.
+    """
+    jobs = [job for job in BackupJob.objects.filter(status='queued', action='maintain').order_by(
+        'queued', 'id') if job.claim()]
+    if not jobs:
+        return jobs
+    start = time.time()
+    status, result, error = 'done', u'', u''
+    try:
+        sent = run_maintenance([job.archive_id for job in jobs], fail_silently=False)
+        result = u'%d archives, %d mails' % (len(jobs), sent)
+    except Exception, e:
+        status = 'failed'
+        error = u'%s: %s' % (e.__class__.__name__, e)
+        transaction.rollback_unless_managed()
+    duration = time.time() - start
+    finished = datetime.datetime.now()
+    BackupJob.objects.filter(id__in=[job.id for job in jobs]).update(status=status,
+        result=result, error=error, duration=duration, finished=finished, pending=None)
+    for job in jobs:
+        job.status, job.result, job.error = status, result, error
+        job.duration, job.finished, job.pending = duration, finished, None
+    return jobs
+
+
+def _backup_one(backup_object_id):
+    """
+    Backup one BackupObject and report how it went.  Never raises so one
+    failing app does not stop the others.
+    """
+    result = {'id': backup_object_id, 'app_label': None, 'status': 'failed',
+        'duration': 0.0, 'bytes': 0, 'error': None, 'archive': None, 'throughput': None}
+    start = time.time()
+    defer_maintenance()
+    try:
+        bo = BackupObject.objects.get(id__exact=backup_object_id)
+        result['app_label'] = bo.app_label
+        ba = bo.backup()
+        if ba is None:
+            result['status'] = bo.skipped and 'skipped' or 'unchanged'
+        else:
+            result['status'] = 'ok'
+            result['bytes'] = ba.size
+            result['archive'] = ba.id
+            result['throughput'] = ba.throughput
+    except Exception, e:
+        result['error'] = u'%s: %s' % (e.__class__.__name__, e)
+        # a failed query must not leave the connection aborted for the
+        # next app
+        transaction.rollback_unless_managed()
+    deferred_archives()
+    result['duration'] = time.time() - start
+    return result
+
+
+def backup_all(workers=1):
+    """
+    Backup All
+
+    Backup every included BackupObject, *workers* at a time.  With more
+    than one worker backups run in a process pool, each process using its
+    own DB connection.  Returns one result dict per app with app_label,
+    status ('ok', 'skipped' when the fingerprint showed no changes,
+    'unchanged' when the dump did, or 'failed'), duration, bytes, error,
+    the new archive id and its throughput.
+
+    Pruning and mailing wait until every app is backed up and then run
+    as one batch, see run_maintenance.
+    """
+    ids = list(BackupObject.objects.filter(include=True).values_list('id', flat=True))
+    if workers > 1 and len(ids) > 1:
+        for connection in connections.all():
+            connection.close()
+        pool = multiprocessing.Pool(min(workers, len(ids)), init_worker)
+        try:
+            results = pool.map(_backup_one, ids)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_backup_one(id) for id in ids]
+    run_maintenance([result['archive'] for result in results if result['archive'] is not None])
+    return results
 
 pre_delete.connect(unlink_archive, sender=BackupArchive)
+post_delete.connect(collect_chunks, sender=BackupArchive)
+post_delete.connect(update_stats_on_delete, sender=BackupArchive)
+post_save.connect(update_stats_on_save, sender=BackupArchive)
+post_save.connect(save_archive_chunks, sender=BackupArchive)
 post_save.connect(maintenance_tasks, sender=BackupArchive)
+action_timed.connect(record_metrics)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+MessagePack serializer
+
+Compact binary fixture format: one MessagePack map per object, with the
+layout the python serializer gives it, written back to back so objects
+can be read one at a time.  Dates, times and decimals are stored as the
+strings DjangoJSONEncoder makes of them.  Needs msgpack, registered as
+the 'msgpack' serialization format by vz_backup.models when installed.
+"""
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.serializers.python import Deserializer as PythonDeserializer
+from django.core.serializers.python import Serializer as PythonSerializer
+from django.utils.encoding import smart_unicode
+
+import msgpack
+
+from StringIO import StringIO
+
+
+class Serializer(PythonSerializer):
+    """
+    MessagePack Serializer
+
+    Writes each object to the stream as soon as it is serialized.
+    """
+
+    internal_use_only = False
+
+    def start_serialization(self):
+        self._current = None
+        self._default = DjangoJSONEncoder().default
+
+    def end_serialization(self):
+        pass
+
+    def end_object(self, obj):
+        self.stream.write(msgpack.packb({
+            'model': smart_unicode(obj._meta),
+            'pk': smart_unicode(obj._get_pk_val(), strings_only=True),
+            'fields': self._current,
+        }, default=self._default, use_bin_type=True))
+        self._current = None
+
+    def getvalue(self):
+        if callable(getattr(self.stream, 'getvalue', None)):
+            return self.stream.getvalue()
+
+
+def iter_objects(stream):
+    """Yield the objects read from *stream* one by one, as python dicts."""
+    return msgpack.Unpacker(stream, raw=False)
+
+
+def Deserializer(stream_or_string, **options):
+    """Deserialize a stream or string of MessagePack data."""
+    if isinstance(stream_or_string, basestring):
+        stream = StringIO(stream_or_string)
+    else:
+        stream = stream_or_string
+    for obj in PythonDeserializer(iter_objects(stream), **options):
+        yield obj
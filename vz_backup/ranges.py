@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Byte ranges
+
+Parsing of HTTP Range headers and the response bodies download_archive
+sends for them.
+"""
+
+import mimetools
+import re
+
+BLOCK_SIZE = 64 * 1024
+
+RANGE_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def parse_range(header, size):
+    """
+    Parse Range
+
+    Byte ranges of the Range *header* as (first, last) pairs, both
+    inclusive, clipped to a file of *size* bytes.  None when there is no
+    header or it can't be parsed (the whole file is sent), an empty list
+    when none of the ranges can be satisfied.
+    """
+    if not header:
+        return None
+    unit, sep, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not sep:
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        if not spec.strip():
+            continue
+        match = RANGE_RE.match(spec)
+        if match is None:
+            return None
+        first, last = match.groups()
+        if not first and not last:
+            return None
+        if not first:
+            # suffix range, the last *last* bytes
+            first, last = max(size - int(last), 0), size - 1
+            if last < first:
+                continue
+        else:
+            first = int(first)
+            if last and int(last) < first:
+                return None
+            if first >= size:
+                continue
+            last = last and min(int(last), size - 1) or size - 1
+        ranges.append((first, last))
+    return ranges
+
+
+class ArchiveRanges(object):
+    """
+    Archive Ranges
+
+    Iterable response body holding *ranges* of *archive*.  A single
+    range is sent as is, several ranges as a multipart/byteranges body
+    whose *content_type* parts are separated by *boundary*.  Only the
+    archive bytes that are sent are read.
+    """
+
+    def __init__(self, archive, ranges, content_type='application/octet-stream', boundary=None):
+        self.archive = archive
+        self.ranges = ranges
+        self.size = archive.size
+        if len(ranges) > 1 and boundary is None:
+            boundary = mimetools.choose_boundary()
+        self.boundary = boundary
+        self.content_type = content_type
+
+    def _part_header(self, first, last):
+        return '\r\n--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+            self.boundary, self.content_type, first, last, self.size)
+
+    def _closing(self):
+        return '\r\n--%s--\r\n' % self.boundary
+
+    @property
+    def multipart(self):
+        return len(self.ranges) > 1
+
+    def __len__(self):
+        length = sum([last - first + 1 for first, last in self.ranges])
+        if self.multipart:
+            length = length + sum([len(self._part_header(first, last))
+                for first, last in self.ranges]) + len(self._closing())
+        return length
+
+    def __iter__(self):
+        for first, last in self.ranges:
+            if self.multipart:
+                yield self._part_header(first, last)
+            b_file = self.archive.open(first)
+            try:
+                remaining = last - first + 1
+                while remaining > 0:
+                    data = b_file.read(min(BLOCK_SIZE, remaining))
+                    if not data:
+                        break
+                    remaining = remaining - len(data)
+                    yield data
+            finally:
+                b_file.close()
+        if self.multipart:
+            yield self._closing()
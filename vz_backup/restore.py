@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming restore
+
+Loads JSON and MessagePack archives back into the database without reading them whole:
+objects are parsed from the stream one at a time and written per model
+with batched INSERTs, instead of one save() per object like loaddata.
+Everything runs inside the caller's transaction, so a failed restore
+leaves the old data in place.
+"""
+
+from django.core.management.color import no_style
+from django.core.serializers.python import Deserializer as PythonDeserializer
+from django.db import connections, models, router, transaction, DEFAULT_DB_ALIAS
+from django.utils import simplejson
+
+from vz_backup.dump import CHUNK_SIZE, app_models
+
+import codecs
+import re
+
+try:
+    from vz_backup.msgpack_serializer import iter_objects as iter_msgpack_objects
+except ImportError:
+    iter_msgpack_objects = None
+
+READ_SIZE = 64 * 1024
+
+SKIP_RE = re.compile(r'[\s,\[\]]*')
+
+
+def iter_json_objects(stream, read_size=READ_SIZE):
+    """
+    Iter JSON Objects
+
+    Yield the elements of the JSON array read from *stream* one by one,
+    parsing each as soon as it has been read.  Only the element being
+    parsed is held in memory.
+    """
+    decoder = simplejson.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = u''
+    pos = 0
+    eof = False
+    while True:
+        pos = SKIP_RE.match(buffer, pos).end()
+        if pos < len(buffer):
+            try:
+                obj, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # element cut off at the end of the buffer
+                if eof:
+                    raise
+            else:
+                yield obj
+                continue
+        elif eof:
+            return
+        data = stream.read(read_size)
+        eof = not data
+        buffer = buffer[pos:] + utf8.decode(data, eof)
+        pos = 0
+
+
+# fixture formats that can be read one object at a time
+OBJECT_READERS = {'json': iter_json_objects}
+if iter_msgpack_objects is not None:
+    OBJECT_READERS['msgpack'] = iter_msgpack_objects
+
+
+def defer_constraints(connection):
+    """
+    Check foreign keys at commit instead of after every statement, so
+    rows can be inserted before the rows they point to.
+    """
+    engine = connection.settings_dict['ENGINE']
+    cursor = connection.cursor()
+    if 'postgresql' in engine:
+        cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+    elif 'mysql' in engine:
+        cursor.execute('SET foreign_key_checks = 0')
+
+
+def restore_constraints(connection):
+    if 'mysql' in connection.settings_dict['ENGINE']:
+        connection.cursor().execute('SET foreign_key_checks = 1')
+
+
+def clear_model(model, using=DEFAULT_DB_ALIAS, pks=None):
+    """
+    Delete the rows of *model*, or those with a primary key in *pks*, and
+    their many to many rows.  Must run under transaction management.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    where, params = '', []
+    if pks is not None:
+        pks = list(pks)
+        where = ' WHERE %%(column)s IN (%s)' % ', '.join(['%%s'] * len(pks))
+        params = [model._meta.pk.get_db_prep_value(pk, connection=connection) for pk in pks]
+    for field in model._meta.local_many_to_many:
+        if field.rel.through._meta.auto_created:
+            cursor.execute('DELETE FROM %s%s' % (qn(field.m2m_db_table()),
+                where % {'column': qn(field.m2m_column_name())}), params)
+    cursor.execute('DELETE FROM %s%s' % (qn(model._meta.db_table),
+        where % {'column': qn(model._meta.pk.column)}), params)
+    transaction.set_dirty(using=using)
+
+
+def clear_app(app_label, using=DEFAULT_DB_ALIAS):
+    """
+    Delete every row of *app_label*'s models and their many to many
+    tables, dependent models first.  Unlike reset no table is dropped, so
+    it is undone by a rollback.  Must run under transaction management.
+    """
+    for model in reversed(app_models(app_label, using)):
+        clear_model(model, using)
+
+
+class BatchLoader(object):
+    """
+    Batch Loader
+
+    Writes fixture objects with one executemany INSERT per
+    *batch_size* objects of a model, many to many rows likewise.  With
+    *replace* on, rows with the same primary key are deleted first, so
+    objects that changed since an earlier archive can be loaded on top of
+    it.  Must run under transaction management.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS, batch_size=CHUNK_SIZE, replace=False,
+            use_natural_keys=False):
+        self.using = using
+        self.connection = connections[using]
+        self.batch_size = batch_size
+        self.replace = replace
+        self.use_natural_keys = use_natural_keys
+        self.label = None
+        self.flush_each = False
+        self.batch = []
+        self.models = set()
+        self.count = 0
+
+    def load(self, objects):
+        """
+        Load every object of *objects*, dicts as read from a JSON fixture.
+        Objects are deserialized batch by batch, after the batches before
+        them are written, so natural keys can be looked up.
+        """
+        for obj in objects:
+            if obj['model'] != self.label:
+                # objects of a model may refer to those of the one before
+                self.flush()
+                self.label = obj['model']
+                model = models.get_model(*self.label.split('.'))
+                # the next object of a model referring to itself may refer
+                # to this one by natural key
+                self.flush_each = self.use_natural_keys and model is not None and [
+                    f for f in model._meta.local_fields if f.rel and f.rel.to is model] != []
+            self.batch.append(obj)
+            if len(self.batch) >= self.batch_size or self.flush_each:
+                self.flush()
+        self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        batch = list(PythonDeserializer(self.batch, using=self.using))
+        self.batch = []
+        model = batch[0].object.__class__
+        if not router.allow_syncdb(self.using, model):
+            return
+        self.models.add(model)
+        opts = model._meta
+        qn = self.connection.ops.quote_name
+        cursor = self.connection.cursor()
+        pks = [obj.object._get_pk_val() for obj in batch]
+
+        if self.replace:
+            cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (qn(opts.db_table),
+                qn(opts.pk.column), ', '.join(['%s'] * len(pks))), pks)
+
+        fields = opts.local_fields
+        cursor.executemany('INSERT INTO %s (%s) VALUES (%s)' % (qn(opts.db_table),
+            ', '.join([qn(f.column) for f in fields]), ', '.join(['%s'] * len(fields))),
+            [[f.get_db_prep_save(getattr(obj.object, f.attname), connection=self.connection)
+                for f in fields] for obj in batch])
+
+        for field in opts.local_many_to_many:
+            if not field.rel.through._meta.auto_created:
+                continue
+            table = qn(field.m2m_db_table())
+            column, reverse_column = qn(field.m2m_column_name()), qn(field.m2m_reverse_name())
+            if self.replace:
+                cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (table, column,
+                    ', '.join(['%s'] * len(pks))), pks)
+            related_pk = field.rel.to._meta.pk
+            rows = [(obj.object._get_pk_val(), related_pk.get_db_prep_save(related_pk.to_python(value),
+                connection=self.connection)) for obj in batch
+                for value in obj.m2m_data.get(field.name, ())]
+            if rows:
+                cursor.executemany('INSERT INTO %s (%s, %s) VALUES (%%s, %%s)' % (table,
+                    column, reverse_column), rows)
+
+        transaction.set_dirty(using=self.using)
+        self.count = self.count + len(batch)
+
+    def finish(self):
+        """Reset sequences so new rows don't collide with loaded keys."""
+        self.flush()
+        if self.models:
+            cursor = self.connection.cursor()
+            for sql in self.connection.ops.sequence_reset_sql(no_style(), list(self.models)):
+                cursor.execute(sql)
+
+
+def load_stream(stream, using=DEFAULT_DB_ALIAS, batch_size=CHUNK_SIZE, replace=False,
+        use_natural_keys=False, format='json'):
+    """
+    Load Stream
+
+    Load the *format* fixture read from *stream* with a BatchLoader, one
+    of the formats in OBJECT_READERS.  Returns the number of objects
+    loaded.  Must run under transaction management.
+    """
+    loader = BatchLoader(using=using, batch_size=batch_size, replace=replace,
+        use_natural_keys=use_natural_keys)
+    loader.load(OBJECT_READERS[format](stream))
+    loader.finish()
+    return loader.count
@@ -1,17 +1,63 @@
 # -*- coding: utf-8 -*-
 
+from django.core.exceptions import ObjectDoesNotExist
 from django.db.models.signals import post_save, post_syncdb
+from django.dispatch import Signal
 from vz_backup.exceptions import UnableToDeleteArchive
+from vz_backup.incremental import index_path
 
 import os
+import threading
+
+_maintenance = threading.local()
+
+# sent by vz_backup.metrics.PhaseTimer once a backup, prune, mail or
+# reload is done: phase_timed once per phase, then action_timed
+phase_timed = Signal(providing_args=['backup_object', 'action', 'phase', 'seconds', 'bytes'])
+action_timed = Signal(providing_args=['backup_object', 'action', 'duration', 'phases', 'archive'])
+
+def defer_maintenance():
+    """Collect new archives instead of running maintenance_tasks for them,
+    until deferred_archives is called"""
+    _maintenance.deferred = []
+
+def deferred_archives():
+    """Stop deferring maintenance, returns ids of the archives collected"""
+    deferred = getattr(_maintenance, 'deferred', None) or []
+    _maintenance.deferred = None
+    return deferred
 
 def maintenance_tasks(sender, instance, created, **kwargs):
+    """Maintenance Tasks
+
+    post_save signal
+    sender is BackupArchive
+
+    prunes and mails after a new BackupArchive, unless maintenance is
+    deferred, then the archive is left for run_maintenance"""
     if created:
+        deferred = getattr(_maintenance, 'deferred', None)
+        if deferred is not None:
+            deferred.append(instance.id)
+            return
         bo = instance.backup_object
         if bo.auto_prune:
             bo.prune()
         bo.mail()
 
+def save_archive_chunks(sender, instance, created, **kwargs):
+    """Save Archive Chunks
+
+    post_save signal
+    sender is BackupArchive
+
+    saves chunk references of a new deduplicated BackupArchive, before
+    maintenance_tasks gets to see it"""
+    chunks = getattr(instance, 'pending_chunks', None)
+    if created and chunks is not None:
+        instance.save_chunks(chunks)
+        instance.pending_chunks = None
+
 def unlink_archive(sender, instance, **kwargs):
     """Unlink Archive
     
@@ -19,7 +65,44 @@ def unlink_archive(sender, instance, **kwargs):
     sender is BackupArchive
     
     unlinks file after a BackupArhive object has been deleted"""
+    if os.path.exists(index_path(instance.path)):
+        os.unlink(index_path(instance.path))
+    if instance.chunked:
+        return
     try:
         os.unlink(instance.path)
     except IOError:
         raise UnableToDeleteArchive
+
+def collect_chunks(sender, instance, **kwargs):
+    """Collect Chunks
+
+    post_delete signal
+    sender is BackupArchive
+
+    removes chunks no longer referenced once a deduplicated BackupArchive
+    has been deleted"""
+    if instance.chunked:
+        try:
+            bo = instance.backup_object
+        except ObjectDoesNotExist:
+            return
+        bo.collect_chunks()
+
+def update_stats_on_save(sender, instance, created, **kwargs):
+    """Update Stats On Save
+
+    post_save signal
+    sender is BackupArchive
+
+    keeps BackupStats totals in line with new, kept and unkept archives"""
+    instance.stats_saved(created)
+
+def update_stats_on_delete(sender, instance, **kwargs):
+    """Update Stats On Delete
+
+    post_delete signal
+    sender is BackupArchive
+
+    takes a deleted BackupArchive out of BackupStats totals"""
+    instance.stats_deleted()
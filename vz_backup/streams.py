@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+File-like wrappers used while writing and reading backup archives.
+"""
+
+import hashlib
+import os
+
+
+class HashingWriter(object):
+    """
+    Hashing Writer
+
+    Wraps a file object and updates one digest per algorithm with every
+    byte written, so the archive hash is known as soon as it is closed.
+    """
+
+    def __init__(self, fileobj, algorithms=('sha1', )):
+        self.fileobj = fileobj
+        self.hashes = [(algorithm, hashlib.new(algorithm)) for algorithm in algorithms]
+        self.size = 0
+
+    @property
+    def name(self):
+        return getattr(self.fileobj, 'name', '')
+
+    def write(self, data):
+        for algorithm, digest in self.hashes:
+            digest.update(data)
+        self.size = self.size + len(data)
+        self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+    def hexdigest(self, algorithm='sha1'):
+        return dict(self.hashes)[algorithm].hexdigest()
+
+
+class DeferredFileWriter(object):
+    """
+    Deferred File Writer
+
+    Keeps the first *buffer_size* bytes written in memory and only
+    creates the file at *path* once more are written or it is closed, so
+    a file given up with discard() before then never touches the disk.
+    """
+
+    def __init__(self, path, buffer_size):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        self.fileobj = None
+
+    def _open(self):
+        self.fileobj = open(self.path, 'wb')
+        self.fileobj.write(''.join(self.buffer))
+        self.buffer = []
+
+    def write(self, data):
+        if self.fileobj is not None:
+            self.fileobj.write(data)
+            return
+        self.buffer.append(data)
+        self.buffered = self.buffered + len(data)
+        if self.buffered > self.buffer_size:
+            self._open()
+
+    def flush(self):
+        if self.fileobj is not None:
+            self.fileobj.flush()
+
+    def close(self):
+        if self.fileobj is None:
+            self._open()
+        self.fileobj.close()
+
+    def discard(self):
+        """Give up the file, removing it if it was already created."""
+        self.buffer = []
+        if self.fileobj is not None:
+            self.fileobj.close()
+            os.unlink(self.path)
+
+
+class HashingReader(object):
+    """
+    Hashing Reader
+
+    Wraps a file object and updates a digest with every byte read from it.
+    *size* is the number of bytes hashed, from the start of the file.
+
+    Readers that seek, like zipfile, are followed: bytes are hashed as
+    they are read in order, what was skipped or read out of order is
+    hashed by drain().
+    """
+
+    def __init__(self, fileobj, algorithm='sha1'):
+        self.fileobj = fileobj
+        self.hash = hashlib.new(algorithm)
+        self.size = 0
+        self.position = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        end = self.position + len(data)
+        if self.position <= self.size < end:
+            self.hash.update(data[self.size - self.position:])
+            self.size = end
+        self.position = end
+        return data
+
+    def seek(self, offset, whence=0):
+        self.fileobj.seek(offset, whence)
+        self.position = self.fileobj.tell()
+
+    def tell(self):
+        return self.position
+
+    def drain(self, size=1024 * 1024):
+        """Read what is left so the digest covers the whole file."""
+        if self.position != self.size:
+            self.seek(self.size)
+        while self.read(size):
+            pass
+
+    def close(self):
+        self.fileobj.close()
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class TimedWriter(object):
+    """
+    Timed Writer
+
+    Wraps a file object and adds the time spent writing to it, less the
+    time of timed layers below it, and the bytes written to *phase* of
+    the vz_backup.metrics.PhaseTimer *timer*.
+    """
+
+    def __init__(self, fileobj, timer, phase):
+        self.fileobj = fileobj
+        self.timer = timer
+        self.phase = phase
+        self.size = 0
+
+    @property
+    def name(self):
+        return getattr(self.fileobj, 'name', '')
+
+    def write(self, data):
+        start = self.timer.start()
+        self.fileobj.write(data)
+        self.timer.stop(self.phase, start, len(data))
+        self.size = self.size + len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+
+class ThrottledWriter(object):
+    """
+    Throttled Writer
+
+    Wraps a file object and reports every write to the
+    vz_backup.throttle.Throttle *throttle*, which may hold it back.
+    """
+
+    def __init__(self, fileobj, throttle):
+        self.fileobj = fileobj
+        self.throttle = throttle
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.throttle.wrote(len(data))
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+
+class TimedReader(object):
+    """
+    Timed Reader
+
+    Wraps a file object and adds the time spent reading from it, less the
+    time of timed layers below it, and the bytes read to *phase* of the
+    vz_backup.metrics.PhaseTimer *timer*.
+    """
+
+    def __init__(self, fileobj, timer, phase):
+        self.fileobj = fileobj
+        self.timer = timer
+        self.phase = phase
+        self.size = 0
+
+    def read(self, size=-1):
+        start = self.timer.start()
+        data = self.fileobj.read(size)
+        self.timer.stop(self.phase, start, len(data))
+        self.size = self.size + len(data)
+        return data
+
+    def close(self):
+        self.fileobj.close()
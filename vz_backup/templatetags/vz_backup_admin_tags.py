@@ -2,17 +2,31 @@
 
 from django import template
 from django.conf import settings
+from django.core.paginator import EmptyPage, InvalidPage, Paginator
 from django.template.defaultfilters import stringfilter
 from django.utils.safestring import mark_safe
 
-from vz_backup.models import BackupObject, BackupArchive
+from vz_backup.models import BackupArchive
+
+ARCHIVES_PER_PAGE = getattr(settings, 'VZ_BACKUP_ARCHIVES_PER_PAGE', 50)
 
 register = template.Library()
 
 @register.inclusion_tag('vz_backup/vz_backup_admin_view_archives.html')
-def display_archives(b_obj_id):
-    b_obj = BackupObject.objects.get(id__exact=b_obj_id)
-    return { 'archives': BackupArchive.objects.filter(backup_object=b_obj) }
+def display_archives(b_obj_id, page=1):
+    archives = BackupArchive.objects.filter(backup_object__id__exact=b_obj_id).only(
+        'id', 'created', 'name', 'size', 'file_hash', 'keep', 'duration', 'raw_size', 'rows', 'phases',
+        'last_verified')
+    paginator = Paginator(archives, ARCHIVES_PER_PAGE)
+    try:
+        page = paginator.page(int(page))
+    except (ValueError, EmptyPage, InvalidPage):
+        page = paginator.page(paginator.num_pages)
+    return {
+        'archives': page.object_list,
+        'page': page,
+        'offset': page.start_index() - 1,
+    }
 
 @register.filter
 @stringfilter
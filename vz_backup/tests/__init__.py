@@ -2,21 +2,67 @@
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
 from django.core.management import call_command
 from django.core.urlresolvers import reverse
+from django.db import connection, transaction
 from django.db.models import loading
 from django.test import TransactionTestCase
+from django.utils import simplejson
 from vz_backup import generate_file_hash
+from vz_backup.chunks import ChunkWriter, chunk_path
+from vz_backup.compressors import COMPRESSORS, UNAVAILABLE, ParallelCompressingWriter, compressor_for_name, \
+    get_compressor
+from vz_backup.container import open_member, select_members
+from vz_backup.dump import consistent_snapshot, dump_app, dump_app_parallel, dump_segments, in_memory, \
+    plan_segments
+from vz_backup.benchmarks import bench_backup, bench_formats, bench_prune, compare_results, generate_archives, \
+    generate_widgets
+from vz_backup.restore import OBJECT_READERS, iter_json_objects
+from vz_backup.streams import HashingReader, HashingWriter
+from vz_backup.throttle import Throttle
+from vz_backup.verify import verify_archives
 from vz_backup.exceptions import ArchiveHashesDoNotMatch
+from vz_backup.fingerprint import app_fingerprint
+from vz_backup.incremental import MergedRows
+from vz_backup.signals import action_timed
 from vz_backup.tests.testwidgets.models import BackupTestWidget, create_widgets
-from vz_backup.models import backup_all, BackupObject, BackupArchive
+import vz_backup.models
+from vz_backup.models import backup_all, next_job, BackupArchive, BackupJob, BackupObject, BackupStats, Chunk
 
+import bz2
 import datetime
+import gzip
+import hashlib
 import mimetypes
 import os
 import shutil
+import sys
 import tempfile
+import zipfile
+import zlib
+from StringIO import StringIO
+
+def skip(test_case, reason):
+    """Skip the rest of *test_case*, with a notice where unittest can't skip."""
+    if hasattr(test_case, 'skipTest'):
+        test_case.skipTest(reason)
+    sys.stderr.write('skipped %s: %s\n' % (test_case.id(), reason))
+
+class FakeClock(object):
+    """Clock whose sleep moves its time on instead of waiting."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now = self.now + seconds
+
 
 class BackupTestCase(TransactionTestCase):
     def _pre_setup(self):
@@ -82,29 +128,339 @@ class VZBackupTestCase(BackupTestCase):
     def test_management_backup_all(self): 
         #test backup all
         create_widgets(1)
-        call_command('backup_all')
+        call_command('backup_all', verbosity=0)
         self.failUnlessEqual(self.bo.archives.count(), 2)
 
+        #test backup all fails when an app fails
+        BackupObject.objects.create(app_label='doesnotexist')
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            self.assertRaises(SystemExit, call_command, 'backup_all', verbosity=0)
+        finally:
+            sys.stderr = stderr
+        BackupObject.objects.filter(app_label='doesnotexist').delete()
+
         #test backup all with no backup objects included
         self. bo.include = False
         self.bo.save()
         create_widgets(1)
-        call_command('backup_all')
+        call_command('backup_all', verbosity=0)
         self.failUnlessEqual(self.bo.archives.count(), 2)
 
 
+    def test_models_backup_all_results(self):
+        #test per app results, a failing app does not stop the others
+        BackupObject.objects.create(app_label='doesnotexist')
+        create_widgets(1)
+        results = dict((r['app_label'], r) for r in backup_all())
+        self.failUnlessEqual(results['testwidgets']['status'], 'ok')
+        self.failUnlessEqual(results['testwidgets']['bytes'], self.bo.last_archive.size)
+        self.failUnlessEqual(results['doesnotexist']['status'], 'failed')
+        self.assertTrue(results['doesnotexist']['error'])
+
+        #test unchanged app, skipped before dumping
+        results = dict((r['app_label'], r) for r in backup_all())
+        self.failUnlessEqual(results['testwidgets']['status'], 'skipped')
+        self.failUnlessEqual(self.bo.archives.count(), 2)
+
+
+    def test_models_backup_all_maintenance(self):
+        #test prune and mail run once backup_all is done, in one mail per recipient
+        other = BackupObject.objects.create(app_label='auth')
+        other.mail_to.add(self.user1)
+        self.bo.mail_to.add(self.user1)
+        self.bo.auto_prune = True
+        self.bo.prune_by = 'count'
+        self.bo.prune_value = 1
+        self.bo.save()
+        create_widgets(1)
+        results = dict((r['app_label'], r) for r in backup_all())
+        self.failUnlessEqual(self.bo.archives.count(), 1)
+        self.failUnlessEqual(len(mail.outbox), 1)
+        self.failUnlessEqual(len(mail.outbox[0].attachments), 2)
+        self.failUnlessEqual(sorted([a[0] for a in mail.outbox[0].attachments]),
+            sorted(BackupArchive.objects.filter(id__in=[r['archive'] for r in results.values()]).values_list('name', flat=True)))
+
+        #test archives over the size cutoff are linked
+        old_max = vz_backup.models.MAIL_MAX_SIZE
+        vz_backup.models.MAIL_MAX_SIZE = 0
+        try:
+            self.bo.mail()
+        finally:
+            vz_backup.models.MAIL_MAX_SIZE = old_max
+        self.failUnlessEqual(mail.outbox[1].attachments, [])
+        self.assertTrue(reverse('admin:vz_backup_download_archive', args=(self.bo.last_archive.id, )) in mail.outbox[1].body)
+
+
     def test_models_file_hash(self):
         #test file hash
         ba = BackupArchive.objects.get(id__exact=1)
         self.failUnlessEqual(ba.file_hash, generate_file_hash(ba.path))
 
 
+    def test_models_file_hash_compressed(self):
+        #test inline hash matches the file on disk for compressed archives
+        for compress, opener in (('gz', gzip.open), ('bz2', bz2.BZ2File)):
+            self.bo.compress = compress
+            self.bo.save()
+            create_widgets(1)
+            self.bo.backup()
+            ba = self.bo.last_archive
+            self.failUnlessEqual(ba.file_hash, generate_file_hash(ba.path))
+            self.failUnlessEqual(ba.file_hash, generate_file_hash(ba.path, use_mmap=False))
+            self.failUnlessEqual(ba.size, os.path.getsize(ba.path))
+            f = opener(ba.path)
+            self.failUnlessEqual(len(simplejson.loads(f.read())), BackupTestWidget.objects.count())
+            f.close()
+
+
+    def test_compressors(self):
+        #test every registered compressor reads back what it wrote, gz and
+        #bz2 also when streams are concatenated
+        data = 'vz_backup ' * 10000
+        for compressor in COMPRESSORS.values():
+            if compressor.name in ('gz', 'bz2'):
+                members = 2
+            else:
+                members = 1
+            stream = StringIO()
+            for i in range(members):
+                writer = compressor.writer(stream, threads=2)
+                writer.write(data)
+                writer.close()
+            stream.seek(0)
+            self.failUnlessEqual(compressor.reader(stream).read(), data * members)
+
+            #test backup and reload with this compressor
+            self.bo.compress = compressor.name
+            self.bo.compress_level = compressor.default_level
+            self.bo.save()
+            create_widgets(1)
+            ba = self.bo.backup()
+            self.failUnlessEqual(ba.format, 'json')
+            count = BackupTestWidget.objects.count()
+            create_widgets(1)
+            self.bo.reload(ba.id)
+            self.failUnlessEqual(BackupTestWidget.objects.count(), count)
+
+
+    def test_compressors_parallel(self):
+        #test blocks compressed on threads come out in order as standard
+        #multi-member gz and bz2 files
+        data = ''.join(['widget %s\n' % i for i in range(20000)])
+        for name, opener in (('gz', gzip.GzipFile), ('bz2', None)):
+            compressor = COMPRESSORS[name]
+            stream = StringIO()
+            writer = ParallelCompressingWriter(stream, lambda block: compressor.compress_block(block, 6),
+                3, 10000)
+            for start in range(0, len(data), 777):
+                writer.write(data[start:start + 777])
+            writer.close()
+            self.failUnlessEqual(compressor.reader(StringIO(stream.getvalue())).read(), data)
+            if opener is not None:
+                self.failUnlessEqual(opener(fileobj=StringIO(stream.getvalue())).read(), data)
+            self.assertTrue(isinstance(compressor.writer(StringIO(), threads=2), ParallelCompressingWriter))
+
+        #test threaded backups reload
+        self.bo.compress = 'bz2'
+        self.bo.compress_threads = 4
+        self.bo.save()
+        create_widgets(1)
+        ba = self.bo.backup()
+        count = BackupTestWidget.objects.count()
+        create_widgets(1)
+        self.bo.reload(ba.id)
+        self.failUnlessEqual(BackupTestWidget.objects.count(), count)
+
+
+    def test_compressors_unavailable(self):
+        #test a compression whose library is missing is named in the error
+        #and its archives aren't read as uncompressed
+        saved = COMPRESSORS.pop('zstd', None)
+        unavailable = UNAVAILABLE.get('zstd')
+        UNAVAILABLE['zstd'] = ('zst', 'zstandard')
+        try:
+            self.assertRaises(ImproperlyConfigured, get_compressor, 'zstd')
+            self.assertRaises(ImproperlyConfigured, get_compressor, 'doesnotexist')
+            self.assertRaises(ImproperlyConfigured, compressor_for_name, 'widget.json.zst')
+            self.failUnlessEqual(compressor_for_name('widget.json').name, 'none')
+            self.bo.compress = 'zstd'
+            self.bo.save()
+            self.assertRaises(ImproperlyConfigured, self.bo.backup)
+        finally:
+            if unavailable is None:
+                del UNAVAILABLE['zstd']
+            if saved is not None:
+                COMPRESSORS['zstd'] = saved
+
+
+    def test_streams_hashing_writer(self):
+        #test extra digests
+        h_file = HashingWriter(StringIO(), ('sha1', 'sha256'))
+        h_file.write('vz_backup')
+        self.failUnlessEqual(h_file.hexdigest('sha256'), hashlib.sha256('vz_backup').hexdigest())
+        self.failUnlessEqual(h_file.hexdigest(), hashlib.sha1('vz_backup').hexdigest())
+        self.failUnlessEqual(h_file.size, 9)
+
+        #test readers that seek have every byte hashed once
+        data = ''.join([chr(i % 256) for i in range(1000)])
+        h_file = HashingReader(StringIO(data))
+        h_file.seek(-10, 2)
+        h_file.read()
+        h_file.seek(0)
+        h_file.read(100)
+        h_file.seek(50)
+        h_file.read(100)
+        h_file.seek(400)
+        h_file.read(10)
+        h_file.drain()
+        self.failUnlessEqual(h_file.hexdigest(), hashlib.sha1(data).hexdigest())
+        self.failUnlessEqual(h_file.size, 1000)
+
+
     def test_models_file_hash_same(self):
         #test backup only if changed
         self.bo.backup()
         self.failUnlessEqual(self.bo.archives.count(), 1)
 
 
+    def test_models_fingerprint(self):
+        #test the last archive records the fingerprint
+        ba = self.bo.last_archive
+        self.failUnlessEqual(ba.fingerprint, self.bo.fingerprint())
+        tables = simplejson.loads(ba.fingerprint)['tables']
+        self.failUnlessEqual(tables['testwidgets.backuptestwidget']['rows'][0], self.num_widgets)
+        self.assertTrue('fingerprint' in simplejson.loads(ba.phases))
+
+        #test an unchanged app is skipped
+        self.failUnlessEqual(self.bo.backup(), None)
+        self.assertTrue(self.bo.skipped)
+
+        #test changes the timestamp doesn't show are noticed
+        BackupTestWidget.objects.filter(id=1).update(value=42)
+        self.assertNotEqual(self.bo.fingerprint(), ba.fingerprint)
+        self.assertNotEqual(self.bo.backup(), None)
+        self.assertFalse(self.bo.skipped)
+
+        #test new serialization settings are noticed
+        self.bo.use_natural_keys = False
+        self.bo.save()
+        self.failUnlessEqual(self.bo.backup(), None)
+        self.assertFalse(self.bo.skipped)
+        self.failUnlessEqual(self.bo.backup(), None)
+        self.assertTrue(self.bo.skipped)
+        self.failUnlessEqual(self.bo.archives.count(), 2)
+
+        #test with natural keys the tables of other apps they refer to are
+        #fingerprinted, permissions refer to content types
+        tables = app_fingerprint('auth', use_natural_keys=True)
+        self.assertTrue('contenttypes.contenttype' in tables)
+        self.failIf('contenttypes.contenttype' in app_fingerprint('auth'))
+        ContentType.objects.filter(model='backuptestwidget').update(model='renamed')
+        self.assertNotEqual(app_fingerprint('auth', use_natural_keys=True), tables)
+        ContentType.objects.clear_cache()
+
+
+    def test_models_content_hash(self):
+        #test the content hash is the sha1 of the serialized data
+        ba = self.bo.last_archive
+        self.failUnlessEqual(ba.content_hash, ba.file_hash)
+
+        #test an equal dump in another compression is dropped unwritten
+        self.bo.compress = 'gz'
+        self.bo.save()
+        BackupArchive.objects.filter(id=ba.id).update(fingerprint='')
+        files = os.listdir(settings.VZ_BACKUP_DIR)
+        self.failUnlessEqual(self.bo.backup(), None)
+        self.assertFalse(self.bo.skipped)
+        self.failUnlessEqual(os.listdir(settings.VZ_BACKUP_DIR), files)
+        self.failUnlessEqual(BackupArchive.objects.get(id=ba.id).fingerprint, self.bo.fingerprint())
+
+        #test gzip archives of equal data are equal
+        create_widgets(1)
+        ba = self.bo.backup()
+        ba.delete()
+        self.failUnlessEqual(self.bo.backup().file_hash, ba.file_hash)
+
+
+    def test_throttle(self):
+        clock = FakeClock()
+
+        #test the read rate is kept to, a batch at a time
+        throttle = Throttle(read_rate=1000, clock=clock.time, sleep=clock.sleep)
+        for i in range(3):
+            throttle.fetched(500, 0.0)
+        self.assertAlmostEqual(throttle.waited, 0.5)
+        self.assertAlmostEqual(throttle.throughput()['rows_per_second'], 3000)
+
+        #test backoff grows on slow batches up to its cap and halves on fast ones
+        throttle = Throttle(latency_target=0.01, batch_rows=2, max_backoff=0.05,
+            clock=clock.time, sleep=clock.sleep)
+        for rows, latency in ((2, 0.01), (2, 0.01), (2, 0.03), (2, 0.03), (2, 0.0), (20, 0.03)):
+            throttle.fetched(rows, latency)
+        self.assertAlmostEqual(throttle.backoff, 0.0125)
+        self.assertAlmostEqual(throttle.waited, 0.03 + 0.05 + 0.025 + 0.0125)
+
+        #test a throttled backup waits in the throttle phase and reports its throughput
+        create_widgets(75)
+        self.bo.read_rate = 100
+        self.bo.save()
+        ba = self.bo.backup()
+        phases = simplejson.loads(ba.phases)
+        self.assertTrue(0.3 < phases['throttle']['seconds'] < 5)
+        self.assertTrue(ba.throughput[1] < 400)
+
+        #test container backups and fingerprint checksums are throttled too
+        create_widgets(1)
+        self.bo.container = True
+        self.bo.read_rate = None
+        self.bo.write_rate = 0.01
+        self.bo.save()
+        throttle = self.bo.throttle()
+        self.bo.fingerprint(throttle)
+        self.assertTrue(throttle.rows >= 76)
+        ba = self.bo.backup()
+        phases = simplejson.loads(ba.phases)
+        self.assertTrue(phases['throttle']['seconds'] > 0.3)
+
+
+    def test_verify_archives(self):
+        #test intact archives, plain and deduplicated, are verified
+        create_widgets(1)
+        self.bo.backup()
+        self.bo.deduplicate = True
+        self.bo.save()
+        create_widgets(1)
+        self.bo.backup()
+        archives = list(self.bo.archives.order_by('id'))
+        results = list(verify_archives(self.bo.archives.order_by('id'), workers=2))
+        self.failUnlessEqual([status for archive, status in results], ['ok', 'ok', 'ok'])
+        self.failUnlessEqual(self.bo.archives.filter(last_verified__isnull=True).count(), 0)
+
+        #test only archives not verified in the last days are checked again
+        BackupArchive.objects.filter(id=archives[0].id).update(
+            last_verified=datetime.datetime.now() - datetime.timedelta(days=10))
+        call_command('verify_archives', days=7, verbosity=0)
+        self.assertTrue(BackupArchive.objects.get(id=archives[0].id).last_verified >
+            BackupArchive.objects.get(id=archives[1].id).last_verified)
+
+        #test missing, truncated and corrupted archives are flagged
+        os.unlink(archives[0].path)
+        with open(archives[1].path, 'r+b') as f:
+            f.truncate(archives[1].size - 1)
+        digest = archives[2].archivechunk_set.all()[0].chunk.digest
+        with open(chunk_path('testwidgets', digest), 'wb') as f:
+            f.write('not zlib')
+        results = list(verify_archives(self.bo.archives.order_by('id')))
+        self.failUnlessEqual([status for archive, status in results], ['missing', 'truncated', 'corrupt'])
+
+        #test a chunk swapped for another that decompresses cleanly is corrupt
+        with open(chunk_path('testwidgets', digest), 'wb') as f:
+            f.write(zlib.compress('another chunk'))
+        results = list(verify_archives(self.bo.archives.select_related('backup_object').order_by('id')))
+        self.failUnlessEqual([status for archive, status in results], ['missing', 'truncated', 'corrupt'])
+
+
     def test_models_backup(self):
         #delete initial backup archive
         ba = self.bo.archives.delete()
@@ -225,6 +581,395 @@ class VZBackupTestCase(BackupTestCase):
         self.assertEqual(self.bo.archives.count(), 3)
 
 
+    def test_dump_app_chunks(self):
+        #test streaming dump with chunks smaller than the table
+        create_widgets(4)
+        stream = StringIO()
+        dump_app('testwidgets', stream, indent=4, chunk_size=2)
+        objects = simplejson.loads(stream.getvalue())
+        self.assertEqual(len(objects), BackupTestWidget.objects.count())
+        self.assertEqual(len(set(o['pk'] for o in objects)), len(objects))
+
+        #test empty app
+        BackupTestWidget.objects.all().delete()
+        stream = StringIO()
+        dump_app('testwidgets', stream)
+        self.assertEqual(simplejson.loads(stream.getvalue()), [])
+
+
+    def test_dump_app_parallel(self):
+        #test segments of row ranges join into the same dump as dump_app
+        create_widgets(7)
+        segments = plan_segments(self.bo.app_label, segment_rows=4)
+        self.failUnlessEqual(len(segments), 3)
+        self.failUnlessEqual(segments[0][1:], (None, segments[1][1]))
+        serial, parallel = StringIO(), StringIO()
+        dump_app(self.bo.app_label, serial, indent=4)
+        dump_app_parallel(self.bo.app_label, parallel, 1, indent=4, segment_rows=4)
+        self.failUnlessEqual(parallel.getvalue(), serial.getvalue())
+
+        #test backups dumped in segments match serial ones and reload
+        self.bo.backup()
+        self.bo.dump_workers = 2
+        self.bo.save()
+        self.failUnlessEqual(self.bo.backup(), None)
+        create_widgets(1)
+        ba = self.bo.backup()
+        BackupTestWidget.objects.all().delete()
+        self.bo.reload(ba.id)
+        self.failUnlessEqual(BackupTestWidget.objects.count(), self.num_widgets + 8)
+
+
+    def test_dump_app_parallel_workers(self):
+        #test segments dumped by worker processes match serial dumps
+        if in_memory():
+            return skip(self, 'worker processes can\'t open an in-memory database')
+        create_widgets(7)
+        serial, parallel = StringIO(), StringIO()
+        dump_app(self.bo.app_label, serial, indent=4)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            segments = plan_segments(self.bo.app_label, segment_rows=4)
+            dumped = dump_segments(segments, tmp_dir, 2, indent=4)
+            self.failUnlessEqual(sum([count for segment, path, count in dumped]),
+                BackupTestWidget.objects.count())
+        finally:
+            shutil.rmtree(tmp_dir)
+        dump_app_parallel(self.bo.app_label, parallel, 2, indent=4, segment_rows=4)
+        self.failUnlessEqual(parallel.getvalue(), serial.getvalue())
+        self.failUnlessEqual(BackupTestWidget.objects.count(), self.num_widgets + 7)
+
+
+    def test_dump_app_snapshot(self):
+        #test dumps read through a server-side cursor in a snapshot match
+        #chunked ones
+        create_widgets(5)
+        chunked, cursor = StringIO(), StringIO()
+        dump_app(self.bo.app_label, chunked, indent=4, chunk_size=2)
+        with consistent_snapshot():
+            dump_app(self.bo.app_label, cursor, indent=4, fetch_size=2)
+        self.failUnlessEqual(cursor.getvalue(), chunked.getvalue())
+
+        #test a block that raises is rolled back
+        count = BackupTestWidget.objects.count()
+        try:
+            with consistent_snapshot():
+                create_widgets(2)
+                raise ValueError
+        except ValueError:
+            pass
+        self.failUnlessEqual(BackupTestWidget.objects.count(), count)
+
+        #test the transaction of uncommitted writes is left to its owner
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            create_widgets(1)
+            with consistent_snapshot():
+                create_widgets(1)
+            self.assertTrue(transaction.is_dirty())
+            transaction.rollback()
+        finally:
+            transaction.leave_transaction_management()
+        self.failUnlessEqual(BackupTestWidget.objects.count(), count)
+
+        #test snapshot backups match and leave no transaction open
+        self.bo.backup()
+        self.bo.snapshot = True
+        self.bo.dump_workers = 2
+        self.bo.save()
+        self.failUnlessEqual(self.bo.backup(), None)
+        create_widgets(1)
+        ba = self.bo.backup()
+        BackupTestWidget.objects.all().delete()
+        self.bo.reload(ba.id)
+        self.failUnlessEqual(BackupTestWidget.objects.count(), self.num_widgets + 6)
+
+
+    def test_models_container(self):
+        #test container archives hold one member per model and reload
+        label = 'testwidgets.BackupTestWidget'
+        self.bo.container = True
+        self.bo.compress = 'gz'
+        self.bo.save()
+        ba = self.bo.backup()
+        self.assertTrue(ba.container)
+        self.failUnlessEqual(ba.format, 'json')
+        self.failUnlessEqual(self.bo.backup(), None)
+        container = zipfile.ZipFile(ba.path)
+        members = select_members(container)
+        self.failUnlessEqual(container.testzip(), None)
+        container.close()
+        self.failUnlessEqual([(m['model'], m['count']) for m in members], [(label, self.num_widgets)])
+        self.assertTrue(members[0]['member'].endswith('.json.gz'))
+        self.failUnlessEqual(ba.file_hash, generate_file_hash(ba.path))
+        self.failUnlessEqual(ba.size, os.path.getsize(ba.path))
+        create_widgets(2)
+        self.bo.reload(ba.id)
+        self.failUnlessEqual(BackupTestWidget.objects.count(), self.num_widgets)
+
+        #test the content hash covers the member data, so an equal dump in
+        #another compression is dropped
+        container = zipfile.ZipFile(ba.path)
+        data = ''.join([open_member(container, entry).read() for entry in select_members(container)])
+        container.close()
+        self.failUnlessEqual(ba.content_hash, hashlib.sha1(data).hexdigest())
+        self.bo.compress = 'bz2'
+        self.bo.save()
+        BackupArchive.objects.filter(id=ba.id).update(fingerprint='')
+        self.failUnlessEqual(self.bo.backup(), None)
+        self.assertFalse(self.bo.skipped)
+        self.failUnlessEqual(self.bo.backup(), None)
+        self.assertTrue(self.bo.skipped)
+
+        #test the hash of containers is checked while they are reloaded
+        file_hash = ba.file_hash
+        BackupArchive.objects.filter(id=ba.id).update(file_hash='malicious')
+        create_widgets(2)
+        self.failUnlessRaises(ArchiveHashesDoNotMatch, self.bo.reload, ba.id)
+        self.failUnlessEqual(BackupTestWidget.objects.count(), self.num_widgets + 2)
+        BackupArchive.objects.filter(id=ba.id).update(file_hash=file_hash)
+        self.bo.reload(ba.id)
+        self.failUnlessEqual(BackupTestWidget.objects.count(), self.num_widgets)
+
+        #test reloading some rows of one model
+        first = BackupTestWidget.objects.order_by('pk')[0]
+        BackupTestWidget.objects.filter(pk=first.pk).update(name='changed')
+        create_widgets(1)
+        self.bo.reload(ba.id, labels=[label], pks=[first.pk])
+        self.failUnlessEqual(BackupTestWidget.objects.get(pk=first.pk).name, first.name)
+        self.failUnlessEqual(BackupTestWidget.objects.count(), self.num_widgets + 1)
+        self.failUnlessRaises(ValueError, self.bo.reload, 1, labels=[label])
+
+        #test download of one model and the index command
+        response = self.client.get(reverse('admin:vz_backup_download_archive_model', args=(ba.id, label)))
+        self.failUnlessEqual(len(simplejson.loads(response.content)), self.num_widgets)
+        old_stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            call_command('dump_archive_index', str(ba.id))
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = old_stdout
+        self.assertTrue(members[0]['member'] in output)
+
+
+    def test_chunks_content_defined(self):
+        #test an insert only changes the chunks around it
+        lines = ['{"pk": %d, "name": "widget %d"}\n' % (i, i) for i in range(60000)]
+        c1 = ChunkWriter('testwidgets')
+        for line in lines:
+            c1.write(line)
+        c1.close()
+        c2 = ChunkWriter('testwidgets')
+        for line in lines[:30000] + ['{"pk": -1}\n'] + lines[30000:]:
+            c2.write(line)
+        c2.close()
+        self.assertTrue(len(c1.chunks) > 4)
+        new = set(c2.chunks) - set(c1.chunks)
+        self.assertTrue(len(new) <= 2)
+        self.failUnlessEqual(c2.stored_size > 0, True)
+        self.assertTrue(c2.stored_size < c1.stored_size / 2)
+
+
+    def test_models_deduplicate(self):
+        #test deduplicated archives share chunks, reload and gc
+        self.bo.deduplicate = True
+        self.bo.save()
+        create_widgets(1)
+        ba1 = self.bo.backup()
+        self.assertTrue(ba1.chunked)
+        self.failUnlessEqual(ba1.file_hash, hashlib.sha1(ba1.open().read()).hexdigest())
+        self.failUnlessEqual(ba1.size, len(ba1.open().read()))
+        self.failUnlessEqual(self.bo.backup(), None)
+
+        create_widgets(1)
+        ba2 = self.bo.backup()
+        digests = list(Chunk.objects.filter(archivechunk__archive=ba1).values_list('digest', flat=True))
+        for digest in digests:
+            self.assertTrue(os.path.exists(chunk_path('testwidgets', digest)))
+
+        #test reload
+        count = BackupTestWidget.objects.count()
+        create_widgets(2)
+        self.bo.reload(ba2.id)
+        self.failUnlessEqual(BackupTestWidget.objects.count(), count)
+
+        #test a chunk reused by a running backup survives the delete of the last archive holding it
+        data = ba2.open().read()
+        writer = ChunkWriter('testwidgets')
+        writer.write(data)
+        writer.close()
+        self.failUnlessEqual(writer.stored_size, 0)
+        ba1.delete()
+        ba2.delete()
+        self.failUnlessEqual(Chunk.objects.filter(backup_object=self.bo).count(), 0)
+        for digest, size in writer.chunks:
+            self.assertTrue(os.path.exists(chunk_path('testwidgets', digest)))
+        ba3 = self.bo.backup()
+        self.failUnlessEqual(ba3.open().read(), data)
+
+        #test gc after delete, files once they are old enough
+        ba3.delete()
+        self.failUnlessEqual(Chunk.objects.filter(backup_object=self.bo).count(), 0)
+        for digest in digests:
+            os.utime(chunk_path('testwidgets', digest), (0, 0))
+        self.bo.collect_chunks(sweep=True)
+        for digest in digests:
+            self.assertFalse(os.path.exists(chunk_path('testwidgets', digest)))
+
+        #test prune sweeps old chunk files of failed backups, not new ones
+        old, new = chunk_path('testwidgets', 'a' * 40), chunk_path('testwidgets', 'b' * 40)
+        for path in (old, new):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'wb').close()
+        os.utime(old, (0, 0))
+        self.bo.prune()
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+
+
+    def test_models_incremental(self):
+        #test incremental archives only hold changed rows
+        self.bo.incremental = True
+        self.bo.full_every = 2
+        self.bo.save()
+        create_widgets(1)
+        full = self.bo.backup()
+        self.failUnlessEqual(full.parent, None)
+        self.assertTrue(os.path.exists(full.path + '.idx'))
+
+        create_widgets(1)
+        incr1 = self.bo.backup()
+        self.failUnlessEqual(incr1.parent_id, full.id)
+        self.failUnlessEqual(incr1.depth, 1)
+        self.failUnlessEqual(len(simplejson.loads(open(incr1.path).read())), 1)
+
+        #test no change, then a deletion only
+        self.failUnlessEqual(self.bo.backup(), None)
+        BackupTestWidget.objects.all()[0].delete()
+        incr2 = self.bo.backup()
+        self.failUnlessEqual(incr2.parent_id, incr1.id)
+        self.failUnlessEqual(simplejson.loads(open(incr2.path).read()), [])
+
+        #test a failed dump leaves neither archive nor index behind
+        create_widgets(1)
+        files = sorted(os.listdir(settings.VZ_BACKUP_DIR))
+        def fail(*args, **kwargs):
+            raise ValueError('dump failed')
+        self.bo._dump = fail
+        self.assertRaises(ValueError, self.bo.backup)
+        del self.bo._dump
+        self.failUnlessEqual(sorted(os.listdir(settings.VZ_BACKUP_DIR)), files)
+        BackupTestWidget.objects.order_by('-id')[0].delete()
+
+        #test reload replays the chain
+        count = BackupTestWidget.objects.count()
+        create_widgets(2)
+        self.bo.reload(incr2.id)
+        self.failUnlessEqual(BackupTestWidget.objects.count(), count)
+
+        #test next archive after full_every incrementals is full
+        create_widgets(1)
+        self.failUnlessEqual(self.bo.backup().parent, None)
+
+        #test pruning keeps what a surviving incremental builds on
+        self.bo.prune_by = 'count'
+        self.bo.prune_value = 1
+        self.bo.save()
+        incr2.keep = True
+        incr2.save()
+        self.bo.prune()
+        self.failUnlessEqual(BackupArchive.objects.filter(id__in=[full.id, incr1.id]).count(), 2)
+
+        #test index is removed with its archive
+        incr2.delete()
+        self.assertFalse(os.path.exists(incr2.path + '.idx'))
+
+
+    def test_incremental_merged_rows(self):
+        #test parent rows are merged in key order, skipped ones are deleted
+        previous = MergedRows(iter([(1, 'a'), (2, 'b'), (4, 'd'), (6, 'f')]))
+        self.failUnlessEqual(previous.pop(2), 'b')
+        self.failUnlessEqual(previous.pop(3), None)
+        self.failUnlessEqual(previous.pop(4), 'd')
+        self.failUnlessEqual(list(previous), [1, 6])
+
+
+    def test_models_prune_dry_run(self):
+        #test dry run reports victims without deleting them
+        for i in range(3):
+            create_widgets(1)
+            self.bo.backup()
+        self.bo.prune_by = 'count'
+        self.bo.prune_value = 1
+        self.bo.save()
+        archives = list(self.bo.archives.order_by('created'))
+        ids, freed = self.bo.prune(dry_run=True)
+        self.failUnlessEqual(sorted(ids), sorted([ba.id for ba in archives[:3]]))
+        self.failUnlessEqual(freed, sum([ba.size for ba in archives[:3]]))
+        self.failUnlessEqual(self.bo.archives.count(), 4)
+
+        #test prune deletes the same archives and their files
+        self.failUnlessEqual(self.bo.prune(), (ids, freed))
+        self.failUnlessEqual(list(self.bo.archives.values_list('id', flat=True)), [archives[3].id])
+        for ba in archives[:3]:
+            self.assertFalse(os.path.exists(ba.path))
+
+        #test size policy
+        for i in range(2):
+            create_widgets(1)
+            self.bo.backup()
+        self.bo.prune_by = 'size'
+        self.bo.prune_value = (self.bo.last_archive.size + 1) / 1000.0
+        self.bo.save()
+        ids, freed = self.bo.prune()
+        self.failUnlessEqual(len(ids), 2)
+        self.failUnlessEqual(self.bo.archives.count(), 1)
+
+
+    def test_models_stats(self):
+        #test stats follow new, kept and deleted archives
+        for i in range(2):
+            create_widgets(1)
+            self.bo.backup()
+        archives = list(self.bo.archives)
+        stats = self.bo.get_stats()
+        self.failUnlessEqual(stats.number_of_archives, 3)
+        self.failUnlessEqual(stats.archives_size, sum([ba.size for ba in archives]))
+        self.failUnlessEqual(stats.last_archive_id, archives[0].id)
+        archives[1].keep = True
+        archives[1].save()
+        self.failUnlessEqual(self.bo.get_stats().kept_archives, 1)
+        self.failUnlessEqual(self.bo.unkept_archives_size, archives[0].size + archives[2].size)
+        archives[0].delete()
+        stats = self.bo.get_stats()
+        self.failUnlessEqual(stats.number_of_archives, 2)
+        self.failUnlessEqual(stats.last_archive_id, archives[1].id)
+        self.failUnlessEqual(self.bo.last_archive, archives[1])
+
+        #test recompute_stats repairs drift
+        expected = BackupStats.objects.filter(backup_object=self.bo).values()[0]
+        BackupStats.objects.filter(backup_object=self.bo).update(archives_size=0,
+            number_of_archives=0, last_archive_id=None)
+        call_command('recompute_stats', self.bo.app_label, verbosity=0)
+        self.failUnlessEqual(BackupStats.objects.filter(backup_object=self.bo).values()[0], expected)
+
+        #test missing stats are computed from the archives, new one included
+        BackupStats.objects.filter(backup_object=self.bo).delete()
+        create_widgets(1)
+        self.bo.backup()
+        stats = self.bo.get_stats()
+        self.failUnlessEqual(stats.number_of_archives, 3)
+        self.failUnlessEqual(stats.archives_size, sum([ba.size for ba in self.bo.archives]))
+
+        #test deleting the backup object doesn't bring its stats back
+        bo_id = self.bo.id
+        self.bo.delete()
+        self.failIf(BackupStats.objects.filter(backup_object=bo_id).exists())
+
+
     def test_models_mail_to(self):
         #test empty mail_to
         self.bo.mail(fail_silently=True)
@@ -247,6 +992,147 @@ class VZBackupTestCase(BackupTestCase):
         self.failUnlessEqual(BackupTestWidget.objects.count(), self.num_widgets)
 
     
+    def test_restore_iter_json_objects(self):
+        #test objects are parsed across reads, also inside multibyte characters
+        objects = [{'pk': i, 'name': u'widget \xe9\u20ac %s' % i} for i in range(20)]
+        data = simplejson.dumps(objects, indent=4, ensure_ascii=False).encode('utf-8')
+        self.failUnlessEqual(list(iter_json_objects(StringIO(data), read_size=7)), objects)
+        self.failUnlessEqual(list(iter_json_objects(StringIO('[]'))), [])
+        self.failUnlessRaises(ValueError, list, iter_json_objects(StringIO('[{"pk": 1}, {"pk"')))
+
+
+    def test_models_reload_batched(self):
+        #test reload inserts rows in batches
+        create_widgets(300)
+        ba = self.bo.backup()
+        BackupTestWidget.objects.all().delete()
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            self.bo.reload(ba.id)
+            queries = len(connection.queries)
+        finally:
+            settings.DEBUG = old_debug
+        self.failUnlessEqual(BackupTestWidget.objects.count(), 303)
+        self.assertTrue(queries < 20)
+
+        #test keys handed out after a reload do not collide
+        create_widgets(1)
+        self.failUnlessEqual(BackupTestWidget.objects.count(), 304)
+
+
+    def test_models_msgpack(self):
+        if 'msgpack' not in OBJECT_READERS:
+            return skip(self, 'msgpack is not installed')
+        #test msgpack archives reload
+        create_widgets(50)
+        self.bo.format = 'msgpack'
+        self.bo.save()
+        ba = self.bo.backup()
+        self.assertTrue(ba.name.endswith('.msgpack'))
+        self.failUnlessEqual(ba.format, 'msgpack')
+        widgets = list(BackupTestWidget.objects.values_list('id', 'name', 'value'))
+        BackupTestWidget.objects.all().delete()
+        self.bo.reload(ba.id)
+        self.failUnlessEqual(list(BackupTestWidget.objects.values_list('id', 'name', 'value')), widgets)
+
+        #test the format benchmark reads back every object, msgpack dumps are smaller
+        results = bench_formats(self.bo.app_label, ['json', 'msgpack'], indent=4)
+        self.failUnlessEqual([result['name'] for result in results], ['json', 'msgpack'])
+        self.failUnlessEqual([result['objects'] for result in results], [len(widgets)] * 2)
+        self.assertTrue(results[1]['bytes'] < results[0]['bytes'])
+
+
+    def test_benchmarks_suite_helpers(self):
+        #test synthetic widgets are numbered on from start
+        generate_widgets(BackupTestWidget, 25, start=10)
+        self.failUnlessEqual(BackupTestWidget.objects.count(), self.num_widgets + 25)
+        self.failUnlessEqual(BackupTestWidget.objects.filter(name='widget 34').count(), 1)
+
+        #test slower timings and more queries than the baseline are regressions
+        baseline = [
+            {'name': 'backup.gz', 'rows': 10, 'seconds': 1.0},
+            {'name': 'changelist', 'rows': 10, 'seconds': 0.1, 'queries': 5},
+        ]
+        results = [
+            {'name': 'backup.gz', 'rows': 10, 'seconds': 1.2},
+            {'name': 'backup.gz', 'rows': 100, 'seconds': 9.0},
+            {'name': 'changelist', 'rows': 10, 'seconds': 0.2, 'queries': 6},
+        ]
+        self.failUnlessEqual(compare_results(results, baseline), [
+            ('changelist', 10, 'seconds', 0.2, 0.1),
+            ('changelist', 10, 'queries', 6, 5),
+        ])
+        self.failUnlessEqual(len(compare_results(results, baseline, tolerance=0.1)), 3)
+
+        #test every compression and repeat of the backup benchmark dumps
+        results, made = bench_backup(self.bo, ['none', 'gz'], repeat=2)
+        self.failUnlessEqual(sorted([result['name'] for result in results]), ['backup.gz', 'backup.none'])
+        self.failUnlessEqual(len([archive for archive in made if archive is not None]), 2)
+        self.failUnlessEqual(made[1].content_hash, made[0].content_hash)
+        for archive in made:
+            archive.delete()
+
+        #test generated archives get every field's default and are pruned
+        #by every policy
+        generate_archives(self.bo, 20)
+        self.failUnlessEqual(self.bo.get_stats().number_of_archives, 21)
+        ba = self.bo.archives.filter(name='benchmark_0.json')[0]
+        self.failUnlessEqual((ba.content_hash, ba.fingerprint, ba.rows, ba.phases), ('', '', '', ''))
+        self.assertTrue(ba.keep)
+        results = bench_prune(self.bo, archives=20)
+        self.failUnlessEqual([result['name'] for result in results], ['prune.count', 'prune.size', 'prune.time'])
+        for result in results:
+            self.assertTrue(result['pruned'] > 0)
+        self.failUnlessEqual(self.bo.archives.count(), 0)
+
+
+    def test_metrics(self):
+        timed = []
+        def record(sender, action, duration, phases, archive=None, **kwargs):
+            timed.append((action, duration, phases, archive))
+        action_timed.connect(record)
+        old_backends = getattr(settings, 'VZ_BACKUP_METRICS_BACKENDS', ())
+        settings.VZ_BACKUP_METRICS_BACKENDS = ('vz_backup.metrics.PrometheusTextfileBackend', )
+        settings.VZ_BACKUP_METRICS_TEXTFILE = os.path.join(settings.VZ_BACKUP_DIR, 'vz_backup.prom')
+        try:
+            #test backup phases are timed and saved with the archive
+            create_widgets(5)
+            ba = self.bo.backup()
+            action, duration, phases, archive = timed[-1]
+            self.failUnlessEqual((action, archive), ('backup', ba))
+            for phase in ('fetch', 'serialize', 'compress', 'hash', 'write'):
+                self.assertTrue(phase in phases)
+            self.assertTrue(sum([totals['seconds'] for totals in phases.values()]) <= duration)
+            self.failUnlessEqual(phases['write']['bytes'], ba.size)
+            ba = BackupArchive.objects.get(id__exact=ba.id)
+            self.failUnlessEqual(ba.raw_size, ba.size)
+            self.failUnlessEqual(ba.row_counts, [('testwidgets.BackupTestWidget', self.num_widgets + 5)])
+            self.failUnlessEqual(ba.duration, duration)
+            self.failUnlessEqual(len(ba.phase_times), len(phases))
+
+            #test reload and prune are timed and written to the textfile
+            self.bo.reload(ba.id)
+            self.failUnlessEqual(timed[-1][0], 'reload')
+            self.assertTrue('clear' in timed[-1][2] and 'load' in timed[-1][2])
+            self.bo.prune()
+            self.failUnlessEqual(timed[-1][0], 'prune')
+            textfile = open(settings.VZ_BACKUP_METRICS_TEXTFILE).read()
+            for action in ('backup', 'reload', 'prune'):
+                self.assertTrue('vz_backup_duration_seconds{app_label="testwidgets",action="%s"}' % action in textfile)
+            self.assertTrue('vz_backup_archive_raw_bytes{app_label="testwidgets"} %d' % ba.raw_size in textfile)
+
+            #test the archive table shows the stats
+            self.user1.is_staff = True
+            self.user1.save()
+            response = self.client.get(reverse('admin:vz_backup_backupobject_change', args=(self.bo.id, )))
+            self.assertContains(response, 'testwidgets.BackupTestWidget: %d' % (self.num_widgets + 5))
+        finally:
+            action_timed.disconnect(record)
+            settings.VZ_BACKUP_METRICS_BACKENDS = old_backends
+
+
     def test_views_download_archive(self):
         #make user1 a superuser
         self.user1.is_superuser = True
@@ -263,6 +1149,81 @@ class VZBackupTestCase(BackupTestCase):
         self.failUnlessEqual(response.__getitem__('Content-Disposition'), 'attachment; filename=%s'%ba.name)
 
 
+    def test_views_download_archive_ranges(self):
+        url = reverse('admin:vz_backup_download_archive', args=('1', ))
+        ba = BackupArchive.objects.get(id__exact=1)
+        data = open(ba.path, 'rb').read()
+
+        #test conditional get
+        response = self.client.get(url)
+        self.failUnlessEqual(response['Accept-Ranges'], 'bytes')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.failUnlessEqual(response.status_code, 304)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.failUnlessEqual(response.status_code, 304)
+
+        #test single, suffix and multiple ranges
+        response = self.client.get(url, HTTP_RANGE='bytes=10-19')
+        self.failUnlessEqual(response.status_code, 206)
+        self.failUnlessEqual(response.content, data[10:20])
+        self.failUnlessEqual(response['Content-Range'], 'bytes 10-19/%d' % len(data))
+        response = self.client.get(url, HTTP_RANGE='bytes=-5')
+        self.failUnlessEqual(response.content, data[-5:])
+        response = self.client.get(url, HTTP_RANGE='bytes=0-1,5-')
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges'))
+        self.failUnlessEqual(int(response['Content-Length']), len(response.content))
+        self.assertTrue(response.content.endswith(data[5:] + '\r\n--%s--\r\n' % response['Content-Type'].split('=')[1]))
+        response = self.client.get(url, HTTP_RANGE='bytes=%d-' % len(data))
+        self.failUnlessEqual(response.status_code, 416)
+        response = self.client.get(url, HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"stale"')
+        self.failUnlessEqual(response.status_code, 200)
+
+        #test ranges of chunked archives start at the right chunk
+        self.bo.deduplicate = True
+        self.bo.save()
+        create_widgets(1000)
+        ba = self.bo.backup()
+        data = ba.open().read()
+        self.assertTrue(ba.archivechunk_set.count() > 1)
+        offset = ba.archivechunk_set.get(position=1).offset
+        url = reverse('admin:vz_backup_download_archive', args=(ba.id, ))
+        response = self.client.get(url, HTTP_RANGE='bytes=%d-%d' % (offset - 3, offset + 3))
+        self.failUnlessEqual(response.content, data[offset - 3:offset + 4])
+
+
+    def _count_queries(self, url):
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            response = self.client.get(url)
+            return response, len(connection.queries)
+        finally:
+            settings.DEBUG = old_debug
+
+
+    def test_admin_changelist_queries(self):
+        #test changelist query count does not grow with rows
+        self.user1.is_staff = True
+        self.user1.save()
+        url = reverse('admin:vz_backup_backupobject_changelist')
+        response, few = self._count_queries(url)
+        self.failUnlessEqual(response.status_code, 200)
+        for i in range(5):
+            bo = BackupObject.objects.create(app_label='app%s' % i)
+            BackupArchive.objects.create(backup_object=bo, name='a', path='a', size=10, keep=True)
+            BackupArchive.objects.create(backup_object=bo, name='b', path='b', size=5)
+        response, many = self._count_queries(url)
+        self.failUnlessEqual(few, many)
+        self.assertContains(response, '15.0 B')
+
+        #test archive table is paginated
+        response = self.client.get(reverse('admin:vz_backup_backupobject_change', args=(self.bo.id, )),
+            {'archive_page': 'last'})
+        self.failUnlessEqual(response.status_code, 200)
+        self.assertContains(response, 'vz_backup_ba_table')
+
+
     def test_views_keep_archive(self):
         #test keep archive
         response = self.client.get(reverse('admin:vz_backup_keep_archive', args=('keep', '1')))
@@ -298,8 +1259,95 @@ class VZBackupTestCase(BackupTestCase):
         self.failUnlessEqual(BackupTestWidget.objects.count(), self.num_widgets)
         create_widgets(self.num_widgets)
         response = self.client.post(reverse('admin:vz_backup_reload_archive', args=('1', )))
-        self.failUnlessEqual(BackupTestWidget.objects.count(), self.num_widgets)
         self.failUnlessEqual(response.status_code, 302)
+        call_command('run_backup_jobs', once=True, verbosity=0)
+        self.failUnlessEqual(BackupTestWidget.objects.count(), self.num_widgets)
+
+    def test_models_jobs(self):
+        #test jobs for the same action coalesce
+        job = self.bo.enqueue('backup')
+        self.failUnlessEqual(self.bo.enqueue('backup'), job)
+        self.bo.enqueue('mail', 1)
+        self.failUnlessEqual(BackupJob.objects.filter(status='queued').count(), 2)
+
+        #test the worker runs queued jobs and records how they went
+        self.bo.mail_to.add(self.user1)
+        create_widgets(1)
+        call_command('run_backup_jobs', once=True, verbosity=0)
+        job = BackupJob.objects.get(id=job.id)
+        self.failUnlessEqual(job.status, 'done')
+        self.failUnlessEqual(job.progress, 'dumping BackupTestWidget')
+        self.assertTrue(job.result.startswith('archive %s, %d bytes, ' % (self.bo.last_archive.id,
+            self.bo.last_archive.size)))
+        self.assertTrue(job.result.endswith(' rows/s'))
+        self.assertTrue(job.duration is not None)
+        self.failUnlessEqual(len(mail.outbox), 2)
+
+        #test new archives are maintained by queued maintain jobs, left
+        #alone by next_job and run in one batch
+        create_widgets(1)
+        self.bo.enqueue('backup').run()
+        create_widgets(1)
+        self.bo.enqueue('backup').run()
+        self.failUnlessEqual(next_job(), None)
+        self.failUnlessEqual(BackupJob.objects.filter(action='maintain', status='queued').count(), 2)
+        jobs = vz_backup.models.run_maintenance_jobs()
+        self.failUnlessEqual(len(jobs), 2)
+        self.failUnlessEqual(jobs[0].status, 'done')
+        self.failUnlessEqual(jobs[0].result, '2 archives, 1 mails')
+        self.failUnlessEqual(len(mail.outbox), 3)
+
+        #test the worker maintains every maintain_every jobs while more
+        #are queued
+        create_widgets(1)
+        self.bo.enqueue('backup')
+        prune = self.bo.enqueue('prune')
+        call_command('run_backup_jobs', once=True, verbosity=0, maintain_every=1)
+        self.failUnlessEqual(len(mail.outbox), 4)
+        self.failIf(BackupJob.objects.filter(status='queued').exists())
+        maintain = BackupJob.objects.filter(action='maintain').latest()
+        self.assertTrue(maintain.finished <= BackupJob.objects.get(id=prune.id).started)
+
+        #test failing jobs record the error
+        job = self.bo.enqueue('reload', 999)
+        self.failUnlessEqual(next_job(), job)
+        job.run()
+        job = BackupJob.objects.get(id=job.id)
+        self.failUnlessEqual(job.status, 'failed')
+        self.assertTrue(job.error.startswith('DoesNotExist'))
+
+        #test finished jobs are not coalesced
+        job = self.bo.enqueue('reload', 999)
+        self.assertTrue(job.pending is not None)
+        self.failUnlessEqual(BackupJob.objects.filter(pending=job.pending).count(), 1)
+
+        #test running jobs without progress for too long are failed and
+        #no longer coalesced
+        self.failUnlessEqual(next_job(), job)
+        stale = datetime.datetime.now() - datetime.timedelta(seconds=vz_backup.models.JOB_TIMEOUT + 60)
+        BackupJob.objects.filter(id=job.id).update(heartbeat=stale)
+        self.assertTrue(self.bo.enqueue('reload', 999) != job)
+        job = BackupJob.objects.get(id=job.id)
+        self.failUnlessEqual(job.status, 'failed')
+        self.assertTrue(job.error.startswith('Stale'))
+        self.assertTrue(job.pending is None)
+
+        #test a job reporting progress is not stale
+        job = next_job()
+        job.set_progress(u'dumping')
+        self.failUnlessEqual(vz_backup.models.fail_stale_jobs(), 0)
+        self.failUnlessEqual(self.bo.enqueue('reload', 999), job)
+
+        #test snapshot backups are never stale, their progress is only seen once they commit
+        job.run()
+        self.bo.snapshot = True
+        self.bo.save()
+        job = self.bo.enqueue('backup')
+        self.failUnlessEqual(next_job(), job)
+        BackupJob.objects.filter(id=job.id).update(heartbeat=stale)
+        self.failUnlessEqual(vz_backup.models.fail_stale_jobs(), 0)
+        self.failUnlessEqual(self.bo.enqueue('backup'), job)
+
 
     def test_exeptions_ArchiveHashesDoNotMatch(self):
         #test tampered file hash
@@ -309,6 +1357,15 @@ class VZBackupTestCase(BackupTestCase):
         ba.save()
         self.failUnlessRaises(ArchiveHashesDoNotMatch, self.bo.reload, 1)
 
+        #test a damaged archive is rolled back, leaving the data as it was
+        create_widgets(2)
+        ba = self.bo.backup()
+        with open(ba.path, 'r+b') as f:
+            f.seek(ba.size / 2)
+            f.write('}}')
+        self.failUnlessRaises(ArchiveHashesDoNotMatch, self.bo.reload, ba.id)
+        self.failUnlessEqual(BackupTestWidget.objects.count(), self.num_widgets + 2)
+
 
     def tearDown(self):
         pass
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Throttling
+
+Backups often share their host with the database they read.  A Throttle
+holds a backup to a write rate in MB a second and a read rate in rows a
+second with token buckets and, given a latency target, backs off while
+the database takes longer than that to answer a batch of rows.  Time
+spent waiting is added to the 'throttle' phase of the backup's
+PhaseTimer.
+
+lower_priority() renices the current process and sets its IO scheduling
+class, for the processes backups run in.
+"""
+
+from django.conf import settings
+
+import os
+import subprocess
+import time
+
+WRITE_RATE = getattr(settings, 'VZ_BACKUP_WRITE_RATE', None)
+READ_RATE = getattr(settings, 'VZ_BACKUP_READ_RATE', None)
+LATENCY_TARGET = getattr(settings, 'VZ_BACKUP_LATENCY_TARGET', None)
+MAX_BACKOFF = getattr(settings, 'VZ_BACKUP_MAX_BACKOFF', 5.0)
+NICE = getattr(settings, 'VZ_BACKUP_NICE', None)
+IONICE_CLASS = getattr(settings, 'VZ_BACKUP_IONICE_CLASS', None)
+IONICE_LEVEL = getattr(settings, 'VZ_BACKUP_IONICE_LEVEL', None)
+
+# backoffs shorter than this are dropped
+MIN_BACKOFF = 0.001
+
+# set once lower_priority ran, in this process or the one it was forked
+# from, whose priority it inherited
+_lowered = False
+
+
+class TokenBucket(object):
+    """
+    Token Bucket
+
+    Refills at *rate* tokens a second up to *burst* tokens, one second
+    worth by default.  Taking more tokens than there are puts the bucket
+    in debt, paid back by waiting.  *clock* tells the time in seconds.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.time):
+        self.rate = float(rate)
+        self.burst = burst or self.rate
+        self.tokens = self.burst
+        self.clock = clock
+        self.last = clock()
+
+    def take(self, amount):
+        """Take *amount* tokens, returns the seconds to wait for them."""
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens = self.tokens - amount
+        if self.tokens < 0:
+            return -self.tokens / self.rate
+        return 0.0
+
+
+class Throttle(object):
+    """
+    Throttle
+
+    Slows the writes and row fetches reported to it down to *write_rate*
+    MB and *read_rate* rows a second, either None for no limit.  With a
+    *latency_target*, whenever *batch_rows* rows took longer than that
+    many seconds to fetch the backoff between batches doubles, up to
+    *max_backoff* seconds, and it halves again after every fast batch.
+    Fetches are reported a batch at a time, see fetched.
+
+    *clock* and *sleep* tell the time and wait, time.time and time.sleep
+    unless given.
+    """
+
+    def __init__(self, write_rate=None, read_rate=None, latency_target=None,
+            max_backoff=MAX_BACKOFF, batch_rows=1000, timer=None, clock=time.time,
+            sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.write_bucket = None
+        if write_rate:
+            self.write_bucket = TokenBucket(write_rate * 1024 * 1024, clock=clock)
+        self.read_bucket = None
+        if read_rate:
+            self.read_bucket = TokenBucket(read_rate, clock=clock)
+        self.latency_target = latency_target
+        self.max_backoff = max_backoff
+        self.batch_rows = batch_rows
+        self.timer = timer
+        self.backoff = 0.0
+        self.waited = 0.0
+        self.bytes = 0
+        self.rows = 0
+        self.started = clock()
+
+    def wait(self, seconds):
+        if seconds <= 0:
+            return
+        if self.timer is not None:
+            timer_start = self.timer.start()
+        start = self.clock()
+        self.sleep(seconds)
+        if self.timer is not None:
+            self.timer.stop('throttle', timer_start)
+        self.waited = self.waited + self.clock() - start
+
+    def wrote(self, size):
+        """Account for *size* bytes written."""
+        self.bytes = self.bytes + size
+        if self.write_bucket is not None:
+            self.wait(self.write_bucket.take(size))
+
+    def fetched(self, rows, latency):
+        """
+        Account for a batch of *rows* rows that took *latency* seconds to
+        fetch, ideally batch_rows of them.  Its latency is scaled to
+        batch_rows rows before it is compared with the latency target.
+        """
+        self.rows = self.rows + rows
+        wait = 0.0
+        if self.read_bucket is not None:
+            wait = self.read_bucket.take(rows)
+        if self.latency_target is not None:
+            if latency * self.batch_rows / max(rows, 1) > self.latency_target:
+                self.backoff = min(max(self.backoff * 2, latency), self.max_backoff)
+            elif self.backoff / 2 >= MIN_BACKOFF:
+                self.backoff = self.backoff / 2
+            else:
+                self.backoff = 0.0
+            wait = wait + self.backoff
+        self.wait(wait)
+
+    def throughput(self):
+        """
+        Bytes and rows a second reached since the throttle was made, and
+        the seconds spent waiting, as a dict.
+        """
+        seconds = max(self.clock() - self.started, 1e-6)
+        return {
+            'seconds': seconds,
+            'waited': self.waited,
+            'bytes_per_second': self.bytes / seconds,
+            'rows_per_second': self.rows / seconds,
+        }
+
+
+def lower_priority(nice=NICE, ionice_class=IONICE_CLASS, ionice_level=IONICE_LEVEL):
+    """
+    Lower Priority
+
+    Add *nice* to the niceness of the current process and set its IO
+    scheduling class and level with the ionice command, where set.  A
+    missing ionice command is ignored, as are calls after the first.
+    """
+    global _lowered
+    if _lowered:
+        return
+    _lowered = True
+    if nice:
+        os.nice(nice)
+    if ionice_class is not None:
+        args = ['ionice', '-c', str(ionice_class)]
+        if ionice_level is not None:
+            args.extend(['-n', str(ionice_level)])
+        args.extend(['-p', str(os.getpid())])
+        try:
+            subprocess.call(args)
+        except OSError:
+            pass
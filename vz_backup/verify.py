@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Archive verification
+
+Re-hashes archives to find missing, truncated and corrupted ones before
+they are needed.  Archive files are hashed memory mapped with every
+digest the archive has in one pass, see generate_file_hashes, and
+deduplicated archives are rebuilt from their chunks.  Archives are
+checked on a thread pool: hashlib lets go of the GIL while it hashes, so
+threads keep several cores and disks busy.  Threads never touch the
+database, everything they need is looked up before.
+"""
+
+from django.utils.datastructures import SortedDict
+
+from vz_backup import HASH_BUFFER_SIZE, generate_file_hashes
+from vz_backup.chunks import ChunkReader, chunk_path
+from vz_backup.exceptions import ArchiveHashesDoNotMatch
+from vz_backup.models import ArchiveChunk, BackupArchive
+
+from multiprocessing.pool import ThreadPool
+
+import datetime
+import hashlib
+import os
+import zlib
+
+STATUSES = ('ok', 'missing', 'truncated', 'corrupt')
+
+# archives looked up or updated per query
+UPDATE_BATCH_SIZE = 500
+
+# archive fields a check needs, the large text columns are left out
+ARCHIVE_FIELDS = ('id', 'backup_object', 'path', 'size', 'chunked', 'file_hash', 'extra_hash')
+
+
+def check_file(path, size, hashes):
+    """
+    Check File
+
+    Status of the file at *path*, expected to be *size* bytes long with
+    *hashes*, hexdigests by algorithm: 'ok', 'missing', 'truncated' when
+    it is shorter, 'corrupt' when it is longer or a digest differs.
+    """
+    try:
+        actual = os.path.getsize(path)
+    except OSError:
+        return 'missing'
+    if actual < size:
+        return 'truncated'
+    if actual > size:
+        return 'corrupt'
+    try:
+        if generate_file_hashes(path, hashes.keys()) != hashes:
+            return 'corrupt'
+    except (IOError, OSError):
+        return 'missing'
+    return 'ok'
+
+
+def check_chunks(app_label, digests, size, hashes):
+    """
+    Check Chunks
+
+    Status of the deduplicated archive made of the chunks *digests* of
+    *app_label*, like check_file.  A chunk that can't be decompressed or
+    doesn't match its digest makes it corrupt.
+    """
+    for digest in digests:
+        if not os.path.exists(chunk_path(app_label, digest)):
+            return 'missing'
+    file_hashes = [(algorithm, hashlib.new(algorithm)) for algorithm in hashes]
+    reader = ChunkReader(app_label, digests)
+    actual = 0
+    try:
+        data = reader.read(HASH_BUFFER_SIZE)
+        while data:
+            for algorithm, file_hash in file_hashes:
+                file_hash.update(data)
+            actual = actual + len(data)
+            data = reader.read(HASH_BUFFER_SIZE)
+    except (IOError, OSError):
+        return 'missing'
+    except (zlib.error, ArchiveHashesDoNotMatch):
+        return 'corrupt'
+    if actual < size:
+        return 'truncated'
+    if actual > size or dict((algorithm, file_hash.hexdigest())
+            for algorithm, file_hash in file_hashes) != hashes:
+        return 'corrupt'
+    return 'ok'
+
+
+def archive_hashes(archive):
+    """Hexdigests of *archive* by algorithm, file_hash and extra_hash."""
+    hashes = {}
+    if archive.file_hash:
+        hashes['sha1'] = archive.file_hash
+    if archive.extra_hash:
+        algorithm, digest = archive.extra_hash.split(':', 1)
+        hashes[algorithm] = digest
+    return hashes
+
+
+def _check(task):
+    archive, check, args = task
+    return archive, check(*args)
+
+
+def _set_verified(ids, now):
+    BackupArchive.objects.filter(id__in=ids).update(last_verified=now)
+
+
+def verify_archives(archives, workers=4):
+    """
+    Verify Archives
+
+    Check every archive of the queryset *archives*, with only the
+    ARCHIVE_FIELDS loaded, on *workers* threads, yielding
+    (archive, status) pairs in order.  Archives found ok get last_verified
+    set to when the check started, UPDATE_BATCH_SIZE at a time so an
+    interrupted run keeps what it did.
+    """
+    now = datetime.datetime.now()
+    archives = list(archives.only(*ARCHIVE_FIELDS))
+    digests = SortedDict((archive.id, []) for archive in archives if archive.chunked)
+    ids = digests.keys()
+    for start in range(0, len(ids), UPDATE_BATCH_SIZE):
+        for archive_id, digest in ArchiveChunk.objects.filter(
+                archive__in=ids[start:start + UPDATE_BATCH_SIZE]).order_by(
+                'archive', 'position').values_list('archive', 'chunk__digest'):
+            digests[archive_id].append(digest)
+    tasks = []
+    for archive in archives:
+        if archive.chunked:
+            tasks.append((archive, check_chunks, (archive.backup_object.app_label,
+                digests[archive.id], archive.size, archive_hashes(archive))))
+        else:
+            tasks.append((archive, check_file, (archive.path, archive.size, archive_hashes(archive))))
+
+    pool = ThreadPool(max(workers, 1))
+    verified = []
+    try:
+        for archive, status in pool.imap(_check, tasks):
+            if status == 'ok':
+                verified.append(archive.id)
+                if len(verified) >= UPDATE_BATCH_SIZE:
+                    _set_verified(verified, now)
+                    verified = []
+            yield archive, status
+    finally:
+        pool.terminate()
+        if verified:
+            _set_verified(verified, now)
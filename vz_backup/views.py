@@ -4,13 +4,19 @@ from django.conf import settings
 from django.contrib.auth.decorators import permission_required
 from django.core.urlresolvers import reverse
 from django.core.servers.basehttp import FileWrapper
-from django.http import HttpResponse, HttpResponseNotFound
+from django.http import HttpResponse, HttpResponseNotFound, HttpResponseNotModified
 from django.shortcuts import get_object_or_404, redirect, render_to_response
 from django.template import RequestContext
+from django.utils.http import http_date, parse_etags, quote_etag
+from django.views.static import was_modified_since
+from vz_backup.container import EXTENSION as CONTAINER_EXTENSION, iter_model_fixture, select_members
 from vz_backup.models import BackupArchive
+from vz_backup.ranges import ArchiveRanges, parse_range
 
 import mimetypes
 import os
+import time
+import zipfile
 
 @permission_required('backuparchive.can_delete')
 def delete_archive(request, model_admin, id):
@@ -52,22 +58,48 @@ def download_archive(request, id):
     
     If backup archive with *id* exists and user had change permissions
     download file based on *send_file* setting.
+
+    Answers If-None-Match (ETag is the archive sha1) and If-Modified-Since
+    with 304 Not Modified.  Without a send file setting Range requests,
+    including several ranges and If-Range, are served with 206 Partial
+    Content so interrupted downloads can be resumed.
     """
     try:
         archive = BackupArchive.objects.select_related().get(id__exact=id)
     except BackupArchive.DoesNotExist:
         return HttpResponseNotFound('Archive with this ID does not exist.')
 
-    if not os.path.exists(archive.path):
+    if not archive.chunked and not os.path.exists(archive.path):
         return HttpResponseNotFound('Archive path does not exist.')
 
     send_file = getattr(settings,'VZ_BACKUP_SEND_FILE', None)
 
+    etag = quote_etag(archive.file_hash)
+    mtime = time.mktime(archive.created.timetuple())
+    last_modified = http_date(mtime)
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        etags = parse_etags(if_none_match)
+        not_modified = '*' in etags or archive.file_hash in etags
+    else:
+        not_modified = 'HTTP_IF_MODIFIED_SINCE' in request.META and not was_modified_since(
+            request.META['HTTP_IF_MODIFIED_SINCE'], int(mtime))
+    if not_modified:
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        response['Last-Modified'] = last_modified
+        return response
+
+    mimetype = mimetypes.guess_type(archive.name)[0] or 'application/octet-stream'
+
     headers = dict()
     headers['Content-Length'] = archive.size
     headers['Content-Disposition'] = 'attachment; filename=%s'%archive.name
+    headers['ETag'] = etag
+    headers['Last-Modified'] = last_modified
 
-    if send_file == 'x-accel-redirect' or send_file == 'x-send-file':
+    if not archive.chunked and (send_file == 'x-accel-redirect' or send_file == 'x-send-file'):
         response = HttpResponse()
         if send_file == 'x-accel-redirect':
             headers['Content-Type'] = ''
@@ -75,18 +107,61 @@ def download_archive(request, id):
         else:
             headers['X-Sendfile'] = archive.path
     else:
-        if archive.backup_object.compress == 'None':
-            wrapper = FileWrapper(open(archive.path, 'r'))
+        headers['Accept-Ranges'] = 'bytes'
+        ranges = None
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if if_range is None or if_range in (etag, last_modified):
+            ranges = parse_range(request.META.get('HTTP_RANGE'), archive.size)
+
+        if ranges is None:
+            wrapper = FileWrapper(archive.open())
+            response = HttpResponse(wrapper, mimetype=mimetype)
+        elif not ranges:
+            response = HttpResponse(status=416)
+            headers['Content-Length'] = 0
+            headers['Content-Range'] = 'bytes */%d' % archive.size
         else:
-            wrapper = FileWrapper(open(archive.path, 'rb'))
-
-        response = HttpResponse(wrapper, mimetype=mimetypes.guess_type(archive.path)[0])
+            body = ArchiveRanges(archive, ranges, content_type=mimetype)
+            headers['Content-Length'] = len(body)
+            if body.multipart:
+                mimetype = 'multipart/byteranges; boundary=%s' % body.boundary
+            else:
+                headers['Content-Range'] = 'bytes %d-%d/%d' % (ranges[0] + (archive.size, ))
+            response = HttpResponse(body, mimetype=mimetype, status=206)
 
     for k, v in headers.iteritems():
         response[k] = v
 
     return response
 
+@permission_required('backuparchive.can_change')
+def download_archive_model(request, id, model):
+    """
+    Download Archive Model
+
+    Rows of *model*, an 'app_label.ModelName' label, in container archive
+    *id* as a JSON fixture.  Only the members holding the model are read.
+    """
+    try:
+        archive = BackupArchive.objects.get(id__exact=id)
+    except BackupArchive.DoesNotExist:
+        return HttpResponseNotFound('Archive with this ID does not exist.')
+
+    if not archive.container or not os.path.exists(archive.path):
+        return HttpResponseNotFound('Archive is not a container archive.')
+
+    container = zipfile.ZipFile(archive.path)
+    try:
+        if not select_members(container, [model]):
+            return HttpResponseNotFound('Archive holds no rows of this model.')
+    finally:
+        container.close()
+
+    response = HttpResponse(iter_model_fixture(archive.path, model), mimetype='application/json')
+    response['Content-Disposition'] = 'attachment; filename=%s.%s.json' % (
+        archive.name[:-len(CONTAINER_EXTENSION) - 1].rsplit('.', 1)[0], model)
+    return response
+
 @permission_required('backuparchive.can_change')
 def keep_archive(request, action, id):
     try:
@@ -110,8 +185,8 @@ def mail_archive(request, id):
     except BackupArchive.DoesNotExist:
         return HttpResponseNotFound('Archive with this ID does not exist.')
 
-    archive.backup_object.mail(archive.id)
-    request.user.message_set.create(message='Sent archive')
+    archive.backup_object.enqueue('mail', archive.id)
+    request.user.message_set.create(message='Queued mail of archive')
 
     return redirect(reverse('admin:vz_backup_backupobject_change', args=(archive.backup_object.id, )))
 
@@ -128,8 +203,8 @@ def reload_archive(request, model_admin, id):
     has_perm = request.user.has_perm(opts.app_label + '.' + opts.get_change_permission())
 
     if request.method == 'POST':
-        archive.backup_object.reload(archive.id)
-        request.user.message_set.create(message='App Reloaded from Backup Archive')
+        archive.backup_object.enqueue('reload', archive.id)
+        request.user.message_set.create(message='Queued reload of app from Backup Archive')
         return redirect(reverse('admin:vz_backup_backupobject_change', args=(archive.backup_object.id, )))
 
     context = {